@@ -0,0 +1,213 @@
+import atexit
+import ipaddress
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import (
+    mAccessLog,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+ACCESS_LOG_ENABLED = getattr(settings, 'ACCESS_LOG_ENABLED', True)
+ACCESS_LOG_SAMPLE_RATE = getattr(settings, 'ACCESS_LOG_SAMPLE_RATE', 1.0)
+ACCESS_LOG_BATCH_SIZE = getattr(settings, 'ACCESS_LOG_BATCH_SIZE', 200)
+ACCESS_LOG_FLUSH_SECONDS = getattr(settings, 'ACCESS_LOG_FLUSH_SECONDS', 5)
+ACCESS_LOG_MAX_BUFFER = getattr(settings, 'ACCESS_LOG_MAX_BUFFER', 5000)
+ACCESS_LOG_EXCLUDE = getattr(settings, 'ACCESS_LOG_EXCLUDE', ('/static/', '/media/', '/favicon.ico'))
+ACCESS_LOG_TRUST_FORWARDED = getattr(settings, 'ACCESS_LOG_TRUST_FORWARDED', False)
+
+
+"""
+アクセスログ(mAccessLog)の記録
+
+    リクエスト毎にINSERTせず、プロセス毎のバッファに積んで
+    ACCESS_LOG_BATCH_SIZE件溜まるか、ACCESS_LOG_FLUSH_SECONDS経ったら
+    別スレッドがbulk_createでまとめて書き込む。
+    バッファがACCESS_LOG_MAX_BUFFERを超えたら(書き込みが追い付かない時)は
+    リクエストを待たせずにログを捨てる。
+
+    User-Agent, Accept-Languageの解析結果は同じ値でキャッシュする。
+"""
+
+BOT = re.compile(r'bot|crawl|spider|slurp|curl|wget|python-requests', re.IGNORECASE)
+
+# 先に一致したものを使う(ChromeのUser-AgentにはSafariも含まれるため順番が重要)
+BROWSERS = [
+    ('Edge', re.compile(r'Edg(e|A|iOS)?/')),
+    ('Opera', re.compile(r'OPR/|Opera')),
+    ('Samsung Internet', re.compile(r'SamsungBrowser/')),
+    ('Chrome', re.compile(r'Chrome/|CriOS/')),
+    ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('Safari', re.compile(r'Version/.*Safari/')),
+    ('Internet Explorer', re.compile(r'MSIE |Trident/')),
+]
+
+
+@lru_cache(maxsize=1024)
+def parse_user_agent(user_agent):
+    """
+    User-Agentから(デバイス, ブラウザ)を返す。
+    """
+
+    if not user_agent:
+        return 'Unknown', 'Unknown'
+    if BOT.search(user_agent):
+        return 'Bot', 'Bot'
+
+    if 'iPad' in user_agent or 'Tablet' in user_agent \
+            or ('Android' in user_agent and 'Mobile' not in user_agent):
+        device = 'Tablet'
+    elif 'Mobile' in user_agent or 'iPhone' in user_agent or 'Android' in user_agent:
+        device = 'Mobile'
+    else:
+        device = 'PC'
+
+    for browser, pattern in BROWSERS:
+        if pattern.search(user_agent):
+            return device, browser
+    return device, 'Other'
+
+
+@lru_cache(maxsize=256)
+def parse_language(accept_language):
+    """
+    Accept-Languageで最も優先される言語
+    """
+
+    best, best_q = '', -1.0
+    for item in (accept_language or '').split(','):
+        lang, _, params = item.strip().partition(';')
+        lang = lang.strip()
+        if not lang or lang == '*':
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = lang, q
+    return best[:mAccessLog._meta.get_field('language').max_length]
+
+
+def client_ip(request):
+    ip = request.META.get('REMOTE_ADDR', '')
+    if ACCESS_LOG_TRUST_FORWARDED:
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            ip = forwarded.split(',')[0].strip()
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        return None
+
+
+def should_log(request):
+    if request.method == 'OPTIONS':
+        return False
+    if any(request.path.startswith(prefix) for prefix in ACCESS_LOG_EXCLUDE):
+        return False
+    return ACCESS_LOG_SAMPLE_RATE >= 1 or random.random() < ACCESS_LOG_SAMPLE_RATE
+
+
+def build_record(request, visitor=None):
+    device, browser = parse_user_agent(request.META.get('HTTP_USER_AGENT', ''))
+    return mAccessLog(
+        uuid=visitor,
+        ip=client_ip(request),
+        device=device,
+        page=request.get_full_path()[:mAccessLog._meta.get_field('page').max_length],
+        browser=browser,
+        language=parse_language(request.META.get('HTTP_ACCEPT_LANGUAGE', '')),
+    )
+
+
+class AccessLogBuffer:
+    """
+    アクセスログのバッファ
+        add はロックを取ってリストに追加するだけで、DBには触らない。
+        書き込みはフラッシュ用のスレッドだけが行う。
+    """
+
+    def __init__(self, batch_size=ACCESS_LOG_BATCH_SIZE, flush_seconds=ACCESS_LOG_FLUSH_SECONDS,
+                 max_buffer=ACCESS_LOG_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.records = []
+        self.dropped = 0
+        self.written = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, record):
+        with self._lock:
+            if len(self.records) >= self.max_buffer:
+                self.dropped += 1
+                return False
+            self.records.append(record)
+            full = len(self.records) >= self.batch_size
+        if self._thread is None:
+            self._start()
+        if full:
+            self._wakeup.set()
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('アクセスログの書き込みに失敗しました')
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """
+        溜まっているログを書き込み、件数を返す。
+            書き込みに失敗したバッチは捨てる。(再送でバッファが溢れないように)
+        """
+
+        with self._lock:
+            records, self.records = self.records, []
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            logger.warning('アクセスログを%d件捨てました', dropped)
+
+        count = 0
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            logged_at = timezone.now()
+            for record in batch:
+                record.logged_at = logged_at
+            mAccessLog.objects.bulk_create(batch, batch_size=self.batch_size)
+            count += len(batch)
+        self.written += count
+        return count
+
+
+buffer = AccessLogBuffer()
@@ -16,6 +16,7 @@ from .models import (
     MessageNotification,
     ReplyRelationShip,
     FollowRequest,
+    TrafficRollup,
 )
 
 admin.site.register(mUser)
@@ -34,3 +35,4 @@ admin.site.register(Notification)
 admin.site.register(MessageNotification)
 admin.site.register(ReplyRelationShip)
 admin.site.register(FollowRequest)
+admin.site.register(TrafficRollup)
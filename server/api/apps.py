@@ -12,5 +12,19 @@ class ApiConfig(AppConfig):
             liked_receiver,
             follow_request_receiver,
             send_read_message,
-            recevie_message
+            recevie_message,
+            user_cache_receiver,
+            tweet_cache_receiver,
+            tweet_relation_cache_receiver,
+            tweet_m2m_cache_receiver,
+            entry_cache_receiver,
+            setting_cache_receiver,
+            setting_m2m_cache_receiver,
+            follow_cache_receiver,
+            follow_request_cache_receiver,
+            notification_cache_receiver,
+            media_variants_receiver,
+            blob_pre_save_receiver,
+            blob_save_receiver,
+            blob_delete_receiver,
         )
@@ -0,0 +1,280 @@
+import gzip
+import json
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
+
+from .models import (
+    ArchiveBucket,
+    Message,
+    MessageNotification,
+    Notification,
+)
+from .storage import retain_blobs
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+ARCHIVE_NOTIFICATION_DAYS = getattr(settings, 'ARCHIVE_NOTIFICATION_DAYS', 90)
+ARCHIVE_MESSAGE_DAYS = getattr(settings, 'ARCHIVE_MESSAGE_DAYS', 365)
+ARCHIVE_PURGE_DELETED_DAYS = getattr(settings, 'ARCHIVE_PURGE_DELETED_DAYS', 30)
+ARCHIVE_BATCH_SIZE = getattr(settings, 'ARCHIVE_BATCH_SIZE', 1000)
+ARCHIVE_PAGE_SIZE = getattr(settings, 'ARCHIVE_PAGE_SIZE', 50)
+
+
+"""
+古い行のアーカイブ
+
+    created_atが保存期間より前の行を、作成した月とkey(読み出す単位)毎にまとめて
+    gzipで圧縮したNDJSONとしてArchiveBucketに移し、元のテーブルからは削除する。
+    削除フラグの立った行は、ARCHIVE_PURGE_DELETED_DAYS経ったらアーカイブせずに削除する。
+    どちらもbatch_size件ずつ別のトランザクションで行うため、長いロックを取らない。
+
+    アーカイブした行は fetch_archived で保存されていない(pkだけ持った)モデルとして読み出せる。
+    画面に出す時は fetch_archived_page で新しい方からページ単位で読む。(必要なバケットだけ展開する)
+
+    name : ArchiveBucket.kind
+    model : 対象のモデル
+    key : 読み出す単位のカラム
+    days : 保存期間(日)
+    deleted_at : 削除フラグを立てた日時の代わりに使うカラム
+
+    子のテーブルから先に処理する。(メッセージを削除すると通知もCASCADEで消えるため)
+"""
+ARCHIVE_SECTIONS = [
+    {
+        'name': 'notification',
+        'model': Notification,
+        'key': 'receive_user_id',
+        'days': ARCHIVE_NOTIFICATION_DAYS,
+        'deleted_at': 'created_at',
+    },
+    {
+        'name': 'message_notification',
+        'model': MessageNotification,
+        'key': 'receiver_id',
+        'days': ARCHIVE_NOTIFICATION_DAYS,
+        'deleted_at': 'created_at',
+    },
+    {
+        'name': 'message',
+        'model': Message,
+        'key': 'room_id',
+        'days': ARCHIVE_MESSAGE_DAYS,
+        'deleted_at': 'updated_at',
+    },
+]
+
+SECTIONS = OrderedDict((section['name'], section) for section in ARCHIVE_SECTIONS)
+
+
+def bucket_period(value):
+    """
+    日時が入るバケット(月初の日付)
+    """
+    return timezone.localtime(value).date().replace(day=1)
+
+
+def encode_rows(rows):
+    lines = [json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) for row in rows]
+    return gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def decode_rows(data):
+    for line in gzip.decompress(bytes(data)).decode('utf-8').splitlines():
+        if line:
+            yield json.loads(line)
+
+
+def _columns(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def _file_columns(model):
+    return [field.attname for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+
+
+def archive_batch(section, before, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    保存期間を過ぎた行をbatch_size件アーカイブし、件数を返す。
+    """
+
+    model = section['model']
+    with transaction.atomic():
+        rows = list(
+            model.objects.filter(created_at__lt=before)
+            .order_by('created_at', 'pk')
+            .values(*_columns(model))[:batch_size]
+        )
+        if not rows:
+            return 0
+
+        buckets = OrderedDict()
+        for row in rows:
+            buckets.setdefault((bucket_period(row['created_at']), str(row[section['key']])), []).append(row)
+
+        file_columns = _file_columns(model)
+        for (period, key), bucket_rows in buckets.items():
+            blobs = [row[column] for row in bucket_rows for column in file_columns if row[column]]
+            # 元の行を削除すると参照数が減るため、アーカイブの分を先に増やしておく
+            retain_blobs(blobs)
+            ArchiveBucket.objects.create(
+                kind=section['name'],
+                period=period,
+                key=key,
+                row_count=len(bucket_rows),
+                data=encode_rows(bucket_rows),
+                blobs=json.dumps(blobs),
+            )
+
+        pk_column = model._meta.pk.attname
+        model.objects.filter(pk__in=[row[pk_column] for row in rows]).delete()
+    return len(rows)
+
+
+def purge_deleted_batch(section, before, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    削除フラグが立ってから一定期間経った行をbatch_size件削除し、件数を返す。
+    """
+
+    model = section['model']
+    with transaction.atomic():
+        pks = list(
+            model.objects.filter(deleted=True, **{section['deleted_at'] + '__lt': before})
+            .order_by('pk')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if pks:
+            model.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def run_retention(names=None, batch_size=ARCHIVE_BATCH_SIZE, max_batches=None, now=None):
+    """
+    削除済みの行の削除とアーカイブを行い、{name: (削除件数, アーカイブ件数)}を返す。
+        max_batches : 1種類あたりの最大のバッチ数(1回の実行時間を抑える)
+    """
+
+    now = now or timezone.now()
+    purge_before = now - timedelta(days=ARCHIVE_PURGE_DELETED_DAYS)
+    result = OrderedDict()
+    for section in ARCHIVE_SECTIONS:
+        if names is not None and section['name'] not in names:
+            continue
+
+        archive_before = now - timedelta(days=section['days'])
+        purged = archived = batches = 0
+        for batch, before in ((purge_deleted_batch, purge_before), (archive_batch, archive_before)):
+            while max_batches is None or batches < max_batches:
+                count = batch(section, before, batch_size)
+                batches += 1
+                if batch is purge_deleted_batch:
+                    purged += count
+                else:
+                    archived += count
+                if count < batch_size:
+                    break
+
+        result[section['name']] = (purged, archived)
+        logger.info('%s: %d件削除, %d件アーカイブ', section['name'], purged, archived)
+    return result
+
+
+def archived_buckets(name, key, since=None, until=None):
+    """
+    created_atの範囲が入るバケット(periodの古い順)
+    """
+
+    buckets = ArchiveBucket.objects.filter(kind=name, key=str(key)).order_by('period', 'pk')
+    if since is not None:
+        buckets = buckets.filter(period__gte=bucket_period(since))
+    if until is not None:
+        buckets = buckets.filter(period__lte=bucket_period(until))
+    return buckets
+
+
+def iter_archived_rows(name, key):
+    """
+    アーカイブした行をdict(JSONのまま)で返すジェネレーター
+        1バケットずつ展開するため、アーカイブの量に関わらずメモリ使用量は一定。
+    """
+
+    for bucket in archived_buckets(name, key).only('data').iterator():
+        yield from decode_rows(bucket.data)
+
+
+def _bucket_objects(model, bucket):
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    for row in decode_rows(bucket.data):
+        yield model(**{
+            column: fields[column].to_python(value)
+            for column, value in row.items() if column in fields
+        })
+
+
+def fetch_archived(name, key, since=None, until=None):
+    """
+    アーカイブした行を保存されていないモデルのリストで返す。(created_at順)
+        since, until : created_atの範囲
+    """
+
+    model = SECTIONS[name]['model']
+    objs = []
+    for bucket in archived_buckets(name, key, since, until).iterator():
+        for obj in _bucket_objects(model, bucket):
+            if since is not None and obj.created_at < since:
+                continue
+            if until is not None and obj.created_at >= until:
+                continue
+            objs.append(obj)
+
+    objs.sort(key=lambda obj: obj.created_at)
+    return objs
+
+
+def fetch_archived_page(name, key, before=None, limit=ARCHIVE_PAGE_SIZE):
+    """
+    beforeより前にアーカイブした行を新しい方からlimit件返す。
+        バケットの件数(row_count)から新しい月の分だけを選んで展開し、それより古いバケットは読まない。
+        (同じ月のバケットはバッチ毎に複数あるため、月単位で選ぶ)
+
+        返り値 : (created_at順のモデルのリスト, 続きを読む時のbefore(無ければNone))
+    """
+
+    model = SECTIONS[name]['model']
+    buckets = archived_buckets(name, key, until=before).order_by('-period', '-pk')
+    # beforeの月のバケットはbefore以降の行も入っているため件数に数えない
+    partial = bucket_period(before) if before is not None else None
+
+    selected = []
+    count = 0
+    last_period = None
+    more = False
+    for pk, period, row_count in buckets.values_list('pk', 'period', 'row_count'):
+        if last_period is not None and period < last_period:
+            more = True
+            break
+        selected.append(pk)
+        if period != partial:
+            count += row_count
+        if last_period is None and count >= limit:
+            last_period = period
+
+    objs = []
+    for bucket in ArchiveBucket.objects.filter(pk__in=selected).only('data').iterator():
+        objs += [obj for obj in _bucket_objects(model, bucket) if before is None or obj.created_at < before]
+
+    objs.sort(key=lambda obj: (obj.created_at, obj.pk))
+    if len(objs) > limit:
+        # 続きはcreated_atがbeforeより前の行のため、同じ日時の行はページを分けない
+        start = len(objs) - limit
+        while start > 0 and objs[start - 1].created_at == objs[start].created_at:
+            start -= 1
+        more = more or start > 0
+        objs = objs[start:]
+    return objs, (objs[0].created_at if more and objs else None)
@@ -0,0 +1,132 @@
+import hashlib
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 60 * 10)
+
+TAG_KEY = 'tag_version:{0}'
+RESPONSE_KEY = 'response:{0}'
+
+# 依存タグ
+USER = 'user'
+TWEET = 'tweet'
+ENTRY = 'entry'
+SETTING = 'setting'
+
+
+def user_tag(username):
+    """
+    ユーザー個別のタグ(プロフィール詳細用)
+    """
+    return '{0}:{1}'.format(USER, username)
+
+
+def entry_read_tag(username):
+    """
+    ユーザーの記事の既読(ReadManagement)のタグ
+    """
+    return '{0}_read:{1}'.format(ENTRY, username)
+
+
+def get_tag_versions(tags):
+    """
+    タグ毎のバージョンを取得する。
+        バージョンが無い(無効化された, 追い出された)タグには新しい値を振る。
+        値はランダムなので、追い出し後に古いキャッシュを拾う事は無い。
+        同時に値が振られた場合は後勝ちになり、負けた側のキャッシュは参照されなくなるだけ。
+    """
+
+    keys = [TAG_KEY.format(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    missing = {key: uuid.uuid4().hex for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def invalidate_tags(*tags):
+    """
+    タグに依存するキャッシュをまとめて無効化する。
+    """
+    cache.delete_many([TAG_KEY.format(tag) for tag in tags])
+
+
+def viewer_class(request):
+    """
+    閲覧者の区分(匿名 or ログイン済み)
+    """
+    user = getattr(request, 'user', None)
+    return 'auth' if user is not None and user.is_authenticated else 'anon'
+
+
+def response_cache_key(request, tags):
+    """
+    ルート, クエリパラメーター, 閲覧者の区分, タグのバージョンからキーを作る。
+    """
+
+    params = sorted(
+        (key, value)
+        for key in request.query_params
+        for value in request.query_params.getlist(key)
+    )
+    source = '|'.join([
+        request.path,
+        repr(params),
+        viewer_class(request),
+        ','.join(get_tag_versions(tags)),
+    ])
+    return RESPONSE_KEY.format(hashlib.md5(source.encode('utf-8')).hexdigest())
+
+
+def cache_response(*tags, timeout=None):
+    """
+    GETのレスポンスをキャッシュするデコレーター
+        ViewSetやAPIViewのメソッドに付ける。
+
+        tags : 依存するタグ。
+            文字列の他に(view, request, kwargs)を受け取ってタグ(またはタグのリスト)を返す関数も指定できる。
+            タグのキャッシュがsignalsで無効化されると、そのタグを含むレスポンスも無効になる。
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def inner(view, request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(view, request, *args, **kwargs)
+
+            resolved = []
+            for tag in tags:
+                tag = tag(view, request, kwargs) if callable(tag) else tag
+                if isinstance(tag, (list, tuple)):
+                    resolved.extend(tag)
+                else:
+                    resolved.append(tag)
+
+            key = response_cache_key(request, resolved)
+            cached = cache.get(key)
+            if cached is not None:
+                data, status_code = cached
+                return Response(data, status=status_code)
+
+            response = func(view, request, *args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200:
+                cache.set(
+                    key,
+                    (response.data, response.status_code),
+                    RESPONSE_CACHE_TIMEOUT if timeout is None else timeout
+                )
+            return response
+
+        return inner
+
+    return decorator
@@ -0,0 +1,152 @@
+import hashlib
+from functools import wraps
+
+from django.utils.cache import patch_cache_control
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import (
+    mUser,
+    Tweet,
+    RetweetRelationShip,
+)
+from .caches import (
+    get_tag_versions,
+    invalidate_tags,
+    viewer_class,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+条件付きGET(ETag)用のバリデーター
+
+    シリアライズせずにETagを作るため、スコープ毎のバージョンをキャッシュに持つ。
+    バージョンはsignalsで無効化され、次に参照された時に新しい値が振られる。
+
+    FEED : ユーザーのホーム画面のツイート一覧
+    PROFILE : ユーザーのプロフィール, プロフィール画面のツイート一覧
+    VIEWER : 閲覧者のフォロー, いいね, ミュートなど(isLikedなどの表示に影響)
+    INFO : ユーザーの通知一覧
+"""
+
+FEED = 'feed'
+PROFILE = 'profile'
+VIEWER = 'viewer'
+INFO = 'info'
+
+
+def validator_tag(scope, ident):
+    return 'validator:{0}:{1}'.format(scope, ident)
+
+
+def invalidate_validators(scope, *idents):
+    """
+    対象スコープのバリデーターを無効化する。
+        identはユーザー名。
+    """
+
+    tags = [validator_tag(scope, ident) for ident in idents if ident]
+    if tags:
+        invalidate_tags(*tags)
+
+
+def invalidate_feeds(*usernames):
+    """
+    ユーザーとそのフォロワーのホーム画面のバリデーターを無効化する。
+    """
+
+    usernames = [username for username in usernames if username]
+    if not usernames:
+        return
+
+    usernames += list(
+        mUser.objects.filter(followees__username__in=usernames)
+        .values_list('username', flat=True)
+        .distinct()
+    )
+    invalidate_validators(FEED, *usernames)
+
+
+def invalidate_tweet_validators(tweet_pks):
+    """
+    ツイートの件数(いいね, リツイート, リプライ)が変わった時のバリデーターの無効化
+        ツイートが載るのは作成者とリツイートしたユーザーのプロフィール、
+        いいねしたユーザーのいいね一覧、およびそのフォロワーのホーム画面。
+        無効化したユーザー名を返す。(レスポンスキャッシュの無効化用)
+    """
+
+    tweet_pks = [pk for pk in tweet_pks if pk is not None]
+    if not tweet_pks:
+        return set()
+
+    usernames = set(
+        Tweet.objects.filter(pk__in=tweet_pks).values_list('author__username', flat=True)
+    )
+    usernames.update(
+        RetweetRelationShip.objects.filter(target_tweet__in=tweet_pks)
+        .values_list('retweet_user__username', flat=True)
+    )
+    usernames.update(
+        Tweet.liked.through.objects.filter(liked_tweet__in=tweet_pks)
+        .values_list('liked_user__username', flat=True)
+    )
+    invalidate_validators(PROFILE, *usernames)
+    invalidate_feeds(*usernames)
+    return usernames
+
+
+def _matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+    for value in if_none_match.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
+def condition(validators):
+    """
+    ETagで条件付きGETに対応するデコレーター
+        validators(view, request, kwargs)が [(スコープ, ユーザー名), ...] を返す。
+        Noneを返した場合は何もしない。
+
+        If-None-MatchがETagと一致したら、QuerySetもシリアライザーも使わずに304を返す。
+        バージョンの取得はget_manyの1回だけ。
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def inner(view, request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(view, request, *args, **kwargs)
+
+            scopes = validators(view, request, kwargs)
+            if not scopes:
+                return func(view, request, *args, **kwargs)
+
+            versions = get_tag_versions([validator_tag(scope, ident) for scope, ident in scopes])
+            source = '|'.join([request.get_full_path(), viewer_class(request)] + versions)
+            etag = '"{0}"'.format(hashlib.md5(source.encode('utf-8')).hexdigest())
+
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match and _matches(if_none_match, etag):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = func(view, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+
+            response['ETag'] = etag
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        return inner
+
+    return decorator
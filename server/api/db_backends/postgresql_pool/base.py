@@ -0,0 +1,66 @@
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from ...pool import (
+    ConnectionPool,
+    find_pool,
+    get_pool,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def check_connection(conn):
+    if conn.closed:
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    接続をConnectionPoolから借りるPostgreSQLバックエンド
+
+        DjangoはCONN_MAX_AGE=0だとリクエスト毎(database_sync_to_async毎)に接続を閉じるが、
+        このバックエンドでは閉じる代わりにプールへ返す。
+        プールはプロセス内の全スレッドで共有する。(メトリクスはapi.pool.pool_stats)
+
+        DATABASES['POOL']
+            SIZE : 接続数の上限
+            TIMEOUT : 空きを待つ最大秒数
+            CHECK_INTERVAL : この秒数以上使われていない接続はSELECT 1で確認してから貸す
+    """
+
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get('POOL', {})
+        create = super().get_new_connection
+        return get_pool(self.alias, lambda: ConnectionPool(
+            lambda: create(conn_params),
+            maxsize=options.get('SIZE', 10),
+            timeout=options.get('TIMEOUT', 10),
+            check=check_connection,
+            check_interval=options.get('CHECK_INTERVAL', 30),
+        ))
+
+    def get_new_connection(self, conn_params):
+        return self.get_pool(conn_params).acquire()
+
+    def _close(self):
+        if self.connection is None:
+            return
+
+        conn = self.connection
+        pool = find_pool(self.alias)
+        if pool is None:
+            return super()._close()
+
+        # トランザクション途中の接続や壊れた接続は返さずに捨てる
+        discard = conn.closed or self.in_atomic_block or (self.errors_occurred and not self.is_usable())
+        if not discard and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except base.Database.Error:
+                discard = True
+        pool.release(conn, discard=discard)
@@ -0,0 +1,98 @@
+import random
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+読み取りレプリカへの振り分け
+
+    DATABASESの'replica'で始まるエイリアスをレプリカとして扱う。
+    リクエスト毎の状態はReplicaRoutingMiddlewareがセットする。
+    リクエスト外(websocket, signals, コマンドなど)は全てプライマリを使う。
+"""
+
+REPLICA_DATABASES = [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+# 書き込んでもプライマリに固定しないモデル('app_label.modelname')
+#   セッション, アクセスログ, 集計など、直後に読み直して表示に使わないもの。
+REPLICA_PIN_EXCLUDED_MODELS = frozenset(label.lower() for label in getattr(
+    settings, 'REPLICA_PIN_EXCLUDED_MODELS', [
+        'sessions.session',
+        'api.maccesslog',
+        'api.mediablob',
+        'api.trafficrollup',
+        'api.rollupstate',
+        'api.archivebucket',
+    ],
+))
+
+_state = Local()
+
+
+def set_read_replica(flag):
+    """
+    このリクエストの読み取りをレプリカに振り分けるかどうか
+    """
+    _state.read_replica = flag
+    _state.wrote = False
+
+
+def clear_state():
+    _state.read_replica = False
+    _state.wrote = False
+
+
+def has_written():
+    """
+    このリクエスト中に書き込みがあったかどうか
+    """
+    return getattr(_state, 'wrote', False)
+
+
+@contextmanager
+def use_primary():
+    """
+    ブロック内の読み取りをプライマリに固定する。
+    """
+
+    previous = getattr(_state, 'read_replica', False)
+    _state.read_replica = False
+    try:
+        yield
+    finally:
+        _state.read_replica = previous
+
+
+class ReplicaRouter:
+    """
+    読み取りはレプリカ, 書き込みはプライマリに振り分けるルーター
+        - リクエスト中に一度でも書き込んだら、以降の読み取りはプライマリ
+          (REPLICA_PIN_EXCLUDED_MODELSへの書き込みは除く)
+        - トランザクション中の読み取りはプライマリ
+    """
+
+    def db_for_read(self, model, **hints):
+        if not REPLICA_DATABASES or not getattr(_state, 'read_replica', False):
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower not in REPLICA_PIN_EXCLUDED_MODELS:
+            _state.wrote = True
+            _state.read_replica = False
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製なので、どの組み合わせでも同じDBとみなす
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,208 @@
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .models import (
+    Tweet,
+    LikedRelationShip,
+    Message,
+    Entry,
+    Notification,
+    Room,
+)
+from .utils import (
+    chunked,
+)
+from .archive import (
+    SECTIONS as ARCHIVE_SECTIONS,
+    iter_archived_rows,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+"""
+エクスポート対象
+    name : NDJSONの各行の'type'
+    queryset : ユーザーを受け取ってQuerySetを返す
+    fields : values()で取得するカラム(先頭はキーセットのキー)
+    archive : アーカイブ(api.archive)した行も出力する場合
+        keys : ユーザーを受け取ってアーカイブのkeyのリストを返す
+        match : アーカイブの行(dict)がユーザーのものか
+"""
+EXPORT_SECTIONS = [
+    {
+        'name': 'tweet',
+        'queryset': lambda user: Tweet.objects.filter(author=user),
+        'fields': [
+            'pk',
+            'content',
+            'images',
+            'isRetweet',
+            'isReply',
+            'retweet_username',
+            'deleted',
+            'created_at',
+            'updated_at',
+        ],
+    },
+    {
+        'name': 'like',
+        'queryset': lambda user: LikedRelationShip.objects.filter(liked_user=user),
+        'fields': [
+            'pk',
+            'liked_tweet',
+            'created_at',
+        ],
+    },
+    {
+        'name': 'message',
+        'queryset': lambda user: Message.objects.filter(Q(sender=user) | Q(receiver=user)),
+        'archive': {
+            'keys': lambda user: Room.objects.filter(users=user).values_list('pk', flat=True),
+            'match': lambda row, user: user.pk in (row['sender_id'], row['receiver_id']),
+        },
+        'fields': [
+            'pk',
+            'room',
+            'sender__username',
+            'receiver__username',
+            'content',
+            'image',
+            'readed',
+            'deleted',
+            'created_at',
+        ],
+    },
+    {
+        'name': 'entry',
+        'queryset': lambda user: Entry.objects.filter(author=user),
+        'fields': [
+            'pk',
+            'title',
+            'content',
+            'type',
+            'prefecture',
+            'area',
+            'day_week',
+            'direction',
+            'part',
+            'genre',
+            'sex',
+            'is_public',
+            'read_count',
+            'created_at',
+            'updated_at',
+        ],
+    },
+    {
+        'name': 'notification',
+        'queryset': lambda user: Notification.objects.filter(receive_user=user),
+        'archive': {
+            'keys': lambda user: [user.pk],
+            'match': lambda row, user: True,
+        },
+        'fields': [
+            'pk',
+            'event',
+            'send_user__username',
+            'target_tweet_info',
+            'infomation',
+            'readed',
+            'created_at',
+        ],
+    },
+]
+
+SECTION_NAMES = [section['name'] for section in EXPORT_SECTIONS]
+
+
+def iter_user_export(user, sections=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    ユーザーのデータをNDJSONの1行ずつ(bytes)返すジェネレーター
+        キーセットページネーションでchunk_size件ずつ取得するため、
+        件数に関わらずメモリ使用量は一定。
+        アーカイブした行('archived': true)を先に、テーブルに残っている行をpk順に返す。
+    """
+
+    for section in EXPORT_SECTIONS:
+        if sections is not None and section['name'] not in sections:
+            continue
+
+        for row in iter_archived_export(section, user):
+            yield _export_line(section['name'], row, archived=True)
+
+        queryset = section['queryset'](user).values(*section['fields'])
+        for row in chunked(queryset, chunk_size=chunk_size):
+            yield _export_line(section['name'], row)
+
+
+def _export_line(name, row, archived=False):
+    payload = {'type': name, 'data': row}
+    if archived:
+        payload['archived'] = True
+    return (json.dumps(payload, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def iter_archived_export(section, user):
+    """
+    アーカイブした行をセクションのfieldsの形にして返す。
+        sender__username のような関連先の値はまとめて覚えておき、同じ値は1回だけ引く。
+    """
+
+    archive = section.get('archive')
+    if archive is None:
+        return
+
+    model = ARCHIVE_SECTIONS[section['name']]['model']
+    related = {}
+    for key in archive['keys'](user):
+        for row in iter_archived_rows(section['name'], key):
+            if archive['match'](row, user):
+                yield {field: _archived_value(model, row, field, related) for field in section['fields']}
+
+
+def _archived_value(model, row, field, related):
+    if field == 'pk':
+        return row[model._meta.pk.attname]
+
+    name, _, attr = field.partition('__')
+    model_field = model._meta.get_field(name)
+    value = row.get(model_field.attname)
+    if not attr or value is None:
+        return value
+
+    if (name, value) not in related:
+        related[(name, value)] = model_field.related_model.objects \
+            .filter(pk=value).values_list(attr, flat=True).first()
+    return related[(name, value)]
+
+
+def gzip_stream(chunks, flush_size=64 * 1024):
+    """
+    bytesのイテレーターをgzip形式で圧縮しながら返すジェネレーター
+        flush_sizeまで溜まったら返す。
+    """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            buffer.append(data)
+            size += len(data)
+        if size >= flush_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+
+    buffer.append(compressor.flush())
+    yield b''.join(buffer)
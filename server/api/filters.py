@@ -18,6 +18,15 @@ from .models import (
 import logging
 logger = logging.getLogger(__name__)
 
+from .logs import (
+    lazy_qs,
+)
+
+from .hashtags import (
+    parse_tags,
+    tagged_tweet_ids,
+)
+
 from django.shortcuts import get_object_or_404
 
 
@@ -63,19 +72,20 @@ class TweetFilter(django_filter.FilterSet):
     def content_filter(self, queryset, name, value):
         logger.debug('=====CONTENT_FILTER=====')
 
-        h_list = []
-        q_list = []
-        qs = list({i.strip() for i in value.split(',')})
-        for q in qs:
-            if q[0] == '#':
-                h_list.append('Q(hashTag__title=q)')
-            else:
-                q_list.append('Q(content__contains=q)')
-        query_str = '&'.join(q_list) + '|'.join(h_list)
+        terms = {i.strip() for i in value.split(',')} - {''}
+        slugs = parse_tags(terms)
+        words = [term for term in terms if term[:1] not in ('#', '＃')]
+
+        # 文字は全て含むもの, #タグはいずれかが付いたもの(HashTagIndexから)
+        query = Q()
+        for word in words:
+            query &= Q(content__contains=word)
+        if slugs:
+            query &= Q(pk__in=tagged_tweet_ids(slugs))
 
         # ブロックリストにログインユーザーが入っている場合,
         # また、非公開の場合、省く
-        q = Tweet.objects.filter(eval(query_str)).exclude(
+        q = Tweet.objects.filter(query).exclude(
             Q(author__msetting__block_list__username=self.login_user) |
             Q(author__msetting__isPrivate=True)
         )
@@ -92,8 +102,7 @@ class TweetFilter(django_filter.FilterSet):
         elif self.searchFlg == '3':
             q = q.exclude(images__isnull=False).order_by('-created_at')
 
-        logger.debug('検索結果 : ')
-        logger.debug(q)
+        logger.debug('検索結果 : %s', lazy_qs(q))
         return q
 
 
@@ -152,20 +161,17 @@ class TweetFilter(django_filter.FilterSet):
                 # unionしたものが結果
                 res = my_tweets.union(followees_tweets).union(followees_retweets).order_by('-created_at')
 
-        logger.debug('--TWEET_FILTER_RESULT--')
-        logger.debug(res)
+        logger.debug('--TWEET_FILTER_RESULT-- %s', lazy_qs(res))
         return res
 
 
     def deleted_filter(self, queryset, name, value):
 
         logger.debug('====DELETED_FILTER====')
-        logger.debug(name)
-        logger.debug(value)
+        logger.debug('%s %s', name, value)
         lookup = '__'.join([name, 'isnull'])
         res = queryset.filter(**{lookup: value})
-        logger.debug('--result--')
-        logger.debug(res)
+        logger.debug('--result-- %s', lazy_qs(res))
         return res
 
 
@@ -225,7 +231,7 @@ class EntryFilter(django_filter.FilterSet):
             # 新着記事一覧
             res = Entry.objects.filter(is_public=False).order_by('-created_at')
 
-        logger.info(res)
+        logger.debug('%s', lazy_qs(res))
 
         return res
 
@@ -273,6 +279,5 @@ class RoomFilter(django_filter.FilterSet):
                     break
 
         res = Room.objects.filter(pk__in=pk_list)
-        logger.debug('検索結果 : ')
-        logger.info(res)
+        logger.debug('検索結果 : %s', lazy_qs(res))
         return res
@@ -0,0 +1,116 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import (
+    RetweetRelationShip,
+)
+from .caches import (
+    get_tag_versions,
+    invalidate_tags,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+ツイートの共通部分(閲覧者に依存しない部分)のキャッシュ
+
+    キーは (ツイートのpk, updated_at, 件数などのバージョン, 作成者のバージョン, フィールド構成)。
+    いいね, リツイート, リプライの件数はupdated_atが変わらないため、
+    signalsでtweet_tag/author_tagを無効化してバージョンを変える。
+"""
+
+TWEET_FRAGMENT_TIMEOUT = getattr(settings, 'TWEET_FRAGMENT_TIMEOUT', 60 * 60)
+
+FRAGMENT_KEY = 'tweet_fragment:{0}:{1}:{2}:{3}'
+
+
+def tweet_tag(pk):
+    return 'tweet_fragment:{0}'.format(pk)
+
+
+def author_tag(pk):
+    return 'tweet_author:{0}'.format(pk)
+
+
+def invalidate_tweet_fragments(tweet_pks=(), author_pks=()):
+    """
+    ツイート, 作成者単位で共通部分のキャッシュを無効化する。
+    """
+
+    tags = [tweet_tag(pk) for pk in tweet_pks if pk is not None]
+    tags += [author_tag(pk) for pk in author_pks if pk is not None]
+    if tags:
+        invalidate_tags(*tags)
+
+
+def field_signature(field_names):
+    """
+    fields指定によって共通部分の中身が変わるため、キーに含める。
+    """
+    return hashlib.md5(','.join(field_names).encode('utf-8')).hexdigest()[:12]
+
+
+def get_fragments(tweets, signature, render):
+    """
+    ツイートの共通部分をまとめて取得する。
+        キャッシュはget_many/set_manyでまとめて読み書きし、
+        無いものだけrender(tweet)で作る。
+
+        Returns
+        ------------------------------
+        {tweet.pk: 共通部分のdict}
+    """
+
+    if not tweets:
+        return {}
+
+    # リツイートは元ツイートの件数を表示するため、元ツイートのバージョンにも依存する
+    retweet_pks = [tweet.pk for tweet in tweets if tweet.isRetweet]
+    targets = {}
+    if retweet_pks:
+        targets = dict(
+            RetweetRelationShip.objects.filter(retweet__in=retweet_pks)
+            .values_list('retweet', 'target_tweet')
+        )
+
+    tags_by_tweet = {}
+    for tweet in tweets:
+        tags = [tweet_tag(tweet.pk), author_tag(tweet.author_id)]
+        if tweet.pk in targets:
+            tags.append(tweet_tag(targets[tweet.pk]))
+        tags_by_tweet[tweet.pk] = tags
+
+    unique_tags = list({tag for tags in tags_by_tweet.values() for tag in tags})
+    versions = dict(zip(unique_tags, get_tag_versions(unique_tags)))
+
+    keys = {}
+    for tweet in tweets:
+        version = hashlib.md5(
+            ','.join(versions[tag] for tag in tags_by_tweet[tweet.pk]).encode('utf-8')
+        ).hexdigest()[:12]
+        keys[tweet.pk] = FRAGMENT_KEY.format(
+            tweet.pk,
+            tweet.updated_at.timestamp() if tweet.updated_at else 0,
+            version,
+            signature,
+        )
+
+    cached = cache.get_many(list(keys.values()))
+    fragments = {}
+    missing = {}
+    for tweet in tweets:
+        key = keys[tweet.pk]
+        if key in cached:
+            fragments[tweet.pk] = cached[key]
+        elif tweet.pk not in fragments:
+            fragments[tweet.pk] = render(tweet)
+            missing[key] = fragments[tweet.pk]
+
+    if missing:
+        cache.set_many(missing, TWEET_FRAGMENT_TIMEOUT)
+
+    return fragments
@@ -0,0 +1,229 @@
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import (
+    mUser,
+    HashTag,
+    HashTagIndex,
+    Mention,
+    Tweet,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+HASHTAG_MAX_PER_TWEET = getattr(settings, 'HASHTAG_MAX_PER_TWEET', 10)
+MENTION_MAX_PER_TWEET = getattr(settings, 'MENTION_MAX_PER_TWEET', 10)
+
+
+"""
+ハッシュタグ, メンションの抽出と転置インデックス
+
+    ツイートの作成, 更新時(signals)に本文から #タグ と @ユーザー名 を取り出し、
+        - HashTagは無い分だけまとめて作る。(slugで一意)
+        - HashTagIndex(タグ -> ツイート, ツイートの作成日時)を差分だけ追加, 削除する。
+        - HashTag.tweet_countは追加, 削除した分だけ増減する。
+          (削除はカスケードも含めてsignalsのpost_deleteで減らす)
+        - Tweet.hashTag(シリアライザーが返すタグ)も合わせる。
+        - Mention(ユーザー -> ツイート)は存在するユーザーだけ記録する。
+
+    タグのページ, #タグの検索は HashTagIndex の(tag, -created_at)のインデックスを範囲で読む。
+    リツイートは元ツイートのタグをコピーする(viewsets)ため、インデックスには入れない。
+"""
+
+# &#123; などの文字参照や、単語の途中の#は除く
+HASHTAG_RE = re.compile(r'(?<![\w&#＃])[#＃](\w+)')
+MENTION_RE = re.compile(r'(?<![\w@＠])[@＠](\w+)')
+TAG_MAX_LENGTH = HashTag._meta.get_field('slug').max_length
+
+
+def normalize_tag(title):
+    """
+    タグのslug(全角, 半角, 大文字, 小文字の違いをまとめる)
+    """
+    return unicodedata.normalize('NFKC', title).casefold()
+
+
+def extract_hashtags(content):
+    """
+    {slug: 最初に出てきた表記} を出てきた順に返す。
+        数字だけのタグ, 長すぎるタグは除く。
+    """
+
+    tags = {}
+    for title in HASHTAG_RE.findall(content or ''):
+        slug = normalize_tag(title)
+        # 正規化で長くなる文字(ﬀ, ㍻など)があるため、slugの長さも見る
+        if title.isdigit() or max(len(title), len(slug)) > TAG_MAX_LENGTH:
+            continue
+        tags.setdefault(slug, title)
+        if len(tags) >= HASHTAG_MAX_PER_TWEET:
+            break
+    return tags
+
+
+def extract_mentions(content):
+    """
+    メンションされたユーザー名を出てきた順に返す。
+    """
+
+    usernames = []
+    for username in MENTION_RE.findall(content or ''):
+        if username not in usernames:
+            usernames.append(username)
+            if len(usernames) >= MENTION_MAX_PER_TWEET:
+                break
+    return usernames
+
+
+def get_or_create_tags(tags):
+    """
+    {slug: 表記} のHashTagを返す。無い分はまとめて作る。
+    """
+
+    if not tags:
+        return []
+    found = {tag.slug: tag for tag in HashTag.objects.filter(slug__in=tags)}
+    missing = [slug for slug in tags if slug not in found]
+    if missing:
+        # 同時に作られた分はignore_conflictsで無視して取り直す
+        HashTag.objects.bulk_create(
+            [HashTag(title=tags[slug], slug=slug) for slug in missing],
+            ignore_conflicts=True,
+        )
+        found.update({tag.slug: tag for tag in HashTag.objects.filter(slug__in=missing)})
+    return [found[slug] for slug in tags]
+
+
+def index_tweet(tweet, created=False):
+    """
+    ツイートのタグ, メンションをインデックスに反映する。
+        削除(deleted=True)されたツイートはインデックスから外す。
+    """
+
+    if tweet.isRetweet:
+        return
+
+    if tweet.deleted:
+        tags, usernames = [], []
+    else:
+        tags = get_or_create_tags(extract_hashtags(tweet.content))
+        usernames = extract_mentions(tweet.content)
+
+    _sync_tags(tweet, tags, created)
+    _sync_mentions(tweet, usernames, created)
+
+
+def _sync_tags(tweet, tags, created):
+    wanted = {tag.pk for tag in tags}
+    current = set() if created else \
+        set(HashTagIndex.objects.filter(tweet=tweet).values_list('tag_id', flat=True))
+
+    added = wanted - current
+    removed = current - wanted
+    if not added and not removed:
+        return
+
+    if removed:
+        # tweet_countはpost_deleteで減らす
+        HashTagIndex.objects.filter(tweet=tweet, tag_id__in=removed).delete()
+    if added:
+        HashTagIndex.objects.bulk_create([
+            HashTagIndex(tag_id=pk, tweet=tweet, created_at=tweet.created_at) for pk in added
+        ])
+        HashTag.objects.filter(pk__in=added).update(tweet_count=F('tweet_count') + 1)
+    tweet.hashTag.set(tags)
+
+
+def _sync_mentions(tweet, usernames, created):
+    wanted = set(mUser.objects.filter(username__in=usernames).values_list('pk', flat=True)) \
+        if usernames else set()
+    current = set() if created else \
+        set(Mention.objects.filter(tweet=tweet).values_list('user_id', flat=True))
+
+    if current - wanted:
+        Mention.objects.filter(tweet=tweet, user_id__in=current - wanted).delete()
+    if wanted - current:
+        Mention.objects.bulk_create([
+            Mention(user_id=pk, tweet=tweet, created_at=tweet.created_at) for pk in wanted - current
+        ])
+
+
+def parse_tags(terms):
+    """
+    検索語から#付きのものをslugにして返す。
+    """
+    return [normalize_tag(term.lstrip('#＃')) for term in terms if term[:1] in ('#', '＃') and len(term) > 1]
+
+
+def tagged_tweet_ids(slugs):
+    """
+    いずれかのタグが付いたツイートのid(サブクエリ用)
+    """
+    return HashTagIndex.objects.filter(tag__slug__in=slugs, tag__deleted=False).values('tweet')
+
+
+def tagged_tweets(slug, before=None):
+    """
+    タグが付いたツイートを新しい順に返す。
+        before : この日時より前(無限スクロールの続き)
+    """
+
+    # 同じ行で絞るため条件は1回のfilterで渡す
+    lookups = {'tag_entries__tag__slug': slug, 'tag_entries__tag__deleted': False}
+    if before is not None:
+        lookups['tag_entries__created_at__lt'] = before
+    return Tweet.objects.filter(deleted=False, **lookups).order_by('-tag_entries__created_at')
+
+
+def mentioned_tweets(user, before=None):
+    """
+    ユーザーがメンションされたツイートを新しい順に返す。
+    """
+
+    lookups = {'mentions__user': user}
+    if before is not None:
+        lookups['mentions__created_at__lt'] = before
+    return Tweet.objects.filter(deleted=False, **lookups).order_by('-mentions__created_at')
+
+
+def popular_tags(limit=10):
+    """
+    ツイートの件数が多いタグ
+    """
+    return HashTag.objects.filter(deleted=False, tweet_count__gt=0).order_by('-tweet_count')[:limit]
+
+
+def reindex_tweets(batch_size=1000):
+    """
+    全てのツイートのインデックスを作り直し、件数を返す。(既存のツイートの取り込み用)
+    """
+
+    count = 0
+    last_pk = 0
+    while True:
+        tweets = list(Tweet.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not tweets:
+            break
+        for tweet in tweets:
+            index_tweet(tweet)
+        count += len(tweets)
+        last_pk = tweets[-1].pk
+    recount_tags()
+    logger.info('%d件のツイートのハッシュタグを登録しました', count)
+    return count
+
+
+def recount_tags():
+    """
+    HashTag.tweet_countをインデックスの件数で数え直す。
+    """
+
+    counts = HashTagIndex.objects.filter(tag=OuterRef('pk')).order_by() \
+        .values('tag').annotate(count=Count('pk')).values('count')
+    HashTag.objects.update(tweet_count=Coalesce(Subquery(counts), 0))
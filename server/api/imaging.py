@@ -0,0 +1,58 @@
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+"""
+画像の変換処理
+
+    ワーカープロセスで実行するため、Djangoには依存させない。
+"""
+
+FORMAT_EXTENSIONS = {
+    'WEBP': 'webp',
+    'JPEG': 'jpg',
+    'PNG': 'png',
+}
+
+
+def render_variants(data, specs, fmt='WEBP', quality=80):
+    """
+    元画像(bytes)からサイズ違いの画像を作る。
+
+        Parameters
+        -------------------------------------------
+        data : 元画像のbytes
+        specs : [(名前, 幅, 高さ, 'crop' or 'fit'), ...]
+            crop : 指定サイズに中央で切り抜く(アイコン用)
+            fit : 縦横比を保って指定サイズに収める。拡大はしない。
+        fmt : 出力形式(WEBP, JPEG, PNG)
+
+        Returns
+        -------------------------------------------
+        {名前: bytes}
+    """
+
+    with Image.open(BytesIO(data)) as original:
+        # アニメーションは1フレーム目だけを使う
+        original.seek(0)
+        image = ImageOps.exif_transpose(original)
+
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha and fmt != 'JPEG' else 'RGB')
+
+        rendered = {}
+        for name, width, height, mode in specs:
+            if mode == 'crop':
+                resized = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            else:
+                resized = image.copy()
+                resized.thumbnail((width, height), Image.LANCZOS)
+
+            buffer = BytesIO()
+            if fmt == 'PNG':
+                resized.save(buffer, fmt, optimize=True)
+            else:
+                resized.save(buffer, fmt, quality=quality)
+            rendered[name] = buffer.getvalue()
+    return rendered
@@ -0,0 +1,67 @@
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import (
+    mSetting,
+    Notification,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+通知の受信箱
+
+    既読はユーザー毎の既読日時(mSetting.last_read_at)で管理する。
+    既読日時より後に作られ、readedがFalseの通知が未読になる。
+    全て既読にする時は既読日時を1行更新するだけで、通知の件数によらない。
+"""
+
+
+def get_watermark(user):
+    """
+    ユーザーの既読日時(未設定ならNone)
+    """
+
+    try:
+        return user.msetting.last_read_at
+    except mSetting.DoesNotExist:
+        return None
+
+
+def unread_q(watermark):
+    q = Q(readed=False)
+    if watermark is not None:
+        q &= Q(created_at__gt=watermark)
+    return q
+
+
+def unread_notifications(user):
+    return Notification.objects.filter(unread_q(get_watermark(user)), receive_user=user)
+
+
+def is_read(notification, watermark):
+    return notification.readed or (watermark is not None and notification.created_at <= watermark)
+
+
+def mark_all_read(user, at=None):
+    """
+    全ての通知を既読にする。(既読日時を進めるだけ)
+        既読日時は戻さない。
+        設定の行が無いユーザー(作成時のsignalsより前のユーザーなど)は行を作る。
+    """
+
+    at = at or timezone.now()
+    updated = mSetting.objects.filter(
+        Q(last_read_at__isnull=True) | Q(last_read_at__lt=at),
+        target=user,
+    ).update(last_read_at=at)
+
+    if not updated:
+        # 既読日時が既に新しいか、行が無い
+        setting, created = mSetting.objects.get_or_create(target=user, defaults={'last_read_at': at})
+        if created:
+            user.msetting = setting
+            logger.warning('%sの設定が無いため作成しました', user.username)
+    return at
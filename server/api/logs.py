@@ -0,0 +1,140 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+
+class LazyQuerySet:
+    """
+    QuerySetをログに出力する時のラッパー
+        ログが実際に出力される時だけ文字列化され、
+        その場合もSQLを組み立てるだけでQuerySet自体は評価しない。
+    """
+
+    __slots__ = ('queryset',)
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def __str__(self):
+        model = getattr(self.queryset, 'model', None)
+        name = model.__name__ if model is not None else type(self.queryset).__name__
+        try:
+            sql = str(self.queryset.query)
+        except Exception:
+            # EmptyResultSetなどSQLにならないQuerySet
+            sql = '(empty)'
+        return '<QuerySet {0}: {1}>'.format(name, sql)
+
+    __repr__ = __str__
+
+
+def lazy_qs(queryset):
+    """
+    logger.debug('%s', lazy_qs(q)) のように使う。
+    """
+    return LazyQuerySet(queryset)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    ログを1行のJSONで出力するフォーマッター
+        ログ収集基盤への取り込み用
+    """
+
+    def format(self, record):
+        payload = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'func': record.funcName,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+_default_formatter = logging.Formatter()
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    ログの書き出しをリクエストスレッドから切り離すハンドラー
+        レコードは呼び出し元スレッドでメッセージだけ確定させてキューに積み、
+        QueueListenerのスレッドがhandlersで指定したハンドラーへ書き出す。
+
+        Parameters
+        -------------------------------------------
+        handlers : 実際に書き出すハンドラーのリスト
+            dictConfigでは 'cfg://handlers.console' のように参照で指定する。
+            参照は最初に書き出す時(dictConfigが終わった後)に解決するため、
+            ハンドラーの名前の順番には依存しない。
+        maxsize : キューの上限。溢れた分は捨ててdroppedに数える。
+    """
+
+    def __init__(self, handlers=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.targets = handlers if handlers is not None else []
+        self.dropped = 0
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            # ConvertingListは取り出した時にcfg://を解決する
+            targets = [self.targets[i] for i in range(len(self.targets))]
+            for target in targets:
+                if not isinstance(target, logging.Handler):
+                    raise ValueError('ハンドラー %r を解決できません。cfg://handlers.<名前> で指定してください。' % (target,))
+            targets = targets or [logging.StreamHandler()]
+            self._listener = QueueListener(self.queue, *targets, respect_handler_level=True)
+            self._listener.start()
+            atexit.register(self.close)
+
+    def prepare(self, record):
+        """
+        メッセージを確定させる。
+            QueueHandler.prepareはトレースバックをmessageに含めてexc_textを消すため、
+            トレースバックはexc_textに残して書き出す側のフォーマッターに任せる。
+        """
+
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = (self.formatter or _default_formatter).formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # ログのためにリクエストを待たせない
+            self.dropped += 1
+
+    def emit(self, record):
+        if self._listener is None:
+            self._start_listener()
+        super().emit(record)
+
+    def close(self):
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+        super().close()
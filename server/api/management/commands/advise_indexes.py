@@ -0,0 +1,70 @@
+import os
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...slow_queries import (
+    SLOW_QUERY_LOG,
+    read_slow_queries,
+    explain,
+    suggest_indexes,
+)
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on captured slow queries and suggest missing indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-f', '--file', default=SLOW_QUERY_LOG, help='記録したSQLのファイル')
+        parser.add_argument('--limit', type=int, default=20, help='合計時間の上位何件を確認するか')
+        parser.add_argument('--database', default=None, help='EXPLAINするDB(省略時は記録時のDB)')
+        parser.add_argument('--plan', action='store_true', help='EXPLAINの結果も出力')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['file']):
+            raise CommandError('ファイルがありません: ' + options['file'])
+
+        # 同じSQL(パラメーター違い)をまとめる
+        grouped = OrderedDict()
+        for entry in read_slow_queries(options['file']):
+            group = grouped.setdefault(entry['sql'], {
+                'entry': entry,
+                'count': 0,
+                'total_ms': 0.0,
+                'views': set(),
+            })
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            group['views'].add('{0} ({1})'.format(entry['view'], entry['action']))
+
+        groups = sorted(grouped.values(), key=lambda group: group['total_ms'], reverse=True)
+        suggested = OrderedDict()
+        for group in groups[:options['limit']]:
+            entry = group['entry']
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                '{0:.1f}ms / {1}回 (平均 {2:.1f}ms)'.format(
+                    group['total_ms'], group['count'], group['total_ms'] / group['count'])))
+            self.stdout.write('  ' + ', '.join(sorted(group['views'])))
+            self.stdout.write('  ' + entry['sql'])
+
+            try:
+                plan = explain(entry['sql'], entry['params'], options['database'] or entry['alias'])
+            except Exception as e:
+                self.stdout.write(self.style.WARNING('  EXPLAINできません: {0}'.format(e)))
+                continue
+
+            if options['plan']:
+                for line in plan:
+                    self.stdout.write('    ' + line)
+
+            for model, fields in suggest_indexes(entry['sql'], plan):
+                suggested.setdefault((model, tuple(fields)), []).append(group['total_ms'])
+
+        if not suggested:
+            self.stdout.write(self.style.SUCCESS('インデックスの候補はありません。'))
+            return
+
+        self.stdout.write(self.style.MIGRATE_HEADING('インデックスの候補'))
+        for (model, fields), totals in suggested.items():
+            self.stdout.write('  {0}: models.Index(fields={1})  # {2:.1f}ms'.format(
+                model, list(fields), sum(totals)))
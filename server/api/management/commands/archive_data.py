@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...archive import (
+    ARCHIVE_BATCH_SIZE,
+    SECTIONS,
+    run_retention,
+)
+
+
+class Command(BaseCommand):
+    help = 'Purge soft-deleted rows and archive old notifications and messages into monthly buckets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', nargs='+', choices=list(SECTIONS), help='対象の種類')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='1トランザクションで処理する件数')
+        parser.add_argument('--max-batches', type=int, default=None, help='1種類あたりの最大のバッチ数')
+        parser.add_argument('--interval', type=int, default=0, help='この秒数毎に繰り返す(0なら1回だけ)')
+
+    def handle(self, *args, **options):
+        while True:
+            result = run_retention(
+                names=options['only'],
+                batch_size=options['batch_size'],
+                max_batches=options['max_batches'],
+            )
+            for name, (purged, archived) in result.items():
+                self.stdout.write('{0}: {1}件削除, {2}件アーカイブ'.format(name, purged, archived))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from ...uploads import (
+    UPLOAD_SESSION_TTL,
+    cleanup_uploads,
+)
+
+
+class Command(BaseCommand):
+    help = 'Delete expired upload sessions and their staged files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=UPLOAD_SESSION_TTL, help='この秒数以上更新の無いセッションを削除')
+
+    def handle(self, *args, **options):
+        count = cleanup_uploads(ttl=options['ttl'])
+        self.stdout.write('{0}件削除しました。'.format(count))
@@ -0,0 +1,34 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ...db_routers import REPLICA_DATABASES
+
+
+class Command(BaseCommand):
+    help = 'Copy the SQLite primary database to the SQLite replicas (local development only)'
+
+    def handle(self, *args, **options):
+        if not REPLICA_DATABASES:
+            raise CommandError('DATABASE_REPLICA_URLSが設定されていません。')
+
+        primary = settings.DATABASES[DEFAULT_DB_ALIAS]
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('プライマリがSQLiteではありません。')
+
+        for alias in REPLICA_DATABASES:
+            replica = settings.DATABASES[alias]
+            if replica['ENGINE'] != 'django.db.backends.sqlite3':
+                raise CommandError('{0}がSQLiteではありません。'.format(alias))
+
+            connections[alias].close()
+            source = sqlite3.connect(primary['NAME'])
+            target = sqlite3.connect(replica['NAME'])
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+            self.stdout.write('{0}: {1}'.format(alias, replica['NAME']))
@@ -0,0 +1,49 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import mUser
+from ...exports import (
+    EXPORT_CHUNK_SIZE,
+    SECTION_NAMES,
+    iter_user_export,
+    gzip_stream,
+)
+
+
+class Command(BaseCommand):
+    help = 'Export a user\'s data as NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('-o', '--output', help='出力先ファイル(省略時は標準出力)')
+        parser.add_argument('--gzip', action='store_true', help='gzip圧縮して出力')
+        parser.add_argument('--sections', help='カンマ区切り({0})'.format(','.join(SECTION_NAMES)))
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = mUser.objects.get(username=options['username'])
+        except mUser.DoesNotExist:
+            raise CommandError('mUserが存在しません: ' + options['username'])
+
+        sections = None
+        if options['sections']:
+            sections = [i.strip() for i in options['sections'].split(',') if i.strip()]
+            unknown = [i for i in sections if i not in SECTION_NAMES]
+            if unknown:
+                raise CommandError('不明なsectionです: ' + ','.join(unknown))
+
+        stream = iter_user_export(user, sections=sections, chunk_size=options['chunk_size'])
+        if options['gzip']:
+            stream = gzip_stream(stream)
+
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in stream:
+                    f.write(chunk)
+        else:
+            out = sys.stdout.buffer
+            for chunk in stream:
+                out.write(chunk)
+            out.flush()
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...media import (
+    MEDIA_FIELDS,
+    generate_variants,
+    save_variant_names,
+    state_field,
+)
+
+
+class Command(BaseCommand):
+    help = 'Generate resized variants for images uploaded before the media pipeline existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='記録済みの画像も作り直して記録する')
+
+    def handle(self, *args, **options):
+        for model, fields in MEDIA_FIELDS.items():
+            for field_name, kind in fields.items():
+                queryset = (
+                    model.objects.exclude(**{field_name: ''})
+                    .exclude(**{field_name + '__isnull': True})
+                )
+                if not options['all']:
+                    queryset = queryset.filter(**{state_field(field_name): ''})
+
+                count = 0
+                for name in queryset.values_list(field_name, flat=True).distinct().iterator():
+                    try:
+                        save_variant_names(model, field_name, name, generate_variants(name, kind))
+                        count += 1
+                    except Exception as e:
+                        self.stderr.write('{0}: {1}'.format(name, e))
+                self.stdout.write('{0}.{1}: {2}'.format(model.__name__, field_name, count))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ...hashtags import (
+    reindex_tweets,
+    recount_tags,
+)
+
+
+class Command(BaseCommand):
+    help = 'Extract hashtags and mentions from existing tweets and rebuild the hashtag index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回に読み込むツイートの件数')
+        parser.add_argument('--recount', action='store_true', help='インデックスは作り直さず、タグの件数だけ数え直す')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            recount_tags()
+            self.stdout.write('タグの件数を数え直しました。')
+            return
+
+        count = reindex_tweets(batch_size=options['batch_size'])
+        self.stdout.write('{0}件のツイートを登録しました。'.format(count))
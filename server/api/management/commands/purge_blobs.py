@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ...storage import (
+    BLOB_PURGE_GRACE,
+    purge_blobs,
+    sweep_orphan_files,
+)
+
+
+class Command(BaseCommand):
+    help = 'Delete content-addressed files that have stayed unreferenced past the grace period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=BLOB_PURGE_GRACE, help='参照数0のままこの秒数経ったファイルを削除')
+        parser.add_argument('--sweep', action='store_true', help='MediaBlobの行が無いファイルの参照数を先に数える')
+
+    def handle(self, *args, **options):
+        if options['sweep']:
+            count = sweep_orphan_files()
+            self.stdout.write('{0}件のファイルを登録しました。'.format(count))
+
+        count = purge_blobs(grace=options['grace'])
+        self.stdout.write('{0}件削除しました。'.format(count))
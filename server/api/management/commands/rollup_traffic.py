@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...traffic import (
+    TRAFFIC_ROLLUP_BATCH_SIZE,
+    run_rollup,
+)
+
+
+class Command(BaseCommand):
+    help = 'Aggregate new access logs into hourly and daily traffic rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=TRAFFIC_ROLLUP_BATCH_SIZE, help='1トランザクションで集計する件数')
+        parser.add_argument('--max-batches', type=int, default=None, help='1回の実行での最大のバッチ数')
+        parser.add_argument('--interval', type=int, default=0, help='この秒数毎に繰り返す(0なら1回だけ)')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_rollup(batch_size=options['batch_size'], max_batches=options['max_batches'])
+            self.stdout.write('{0}件集計しました。'.format(count))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,244 @@
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+
+from .imaging import (
+    FORMAT_EXTENSIONS,
+    render_variants,
+)
+from .models import (
+    mUser,
+    Tweet,
+    Message,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+アップロード画像のサイズ違い(バリアント)の生成
+
+    保存後にsignalsからschedule_for_instanceを呼び、ワーカープロセスで変換して
+    元画像と同じストレージに保存する。
+    生成済みのバリアント名は画像フィールドの横の<フィールド名>_variant_namesに
+    元画像の名前と一緒に記録し、シリアライザーはそこからURLを返す。
+    (シリアライズ中はストレージにもキャッシュにもアクセスしない)
+    生成前, 元画像が変わった後は元画像のURLを返す。
+"""
+
+MEDIA_WORKERS = getattr(settings, 'MEDIA_WORKERS', 2)
+MEDIA_VARIANT_FORMAT = getattr(settings, 'MEDIA_VARIANT_FORMAT', 'WEBP')
+MEDIA_VARIANT_QUALITY = getattr(settings, 'MEDIA_VARIANT_QUALITY', 80)
+
+
+# 画像の種類毎のバリアント (名前, 幅, 高さ, crop or fit)
+MEDIA_VARIANTS = {
+    # アイコン
+    'avatar': [
+        ('small', 48, 48, 'crop'),
+        ('medium', 96, 96, 'crop'),
+        ('large', 256, 256, 'crop'),
+    ],
+    # プロフィールのヘッダー
+    'header': [
+        ('preview', 750, 250, 'fit'),
+        ('full', 1500, 500, 'fit'),
+    ],
+    # ツイート, メッセージの画像
+    'content': [
+        ('thumb', 320, 320, 'crop'),
+        ('preview', 680, 680, 'fit'),
+        ('full', 2048, 2048, 'fit'),
+    ],
+}
+
+# 画像フィールドと種類
+MEDIA_FIELDS = {
+    mUser: {'icon': 'avatar', 'header': 'header'},
+    Tweet: {'images': 'content'},
+    Message: {'image': 'content'},
+}
+
+_process_executor = None
+_io_executor = None
+_executor_lock = threading.Lock()
+_inflight = set()
+
+
+def _get_executors():
+    global _process_executor, _io_executor
+    with _executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=max(MEDIA_WORKERS, 1), thread_name_prefix='media')
+            if MEDIA_WORKERS > 0:
+                # スレッドを持つプロセス(daphne)からforkしないようにforkserverを使う
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+                _process_executor = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, mp_context=context)
+        return _process_executor, _io_executor
+
+
+def variant_name(name, variant):
+    ext = FORMAT_EXTENSIONS.get(MEDIA_VARIANT_FORMAT, 'webp')
+    return '{0}.{1}.{2}'.format(name, variant, ext)
+
+
+def source_name(name):
+    """
+    バリアントの名前なら元画像の名前を返す。(バリアントでなければそのまま)
+    """
+
+    base, ext = os.path.splitext(name)
+    if ext.lstrip('.') not in FORMAT_EXTENSIONS.values():
+        return name
+    base, variant = os.path.splitext(base)
+    variants = {variant for specs in MEDIA_VARIANTS.values() for variant, *_ in specs}
+    if variant.lstrip('.') in variants and os.path.splitext(base)[1]:
+        return base
+    return name
+
+
+def generate_variants(name, kind, storage=default_storage):
+    """
+    バリアントを生成して保存する。(同期)
+        既に保存されているバリアントは作り直さない。
+    """
+
+    specs = MEDIA_VARIANTS[kind]
+    names = {variant: variant_name(name, variant) for variant, *_ in specs}
+    missing = [spec for spec in specs if not storage.exists(names[spec[0]])]
+
+    if missing:
+        with storage.open(name, 'rb') as f:
+            data = f.read()
+
+        process_executor, _ = _get_executors()
+        args = (data, missing, MEDIA_VARIANT_FORMAT, MEDIA_VARIANT_QUALITY)
+        if process_executor is not None:
+            rendered = process_executor.submit(render_variants, *args).result()
+        else:
+            rendered = render_variants(*args)
+
+        for variant, content in rendered.items():
+            names[variant] = storage.save(names[variant], ContentFile(content))
+
+    return names
+
+
+def state_field(field_name):
+    """
+    生成済みのバリアント名を記録するフィールド
+    """
+    return field_name + '_variant_names'
+
+
+def save_variant_names(model, field_name, name, names):
+    """
+    その画像を使っている全ての行にバリアント名を記録する。
+        signalsを飛ばさないようにupdateで書き込む。
+    """
+
+    state = json.dumps({'source': name, 'names': names}, ensure_ascii=False)
+    return model.objects.filter(**{field_name: name}).update(**{state_field(field_name): state})
+
+
+def get_variant_names(instance, field_name):
+    """
+    今の画像について記録されているバリアント名({バリアント: 名前}, 未生成ならNone)
+    """
+
+    file = getattr(instance, field_name)
+    state = getattr(instance, state_field(field_name))
+    if not file or not state:
+        return None
+    try:
+        state = json.loads(state)
+    except ValueError:
+        return None
+    # 画像が差し替えられた後の古い記録は使わない
+    if state.get('source') != file.name:
+        return None
+    return state.get('names')
+
+
+def _run(model, field_name, name, kind, callback):
+    try:
+        save_variant_names(model, field_name, name, generate_variants(name, kind))
+        if callback is not None:
+            callback()
+    except Exception:
+        logger.exception('バリアントの生成に失敗しました: %s', name)
+    finally:
+        _inflight.discard((model, field_name, name))
+        close_old_connections()
+
+
+def schedule_variants(model, field_name, name, kind, callback=None):
+    """
+    バックグラウンドでバリアントを生成し、その画像を使っている行に記録する。
+        callback : 生成後に呼ぶ関数(URLが変わるのでキャッシュの無効化に使う)
+    """
+
+    key = (model, field_name, name)
+    if not name or key in _inflight:
+        return
+    _inflight.add(key)
+    _, io_executor = _get_executors()
+    io_executor.submit(_run, model, field_name, name, kind, callback)
+
+
+def schedule_for_instance(instance, callback=None):
+    """
+    インスタンスの画像フィールドのうち、バリアントが未生成のものを生成する。
+    """
+
+    model = type(instance)
+    for field_name, kind in MEDIA_FIELDS[model].items():
+        file = getattr(instance, field_name)
+        if file and get_variant_names(instance, field_name) is None:
+            schedule_variants(model, field_name, file.name, kind, callback)
+
+
+def variant_urls(instance, field_name, storage=default_storage):
+    """
+    バリアント毎のURL
+        生成前は全て元画像のURLを返す。(生成は保存時のsignalsで予約される)
+    """
+
+    file = getattr(instance, field_name)
+    if not file:
+        return None
+
+    names = get_variant_names(instance, field_name)
+    if names is None:
+        url = file.url
+        kind = MEDIA_FIELDS[type(instance)][field_name]
+        return {variant: url for variant, *_ in MEDIA_VARIANTS[kind]}
+
+    return {variant: storage.url(name) for variant, name in names.items()}
+
+
+def delete_media(name, storage=default_storage):
+    """
+    ファイルとそのバリアントを削除する。
+    """
+
+    names = [name] + [
+        variant_name(name, variant)
+        for kind in MEDIA_VARIANTS.values()
+        for variant, *_ in kind
+    ]
+    for target in names:
+        try:
+            if storage.exists(target):
+                storage.delete(target)
+        except Exception:
+            logger.exception('ファイルを削除できませんでした: %s', target)
@@ -0,0 +1,47 @@
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core import signing
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+非公開のメディア(メッセージの画像)のURLに付ける署名
+
+    imgタグからはAuthorizationヘッダーを送れないため、URLに ?t= を付ける。
+    JWTをURLに載せるとログやリファラーから漏れた時に全てのAPIを使われるため、
+    ファイル(元画像の名前)毎に署名した、MEDIA_TOKEN_MAX_AGE秒だけ有効なトークンにする。
+    サイズ違いの画像(バリアント)は元画像のトークンで読める。
+"""
+
+MEDIA_TOKEN_MAX_AGE = getattr(settings, 'MEDIA_TOKEN_MAX_AGE', 60 * 60)
+MEDIA_TOKEN_PARAM = 't'
+
+
+def _salt(name):
+    return 'api.media_tokens:' + name
+
+
+def media_token(name, username):
+    """
+    ユーザーがnameのファイルを読むためのトークン
+    """
+    return signing.dumps(str(username), salt=_salt(name))
+
+
+def check_media_token(token, name, max_age=MEDIA_TOKEN_MAX_AGE):
+    """
+    トークンのユーザー名を返す。(別のファイルのトークン, 期限切れ, 改ざんはNone)
+    """
+
+    try:
+        return signing.loads(token, salt=_salt(name), max_age=max_age)
+    except signing.BadSignature:
+        return None
+
+
+def with_media_token(url, token):
+    separator = '&' if '?' in url else '?'
+    return url + separator + urlencode({MEDIA_TOKEN_PARAM: token})
@@ -0,0 +1,148 @@
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .db_routers import (
+    REPLICA_DATABASES,
+    set_read_replica,
+    clear_state,
+    has_written,
+)
+from .slow_queries import (
+    SLOW_QUERY_CAPTURE,
+    SlowQueryRecorder,
+)
+from .access_logs import (
+    ACCESS_LOG_ENABLED,
+    buffer as access_log_buffer,
+    build_record,
+    should_log,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+REPLICA_PIN_SECONDS = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+REPLICA_PIN_COOKIE = 'use_primary'
+REPLICA_PIN_KEY = 'db_pin:{0}'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+VISITOR_COOKIE = 'visitor'
+VISITOR_COOKIE_AGE = 60 * 60 * 24 * 365
+
+
+class ReplicaRoutingMiddleware:
+    """
+    安全なメソッドのリクエストの読み取りをレプリカに振り分けるミドルウェア
+
+        書き込んだユーザーはREPLICA_PIN_SECONDSの間プライマリに固定し、
+        自分のツイートやいいねがレプリカの遅延で見えなくならないようにする。
+        固定はクッキーと、ユーザー名をキーにしたキャッシュの両方で行う。
+        (クライアントはJWT認証でクッキーを送らない事があるため、
+         GETに付くloginUserでも判定する)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not REPLICA_DATABASES:
+            return self.get_response(request)
+
+        set_read_replica(request.method in SAFE_METHODS and not self.is_pinned(request))
+        try:
+            response = self.get_response(request)
+            if has_written() or request.method not in SAFE_METHODS:
+                self.pin(request, response)
+        finally:
+            clear_state()
+        return response
+
+    def is_pinned(self, request):
+        if REPLICA_PIN_COOKIE in request.COOKIES:
+            return True
+        login_user = request.GET.get('loginUser')
+        return bool(login_user) and cache.get(REPLICA_PIN_KEY.format(login_user)) is not None
+
+    def pin(self, request, response):
+        response.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True)
+
+        # DRFで認証されたユーザーは元のHttpRequestにもセットされる
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            cache.set(REPLICA_PIN_KEY.format(user.username), 1, REPLICA_PIN_SECONDS)
+
+
+class SlowQueryMiddleware:
+    """
+    SLOW_QUERY_THRESHOLD_MSより遅いSQLを、発生元のViewとactionと一緒に記録するミドルウェア
+        SLOW_QUERY_CAPTUREが無効ならミドルウェアごと外れる。
+        記録したSQLは python manage.py advise_indexes で確認する。
+    """
+
+    def __init__(self, get_response):
+        if not SLOW_QUERY_CAPTURE:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request._slow_query_recorders = [
+            SlowQueryRecorder(request, alias) for alias in connections
+        ]
+        with ExitStack() as stack:
+            for recorder in request._slow_query_recorders:
+                stack.enter_context(connections[recorder.alias].execute_wrapper(recorder))
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        cls = getattr(view_func, 'cls', None)
+        view = '{0}.{1}'.format(cls.__module__, cls.__name__) if cls else view_func.__name__
+
+        # ViewSetはメソッド毎のaction, APIViewはメソッド名
+        actions = getattr(view_func, 'actions', None) or {}
+        action = actions.get(request.method.lower(), request.method.lower())
+
+        for recorder in getattr(request, '_slow_query_recorders', []):
+            recorder.view = view
+            recorder.action = action
+
+
+class AccessLogMiddleware:
+    """
+    アクセスをmAccessLogに記録するミドルウェア
+        ACCESS_LOG_ENABLEDが無効ならミドルウェアごと外れる。
+        書き込みはapi.access_logsのバッファでまとめて行い、リクエストは待たせない。
+        uuidには訪問者毎のクッキーの値を入れる。
+    """
+
+    def __init__(self, get_response):
+        if not ACCESS_LOG_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not should_log(request):
+            return response
+
+        visitor = self.get_visitor(request)
+        if visitor is None:
+            visitor = uuid.uuid4()
+            response.set_cookie(VISITOR_COOKIE, str(visitor), max_age=VISITOR_COOKIE_AGE, httponly=True)
+        try:
+            access_log_buffer.add(build_record(request, visitor))
+        except Exception:
+            logger.exception('アクセスログを記録できませんでした')
+        return response
+
+    def get_visitor(self, request):
+        try:
+            return uuid.UUID(request.COOKIES[VISITOR_COOKIE])
+        except (KeyError, ValueError):
+            return None
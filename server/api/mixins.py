@@ -1,3 +1,9 @@
+from rest_framework.permissions import SAFE_METHODS
+
+from .planner import plan_queryset
+from .serializers import DynamicFieldsModelSerializer
+
+
 class GetLoginUserMixin:
     """
     Getで来たログインユーザーの名前を取得するメソッド
@@ -11,3 +17,44 @@ class GetLoginUserMixin:
 
     def get_login_user(self):
         return getattr(self, 'login_user', None)
+
+
+class SparseFieldsMixin:
+    """
+    ?fields=pk,content のように返すフィールドをクライアントが選べるようにする。
+        Viewでフィールドを指定している場合はその中から選ぶ。
+        書き込みのリクエストでは使わない。(バリデーションするフィールドが減るため)
+    """
+
+    fields_param = 'fields'
+
+    def get_requested_fields(self, fields=None):
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return fields
+
+        value = request.query_params.get(self.fields_param)
+        if not value:
+            return fields
+
+        requested = [name.strip() for name in value.split(',') if name.strip()]
+        if fields is None:
+            return requested
+        return [name for name in fields if name in requested]
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields(kwargs.pop('fields', None))
+        if fields is not None and issubclass(self.get_serializer_class(), DynamicFieldsModelSerializer):
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+
+    def plan_queryset(self, queryset, fields=None, serializer_class=None):
+        """
+        返すフィールドに必要なselect_related, prefetch_related, 件数をQuerySetに付ける。(planner.py)
+            読む列を絞るのは読み込みのリクエストだけ。(更新するオブジェクトは全ての列を読む)
+        """
+
+        serializer_class = serializer_class or self.get_serializer_class()
+        request = getattr(self, 'request', None)
+        narrow = request is not None and request.method in SAFE_METHODS
+        return plan_queryset(queryset, serializer_class, self.get_requested_fields(fields), narrow=narrow)
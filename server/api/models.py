@@ -97,6 +97,8 @@ class mUser(AbstractBaseUser, PermissionsMixin):
     )
 
     header = models.ImageField(_('Header'), upload_to=profile_file_name, blank=True, null=True)
+    # 生成済みのサイズ違いの画像(api.media)
+    header_variant_names = models.TextField(_('Header Variants'), blank=True, default='', editable=False)
 
     is_staff = models.BooleanField(
         _('Staff Status'),
@@ -126,6 +128,7 @@ class mUser(AbstractBaseUser, PermissionsMixin):
     introduction = models.TextField(_('Introduction'), blank=True, null=True)
 
     icon = models.ImageField(_('Icon'), upload_to=profile_file_name, blank=True, null=True)
+    icon_variant_names = models.TextField(_('Icon Variants'), blank=True, default='', editable=False)
 
     followees = models.ManyToManyField(
         'self',
@@ -208,11 +211,19 @@ class FollowRequest(models.Model):
 
 
 class HashTag(models.Model):
+    """
+    - slug
+        タグを探すためのキー(NFKCで正規化して小文字にしたもの。api.hashtags)
+
+    - tweet_count
+        タグが付いているツイートの件数(HashTagIndexの件数)
+    """
 
     title = models.CharField(_('Title'), max_length=30)
     created_at = models.DateTimeField(_('Created At'), auto_now_add=True)
     deleted = models.BooleanField(_('Delete Flag'), default=False)
-    slug = models.SlugField(_('Slug'), blank=True, null=True)
+    slug = models.SlugField(_('Slug'), max_length=30, unique=True, allow_unicode=True, blank=True, null=True)
+    tweet_count = models.PositiveIntegerField(_('Tweet Count'), default=0)
 
     def __str__(self):
         return self.title
@@ -232,6 +243,8 @@ class Tweet(models.Model):
 
     hashTag = models.ManyToManyField(HashTag, blank=True)
     images = models.ImageField(_('Images'), upload_to=content_file_name, blank=True, null=True)
+    # 生成済みのサイズ違いの画像(api.media)
+    images_variant_names = models.TextField(_('Image Variants'), blank=True, default='', editable=False)
     created_at = models.DateTimeField(_('Created At'), auto_now_add=True)
     updated_at = models.DateTimeField(_('Upadate Date'), auto_now=True)
     deleted = models.BooleanField(_('Delete Flag'), default=False)
@@ -263,6 +276,12 @@ class Tweet(models.Model):
         related_name='reply_target'
     )
 
+    class Meta:
+        indexes = [
+            # プロフィール, ホーム画面のツイート一覧
+            models.Index(fields=['author', 'created_at'], name='tweet_author_created_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
@@ -289,6 +308,12 @@ class RetweetRelationShip(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # フォローユーザーのリツイート, isRetweeted
+            models.Index(fields=['retweet_user', 'target_tweet'], name='retweet_user_target_idx'),
+        ]
+
 
 class ReplyRelationShip(models.Model):
     """
@@ -329,6 +354,12 @@ class LikedRelationShip(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # いいねしたツイート一覧
+            models.Index(fields=['liked_user', 'created_at'], name='liked_user_created_idx'),
+        ]
+
 
 class mSetting(models.Model):
     """
@@ -377,6 +408,9 @@ class mSetting(models.Model):
     target = models.OneToOneField(mUser, on_delete=models.CASCADE)
     isDark = models.BooleanField(_('IsDark'), default=False)
 
+    # 通知を全て既読にした日時(これより前の通知は既読)
+    last_read_at = models.DateTimeField(_('Last Read At'), blank=True, null=True)
+
     @property
     def target__username(self):
         return self.target.username
@@ -420,8 +454,11 @@ class mAccessLog(models.Model):
     device = models.CharField(_('Device'), max_length=50)
     page = models.URLField(_('Page'), max_length=500)
     browser = models.CharField(_('Browser'), max_length=50)
-    time = models.DateTimeField(_('Access Time'), auto_now_add=True)
+    # まとめて書き込むため、書き込んだ時刻ではなくアクセスした時刻を入れる
+    time = models.DateTimeField(_('Access Time'), default=timezone.now)
     language = models.CharField(_('Language'), max_length=30)
+    # 書き込んだ時刻(集計で書き込み途中の行を飛ばさないために使う)
+    logged_at = models.DateTimeField(_('Logged At'), default=timezone.now, editable=False, db_index=True)
 
 
 class Entry(models.Model):
@@ -556,11 +593,19 @@ class Message(models.Model):
     receiver = models.ForeignKey(mUser, related_name='receiver', on_delete=models.CASCADE)
     content = models.TextField(_('Content'))
     image = models.ImageField(_('Image'), upload_to=content_file_name, blank=True, null=True)
+    # 生成済みのサイズ違いの画像(api.media)
+    image_variant_names = models.TextField(_('Image Variants'), blank=True, default='', editable=False)
     readed = models.BooleanField(_('Readed'), default=False)
     deleted = models.BooleanField(_('Deleted'), default=False)
     created_at = models.DateTimeField(_('Created At'), default=timezone.now)
     updated_at = models.DateTimeField(_('Upadate Date'), auto_now=True)
 
+    class Meta:
+        indexes = [
+            # ルームのメッセージ一覧
+            models.Index(fields=['room', 'created_at'], name='message_room_created_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
@@ -571,6 +616,11 @@ class ReadManagement(models.Model):
     entry = models.ForeignKey(Entry, on_delete=models.CASCADE)
     is_read = models.BooleanField(_('Is Read'), default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['target', 'entry'], name='readmng_target_entry_idx'),
+        ]
+
     def __str__(self):
         return self.entry.title
 
@@ -623,6 +673,14 @@ class Notification(models.Model):
     readed = models.BooleanField(default=False)
     deleted = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # 通知一覧, 未読件数
+            models.Index(fields=['receive_user', 'readed', 'event'], name='info_receiver_readed_idx'),
+            # 既読日時より後の通知(未読)
+            models.Index(fields=['receive_user', 'created_at'], name='info_receiver_created_idx'),
+        ]
+
 
 class MessageNotification(models.Model):
 
@@ -658,3 +716,220 @@ class MessageNotification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     readed = models.BooleanField(default=False)
     deleted = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # 未読メッセージの通知
+            models.Index(fields=['receiver', 'readed'], name='msginfo_receiver_readed_idx'),
+        ]
+
+
+class MediaBlob(models.Model):
+    """
+    コンテンツアドレスで保存したファイルの参照数
+        Tweet, Message, hTweetUpd, mUser, ArchiveBucketから参照される。
+        参照数が0のまま一定時間経ったらファイルを削除する。(api.storage.purge_blobs)
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # 参照数が0になった(または保存した)日時。purge_blobsはここから一定時間経った行だけ削除する。
+    released_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['refcount', 'released_at'], name='mediablob_release_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class UploadSession(models.Model):
+    """
+    分割アップロードのセッション
+        - status
+            0: アップロード中
+            1: 保存待ち(全て受信済み)
+            2: 保存済み
+            3: 失敗
+
+        - target_model, target_pk, target_field
+            保存前にツイートなどに紐付けられた場合の紐付け先。
+            保存が終わったらワーカーがフィールドにセットする。
+    """
+
+    UPLOADING = 0
+    PENDING = 1
+    STORED = 2
+    FAILED = 3
+
+    status_choices = (
+        (UPLOADING, _('Uploading')),
+        (PENDING, _('Pending')),
+        (STORED, _('Stored')),
+        (FAILED, _('Failed')),
+    )
+
+    token = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        mUser,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions',
+    )
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    size = models.PositiveIntegerField()
+    received = models.PositiveIntegerField(default=0)
+    status = models.IntegerField(choices=status_choices, default=UPLOADING)
+    stored_name = models.CharField(max_length=255, blank=True)
+    target_model = models.CharField(max_length=100, blank=True)
+    target_pk = models.CharField(max_length=64, blank=True)
+    target_field = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.token)
+
+
+class ArchiveBucket(models.Model):
+    """
+    古い行を圧縮して保存するアーカイブ(api.archive)
+
+        - kind
+            アーカイブした行の種類(notification, message_notification, message)
+
+        - period
+            行を作成した月(月初の日付)
+
+        - key
+            読み出す単位。メッセージはルーム, 通知は受信者。
+
+        - data
+            行をNDJSONにしてgzipで圧縮したもの
+
+        - blobs
+            行が参照していた画像の名前(JSON)。
+            アーカイブがある間は参照数を残し、アーカイブを削除したら減らす。
+    """
+
+    kind = models.CharField(max_length=30)
+    period = models.DateField()
+    key = models.CharField(max_length=64)
+    row_count = models.PositiveIntegerField(default=0)
+    data = models.BinaryField()
+    blobs = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'key', 'period'], name='archive_kind_key_period_idx'),
+        ]
+
+    def __str__(self):
+        return '{0}:{1}:{2}'.format(self.kind, self.key, self.period)
+
+
+class TrafficRollup(models.Model):
+    """
+    アクセスログ(mAccessLog)を集計したもの(api.traffic)
+
+        - granularity
+            hour : 1時間毎, day : 1日毎(日本時間)
+
+        - bucket
+            集計した期間の開始日時
+
+        - page
+            クエリ文字列を除いたパス
+    """
+
+    HOUR = 'hour'
+    DAY = 'day'
+
+    granularity_choices = (
+        (HOUR, _('Hour')),
+        (DAY, _('Day')),
+    )
+
+    granularity = models.CharField(max_length=10, choices=granularity_choices)
+    bucket = models.DateTimeField()
+    page = models.CharField(max_length=500)
+    device = models.CharField(max_length=50)
+    browser = models.CharField(max_length=50)
+    language = models.CharField(max_length=30)
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket', 'page', 'device', 'browser', 'language'],
+                name='traffic_rollup_unique',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket'], name='traffic_granularity_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return '{0}:{1}:{2}'.format(self.granularity, self.bucket, self.page)
+
+
+class RollupState(models.Model):
+    """
+    集計の進み具合
+        last_id : 集計済みの最後の行のid
+    """
+
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.name, self.last_id)
+
+
+class HashTagIndex(models.Model):
+    """
+    ハッシュタグ -> ツイートの転置インデックス(api.hashtags)
+        created_at はツイートの作成日時。タグ毎に新しい順で範囲を読む。
+    """
+
+    tag = models.ForeignKey(HashTag, on_delete=models.CASCADE, related_name='entries')
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name='tag_entries')
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tag', 'tweet'], name='hashtag_index_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['tag', '-created_at'], name='hashtag_index_tag_time_idx'),
+        ]
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.tag_id, self.tweet_id)
+
+
+class Mention(models.Model):
+    """
+    ツイートの本文で@メンションされたユーザー(api.hashtags)
+        created_at はツイートの作成日時。
+    """
+
+    user = models.ForeignKey(mUser, on_delete=models.CASCADE, related_name='mentions')
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name='mentions')
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'tweet'], name='mention_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='mention_user_time_idx'),
+        ]
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.user_id, self.tweet_id)
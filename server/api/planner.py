@@ -0,0 +1,220 @@
+from collections import namedtuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Count, IntegerField, OuterRef, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db.models.query import ModelIterable, QuerySet
+from rest_framework import serializers
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+返すフィールドから必要なクエリを決めるプランナー
+
+    シリアライザーは FIELD_REQUIREMENTS に {フィールド名: needs(...)} を定義する。
+
+    plan_queryset : QuerySetにselect_related, prefetch_related, 件数のannotateを付ける。
+    plan_objects : 取得済みのオブジェクト(ページ, unionの結果など)にまとめてプリフェッチし、
+                   全ての件数を1クエリで集計してセットする。既に取得済みのものは取得しない。
+
+    件数は planned_<フィールド名> の属性にセットし、シリアライザーはあればそれを使う。
+
+    返すフィールドが決まっている(?fields= など)時は、読む列だけを .only() で取得する。
+        - モデルの列のフィールド, source='author.username' のような宣言済みのフィールドは自動で決める。
+        - SerializerMethodField などは needs(columns=[...]) で読む列を宣言する。
+        - シリアライザーの REQUIRED_COLUMNS は常に取得する。(キャッシュのキーなど)
+      列の分からないフィールドが1つでもあれば絞らない。(遅延読み込みで1件ずつクエリが出るため)
+"""
+
+Requirement = namedtuple('Requirement', ['select', 'prefetch', 'counts', 'columns'])
+
+
+class CountOf:
+    """
+    modelのfieldがオブジェクトを指す行の件数
+    """
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+
+    def expression(self):
+        rows = self.model.objects.filter(**{self.field: OuterRef('pk')}).order_by() \
+            .values(self.field).annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+def needs(select=(), prefetch=(), counts=None, columns=None):
+    """
+    フィールドに必要なもの
+        select : select_relatedするForeignKey, OneToOne
+        prefetch : prefetch_relatedするManyToMany, 逆参照
+        counts : {属性名: CountOf(...)}
+        columns : 読む列('author__icon'など)。Noneならフィールドの定義から決める。
+    """
+    return Requirement(
+        tuple(select), tuple(prefetch), dict(counts or {}),
+        None if columns is None else tuple(columns)
+    )
+
+
+def count_attr(name):
+    return 'planned_' + name
+
+
+def planned_count(obj, name):
+    """
+    プランナーが集計した件数(無ければNone)
+    """
+    return getattr(obj, count_attr(name), None)
+
+
+def _field_columns(serializer_class, name):
+    """
+    フィールドが読む列と、そのためにselect_relatedする関連を返す。(分からなければNone)
+    """
+
+    model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+    if model is None:
+        return None
+
+    declared = getattr(serializer_class, '_declared_fields', {}).get(name)
+    if declared is not None:
+        # SerializerMethodField, 入れ子のシリアライザーは中で何を読むか分からない
+        if isinstance(declared, (serializers.SerializerMethodField, serializers.BaseSerializer)):
+            return None
+        source = declared.source or name
+        if source == '*':
+            return None
+        path = source.split('.')
+    else:
+        path = [name]
+
+    if path == ['pk']:
+        return (), ()
+    try:
+        field = model._meta.get_field(path[0])
+    except FieldDoesNotExist:
+        return None
+    if field.many_to_many or field.one_to_many:
+        # プリフェッチするため列は要らない
+        return (), ()
+    if not field.concrete:
+        return None
+    if len(path) == 1:
+        return (path[0], ), ()
+    if not field.is_relation:
+        return None
+    return ('__'.join(path), ), ('__'.join(path[:-1]), )
+
+
+def requirements(serializer_class, field_names=None):
+    """
+    フィールドの必要なものをまとめる。
+        field_names : Noneなら全てのフィールド(列は絞らない)
+    """
+
+    table = getattr(serializer_class, 'FIELD_REQUIREMENTS', {})
+    columns = None
+    if field_names is None:
+        field_names = table.keys()
+    else:
+        columns = list(getattr(serializer_class, 'REQUIRED_COLUMNS', ()))
+
+    select, prefetch, counts = [], [], {}
+    for name in field_names:
+        requirement = table.get(name) or needs()
+        selected = requirement.select
+        if columns is not None:
+            if requirement.columns is not None:
+                columns += [column for column in requirement.columns if column not in columns]
+            else:
+                resolved = _field_columns(serializer_class, name)
+                if resolved is None:
+                    columns = None
+                else:
+                    columns += [column for column in resolved[0] if column not in columns]
+                    selected += resolved[1]
+        select += [lookup for lookup in selected if lookup not in select]
+        prefetch += [lookup for lookup in requirement.prefetch if lookup not in prefetch]
+        counts.update(requirement.counts)
+    return Requirement(select, prefetch, counts, columns)
+
+
+def _only_lookups(model, columns, select):
+    """
+    .only()に渡す名前
+        select_relatedする関連も主キーは必要(名前が無いと関連の全ての列を読むため)
+    """
+
+    lookups = ['pk'] + list(columns)
+    for lookup in select:
+        related = model
+        for part in lookup.split('__'):
+            related = related._meta.get_field(part).related_model
+        lookups.append(lookup + '__' + related._meta.pk.name)
+    return lookups
+
+
+def plan_queryset(queryset, serializer_class, field_names=None, narrow=True):
+    """
+    QuerySetに必要なjoin, プリフェッチ, 件数を付ける。
+        union等の結合したQuerySetは変更できないため、そのまま返す。(plan_objectsで補う)
+        narrow : 返すフィールドが決まっていれば、読む列を絞る。(更新するオブジェクトには使わない)
+    """
+
+    if not isinstance(queryset, QuerySet) or queryset.query.combinator:
+        return queryset
+    if queryset._result_cache is not None:
+        # 取得済み(プリフェッチ済みの関連など)は作り直さない
+        return queryset
+
+    plan = requirements(serializer_class, field_names)
+    if plan.select:
+        queryset = queryset.select_related(*plan.select)
+    if plan.prefetch:
+        queryset = queryset.prefetch_related(*plan.prefetch)
+    if plan.counts:
+        queryset = queryset.annotate(**{
+            count_attr(name): count.expression() for name, count in plan.counts.items()
+        })
+    if narrow and plan.columns is not None and _can_narrow(queryset):
+        queryset = queryset.only(*_only_lookups(queryset.model, plan.columns, plan.select))
+    return queryset
+
+
+def _can_narrow(queryset):
+    # values()や、既にonly(), defer()したものはそのまま
+    return queryset._iterable_class is ModelIterable and queryset.query.deferred_loading == (frozenset(), True)
+
+
+def plan_objects(objs, serializer_class, field_names=None):
+    """
+    取得済みのオブジェクトに必要なものをまとめて取得する。
+    """
+
+    objs = [obj for obj in objs if obj is not None]
+    if not objs:
+        return
+
+    plan = requirements(serializer_class, field_names)
+    lookups = list(plan.select) + list(plan.prefetch)
+    if lookups:
+        prefetch_related_objects(objs, *lookups)
+
+    counts = {count_attr(name): count for name, count in plan.counts.items()}
+    missing = [obj for obj in objs if any(not hasattr(obj, attr) for attr in counts)]
+    if not missing:
+        return
+
+    # 件数は全て相関サブクエリにして1回で取得する
+    model = type(missing[0])
+    rows = model._default_manager.filter(pk__in=[obj.pk for obj in missing]).order_by().annotate(**{
+        attr: count.expression() for attr, count in counts.items()
+    }).values('pk', *counts)
+    loaded = {row.pop('pk'): row for row in rows}
+    for obj in missing:
+        for attr, value in loaded.get(obj.pk, {}).items():
+            setattr(obj, attr, value)
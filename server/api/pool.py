@@ -0,0 +1,196 @@
+import threading
+import time
+from collections import deque
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, create):
+    """
+    エイリアス毎のプロセス内で共有するプールを返す。(無ければcreate()で作る)
+    """
+
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = create()
+        return pool
+
+
+def find_pool(alias):
+    return _pools.get(alias)
+
+
+def pool_stats():
+    """
+    エイリアス毎のプールのメトリクス
+    """
+    return {alias: pool.stats() for alias, pool in _pools.items()}
+
+
+class PoolTimeout(Exception):
+    """
+    timeout秒待っても接続が空かなかった
+    """
+    pass
+
+
+class ConnectionPool:
+    """
+    スレッド間で共有するコネクションプール
+
+        Parameters
+        -------------------------------------------
+        factory : 新しい接続を返す関数
+        maxsize : 同時に貸し出せる接続の上限
+        timeout : 空きを待つ最大秒数
+        check : 接続が使えるか確認する関数(使えなければFalseか例外)
+        check_interval : 最後に返却されてからこの秒数以上経った接続だけ確認する
+        on_close : 接続を捨てる時に呼ぶ関数
+        slow_wait : この秒数以上待った時にwarningを出す
+    """
+
+    def __init__(self, factory, maxsize=10, timeout=10, check=None,
+                 check_interval=30, on_close=None, slow_wait=0.1):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.check = check
+        self.check_interval = check_interval
+        self.on_close = on_close or (lambda conn: conn.close())
+        self.slow_wait = slow_wait
+
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+        # メトリクス
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def acquire(self):
+        """
+        接続を借りる。
+            空きが無く上限に達していれば返却を待つ。
+        """
+
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    break
+                if self._size < self.maxsize:
+                    conn, released_at = None, None
+                    self._size += 1
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout('{0}秒待っても接続が空きませんでした。(上限: {1})'.format(
+                        self.timeout, self.maxsize))
+                waited = True
+                self._cond.wait(remaining)
+
+            self.checkouts += 1
+            if waited:
+                elapsed = time.monotonic() - start
+                self.waits += 1
+                self.wait_time += elapsed
+                self.max_wait = max(self.max_wait, elapsed)
+                if elapsed >= self.slow_wait:
+                    logger.warning('コネクションプールの空き待ち: %.3f秒 %s', elapsed, self.stats())
+
+        # 接続の作成, 確認はロックの外で行う
+        #   使えない接続は閉じるが、枠(_size)はそのまま作り直す接続に使う。
+        if conn is not None and not self._is_healthy(conn, released_at):
+            self._close(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.factory()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            self.created += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        接続を返す。
+            discard=Trueなら捨てて、次に借りる時に作り直す。
+        """
+
+        if discard:
+            self._dispose(conn)
+            with self._cond:
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """
+        空いている接続を全て閉じる。
+        """
+
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._dispose(conn)
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'maxsize': self.maxsize,
+            'created': self.created,
+            'discarded': self.discarded,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'avg_wait': self.wait_time / self.waits if self.waits else 0.0,
+            'max_wait': self.max_wait,
+            'timeouts': self.timeouts,
+        }
+
+    def _is_healthy(self, conn, released_at):
+        if self.check is None:
+            return True
+        if released_at is not None and time.monotonic() - released_at < self.check_interval:
+            return True
+        try:
+            return bool(self.check(conn))
+        except Exception:
+            logger.info('使えない接続を破棄しました。', exc_info=True)
+            return False
+
+    def _close(self, conn):
+        try:
+            self.on_close(conn)
+        except Exception:
+            pass
+        with self._cond:
+            self.discarded += 1
+
+    def _dispose(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
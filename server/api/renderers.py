@@ -0,0 +1,95 @@
+from itertools import islice
+
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+
+STREAM_CHUNK_SIZE = getattr(settings, 'STREAM_CHUNK_SIZE', 500)
+
+_encoder = encoders.JSONEncoder(ensure_ascii=False)
+
+# JSONRendererと同じく、JavaScriptの文字列に直接書けないU+2028, U+2029はエスケープする
+_LINE_SEPARATORS = (
+    ('\u2028'.encode('utf-8'), b'\\u2028'),
+    ('\u2029'.encode('utf-8'), b'\\u2029'),
+)
+
+
+def _escape_line_separators(content):
+    for raw, escaped in _LINE_SEPARATORS:
+        if raw in content:
+            content = content.replace(raw, escaped)
+    return content
+
+
+def dumps(data, indent=None):
+    """
+    dataをJSON(bytes)にする。
+        orjsonがあればorjsonを使い、orjsonが扱えない型(遅延翻訳文字列など)は
+        DRFのJSONEncoderに任せる。日時もJSONEncoderと同じ形式にするため任せる。
+    """
+
+    if orjson is None:
+        return _escape_line_separators(json.dumps(
+            data,
+            cls=encoders.JSONEncoder,
+            ensure_ascii=False,
+            indent=indent,
+            separators=(',', ':') if indent is None else None,
+        ).encode('utf-8'))
+
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return _escape_line_separators(orjson.dumps(data, default=_encoder.default, option=option))
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    orjsonでエンコードするJSONRenderer
+        orjsonがインストールされていない場合はJSONRendererと同じ動作になる。
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        if orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        renderer_context = renderer_context or {}
+        indent = self.get_indent(accepted_media_type, renderer_context)
+        return dumps(data, indent=indent)
+
+
+def stream_json_list(iterable, serialize, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    JSONの配列を少しずつ返すジェネレーター
+        iterableからchunk_size件ずつ取り出し、serialize(objs)でdictのリストにしてから
+        エンコードして返す。一覧全体をメモリに載せない。
+    """
+
+    iterator = iter(iterable)
+    yield b'['
+    first = True
+    while True:
+        objs = list(islice(iterator, chunk_size))
+        if not objs:
+            break
+
+        encoded = b','.join(dumps(item) for item in serialize(objs))
+        if not encoded:
+            continue
+        yield encoded if first else b',' + encoded
+        first = False
+    yield b']'
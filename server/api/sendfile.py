@@ -0,0 +1,175 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+ファイルの配信
+
+    MEDIA_SENDFILE_BACKEND
+        ''        : Pythonで送る(開発用)。Range, 条件付きリクエストにも対応する。
+        'nginx'   : X-Accel-Redirect で MEDIA_SENDFILE_ROOT 以下のinternalなlocationに転送する。
+        'xsendfile' : X-Sendfile でファイルの絶対パスを渡す。(Apacheのmod_xsendfile, lighttpd)
+
+    フロントのサーバーに渡す場合もアクセスの確認と304の判定はこちらで行い、
+    転送とRangeの処理はフロントのサーバーに任せる。
+"""
+
+MEDIA_SENDFILE_BACKEND = getattr(settings, 'MEDIA_SENDFILE_BACKEND', '')
+MEDIA_SENDFILE_ROOT = getattr(settings, 'MEDIA_SENDFILE_ROOT', '/protected-media/')
+
+CHUNK_SIZE = 64 * 1024
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def make_etag(stat):
+    return '"{0:x}-{1:x}"'.format(int(stat.st_mtime), stat.st_size)
+
+
+def _etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    # 弱いETagも同じものとして比較する
+    tags = [tag.strip() for tag in header.split(',')]
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+def not_modified(request, etag, mtime):
+    """
+    If-None-Match, If-Modified-Since を満たす(304を返せる)か
+    """
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def parse_range(request, size, etag, mtime):
+    """
+    Rangeヘッダーから(開始, 終了)を返す。
+        None : 全体を返す(Rangeなし, 複数範囲, If-Rangeが一致しない)
+        ValueError : 範囲を満たせない(416)
+    """
+
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != etag:
+                return None
+        elif parse_http_date_safe(if_range) != int(mtime):
+            return None
+
+    match = RANGE.match(header.strip())
+    if match is None:
+        # 複数範囲などは全体を返す(RFC 7233で許されている)
+        return None
+
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # 末尾からnバイト
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def _read(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, name, document_root, cache_control):
+    """
+    document_root以下のnameを配信する。
+
+        Parameters
+        -------------------------------------------
+        name : document_rootからの相対パス
+        cache_control : Cache-Controlヘッダーの値
+    """
+
+    try:
+        path = safe_join(document_root, name)
+    except ValueError:
+        raise Http404
+    if not os.path.isfile(path):
+        raise Http404
+
+    stat = os.stat(path)
+    etag = make_etag(stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+    content_type, encoding = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+
+    if MEDIA_SENDFILE_BACKEND:
+        response = HttpResponse(content_type=content_type)
+        if MEDIA_SENDFILE_BACKEND == 'nginx':
+            response['X-Accel-Redirect'] = MEDIA_SENDFILE_ROOT.rstrip('/') + '/' + quote(name.replace(os.sep, '/'))
+        else:
+            response['X-Sendfile'] = path
+    else:
+        try:
+            byte_range = parse_range(request, stat.st_size, etag, stat.st_mtime)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(stat.st_size)
+            return response
+
+        start, end = byte_range or (0, stat.st_size - 1)
+        length = end - start + 1 if stat.st_size else 0
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+        else:
+            response = StreamingHttpResponse(_read(path, start, length), content_type=content_type)
+        if byte_range is not None:
+            response.status_code = 206
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, stat.st_size)
+        response['Content-Length'] = str(length)
+
+    if encoding:
+        response['Content-Encoding'] = encoding
+    for key, value in headers.items():
+        response[key] = value
+    return response
@@ -1,4 +1,8 @@
+from collections import OrderedDict
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
 from .models import (
     mUser,
     HashTag,
@@ -18,6 +22,7 @@ from .models import (
     MessageNotification,
     ReplyRelationShip,
     FollowRequest,
+    LikedRelationShip,
 )
 from rest_framework.renderers import JSONRenderer
 
@@ -30,7 +35,9 @@ from datetime import (
 import pytz
 from django.templatetags.i18n import language
 from idlelib.idle_test.test_colorizer import source
+from django.db import models
 from django.db.models import Q
+from django.db.models.query import QuerySet
 from django.core.exceptions import ObjectDoesNotExist
 from .utils import (
     search_retweet_target,
@@ -40,34 +47,97 @@ from .utils import (
     search_retweet_reply_target_base,
     is_base_tweet,
 )
+from .media import variant_urls
+from .media_tokens import (
+    media_token,
+    with_media_token,
+)
+from .fragments import (
+    field_signature,
+    get_fragments,
+)
+from .inbox import (
+    get_watermark,
+    is_read,
+    unread_notifications,
+)
+from .planner import (
+    CountOf,
+    needs,
+    planned_count,
+    plan_queryset,
+    plan_objects,
+)
 
-logging.basicConfig(
-    level = logging.DEBUG,
-    format = '''%(levelname)s %(asctime)s %(pathname)s:%(funcName)s:%(lineno)s
-    %(message)s''')
+logger = logging.getLogger(__name__)
 
 
-logger = logging.getLogger(__name__)
+class PlannedListSerializer(serializers.ListSerializer):
+    """
+    一覧のシリアライザー
+        返すフィールドに必要なものをプランナーでまとめて取得してから変換する。(planner.py)
+    """
+
+    def get_planned_objects(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        field_names = list(self.child.fields)
+        if isinstance(iterable, QuerySet):
+            # 列を絞るのはフィールドを指定された時だけ
+            narrow = getattr(self.child, 'requested_fields', None) is not None
+            iterable = plan_queryset(iterable, type(self.child), field_names, narrow=narrow)
+        objs = list(iterable)
+        plan_objects(objs, type(self.child), field_names)
+        return objs
+
+    def to_representation(self, data):
+        return [self.child.to_representation(item) for item in self.get_planned_objects(data)]
 
 
 class DynamicFieldsModelSerializer(serializers.ModelSerializer):
+    """
+    fieldsで指定したフィールドだけを返すシリアライザー
+        指定されていないフィールドは作らない。
+
+        FIELD_REQUIREMENTS : {フィールド名: needs(...)} フィールドに必要なjoin, プリフェッチ, 件数, 列
+        REQUIRED_COLUMNS : フィールドに関係なく常に読む列
+    """
+
+    FIELD_REQUIREMENTS = {}
+    REQUIRED_COLUMNS = ()
 
     def __init__(self, *args, **kwargs):
 
-        fields = kwargs.pop('fields', None)
+        self.requested_fields = kwargs.pop('fields', None)
 
         super(DynamicFieldsModelSerializer, self).__init__(*args, **kwargs)
 
-        if fields is not None:
+    def get_fields(self):
+        if self.requested_fields is None:
+            return super().get_fields()
+
+        # 指定されていない宣言済みのフィールドはコピーもしない
+        allowed = set(self.requested_fields)
+        self._declared_fields = OrderedDict(
+            (name, field) for name, field in type(self)._declared_fields.items() if name in allowed
+        )
+        try:
+            return super().get_fields()
+        finally:
+            del self._declared_fields
+
+    def get_field_names(self, declared_fields, info):
+        field_names = super().get_field_names(declared_fields, info)
+        if self.requested_fields is None:
+            return field_names
 
-            allowed = set(fields)
-            existing = set(self.fields)
-            for field_name in existing - allowed:
-                self.fields.pop(field_name)
+        allowed = set(self.requested_fields)
+        return [name for name in field_names if name in allowed]
 
 
 class ProfileSubSerializer(DynamicFieldsModelSerializer):
 
+    icon_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = mUser
         fields = [
@@ -79,7 +149,12 @@ class ProfileSubSerializer(DynamicFieldsModelSerializer):
             'header',
             'introduction',
             'icon',
+            'icon_variants',
         ]
+        list_serializer_class = PlannedListSerializer
+
+    def get_icon_variants(self, obj):
+        return variant_urls(obj, 'icon')
 
 
 
@@ -92,6 +167,22 @@ class HashTagSerializer(serializers.ModelSerializer):
             'title',
             'created_at',
             'slug',
+            'tweet_count',
+        ]
+
+
+class HashTagSubSerializer(serializers.ModelSerializer):
+    """
+    ツイートに埋め込むタグ
+        tweet_countはツイートが付く度に変わるため、キャッシュするツイートの断片には含めない。
+    """
+
+    class Meta:
+        model = HashTag
+        fields = [
+            'id',
+            'title',
+            'slug',
         ]
 
 
@@ -114,7 +205,7 @@ class ProfileSerializer(DynamicFieldsModelSerializer):
     created_at = serializers.SerializerMethodField()
     followees = ProfileSubSerializer(many=True)
     followers = serializers.SerializerMethodField()
-    followees_count = serializers.IntegerField(source='followees.count')
+    followees_count = serializers.SerializerMethodField()
     followers_count = serializers.SerializerMethodField()
     tweet = serializers.SerializerMethodField()
     entry = serializers.SerializerMethodField()
@@ -126,6 +217,18 @@ class ProfileSerializer(DynamicFieldsModelSerializer):
     isBlock = serializers.SerializerMethodField(read_only=True)
     isFollow = serializers.SerializerMethodField(read_only=True)
     isSendFollowRequest = serializers.SerializerMethodField(read_only=True)
+    icon_variants = serializers.SerializerMethodField()
+    header_variants = serializers.SerializerMethodField()
+
+    FIELD_REQUIREMENTS = {
+        'followees': needs(prefetch=['followees']),
+        'followees_count': needs(counts={'followees_count': CountOf(FollowRelationShip, 'followee')}),
+        'followers_count': needs(counts={'followers_count': CountOf(FollowRelationShip, 'follower')}),
+        'setting': needs(select=['msetting']),
+        'tweet_limit_level': needs(select=['msetting']),
+        'isBlocked': needs(select=['msetting']),
+        'isPrivate': needs(select=['msetting']),
+    }
 
     def __init__(self, *args, **kwargs):
         self.login_user = kwargs['context']['view'].get_login_user() if 'context' in kwargs else None
@@ -141,8 +244,10 @@ class ProfileSerializer(DynamicFieldsModelSerializer):
             'address',
             'created_at',
             'header',
+            'header_variants',
             'introduction',
             'icon',
+            'icon_variants',
             'followees',
             'followers',
             'followees_count',
@@ -158,15 +263,27 @@ class ProfileSerializer(DynamicFieldsModelSerializer):
             'isFollow',
             'isSendFollowRequest',
         ]
+        list_serializer_class = PlannedListSerializer
 
     def get_created_at(self, obj):
         return obj.created_at.strftime('%Y年%m月%d日')
 
+    def get_icon_variants(self, obj):
+        return variant_urls(obj, 'icon')
+
+    def get_header_variants(self, obj):
+        return variant_urls(obj, 'header')
+
     def get_followers(self, obj):
         return ProfileSubSerializer(mUser.objects.filter(followees=obj), many=True).data
 
+    def get_followees_count(self, obj):
+        count = planned_count(obj, 'followees_count')
+        return count if count is not None else obj.followees.count()
+
     def get_followers_count(self, obj):
-        return len(self.get_followers(obj)) if self.get_followers(obj) != None else 0
+        count = planned_count(obj, 'followers_count')
+        return count if count is not None else obj.get_follower_count()
 
     def get_tweet(self, obj):
         return TweetSerializer(Tweet.objects.filter(author=obj), many=True).data
@@ -176,7 +293,7 @@ class ProfileSerializer(DynamicFieldsModelSerializer):
 
     def get_setting(self, obj):
         try:
-            return MSettingSerializer(mSetting.objects.get(target=obj)).data
+            return MSettingSerializer(obj.msetting).data
         except mSetting.DoesNotExist:
             return None
 
@@ -290,6 +407,18 @@ class ProfileSerializer(DynamicFieldsModelSerializer):
         return mUser.objects.create_user(username=validated_data['username'], email=validated_data['email'], password=validated_data['password'])
 
 
+class TweetListSerializer(PlannedListSerializer):
+    """
+    ツイート一覧のシリアライザー
+        共通部分のキャッシュをまとめて取得してから、閲覧者毎の部分を重ねる。
+    """
+
+    def to_representation(self, data):
+        tweets = self.get_planned_objects(data)
+        fragments = self.child.get_shared_fragments(tweets)
+        return [self.child.merge_viewer_fields(tweet, fragments[tweet.pk]) for tweet in tweets]
+
+
 class TweetSerializer(DynamicFieldsModelSerializer):
     """
     ツイートのシリアライザー
@@ -302,8 +431,71 @@ class TweetSerializer(DynamicFieldsModelSerializer):
         followees_in_retweet_users : フォローしている人がリツイートユーザーにいたら取得
         followees_in_liked : フォローしている人がいいねしたユーザーにいたら取得
         isSendFollowRequest : フォロー申請を送っている状態か
+
+        VIEWER_FIELDS, RELATED_USER_FIELDS以外は閲覧者に依存しないため、
+        ツイート単位でキャッシュした共通部分を使う。(fragments.py)
     """
 
+    # 閲覧者(または現在時刻)によって変わるフィールド
+    VIEWER_FIELDS = (
+        'isLiked',
+        'isFollow',
+        'isMyself',
+        'isRetweeted',
+        'isBlocked',
+        'isSendFollowRequest',
+        'followees_in_retweet_users',
+        'followees_in_liked',
+        'reply',
+        'created_time',
+    )
+
+    # 作成者以外のユーザー(いいね, リツイートしたユーザー)のプロフィールを含むフィールド
+    #   共通部分は作成者の変更でしか無効にならないため、キャッシュせずに毎回作る。
+    RELATED_USER_FIELDS = (
+        'liked',
+        'retweet',
+        'retweet_user',
+        'retweet_users',
+    )
+
+    # 作成者を使うフィールド
+    AUTHOR = needs(select=['author'])
+
+    # 共通部分のキャッシュのキー(fragments.py), リツイートかどうかの判定に使う列
+    REQUIRED_COLUMNS = ('author', 'isRetweet', 'updated_at')
+
+    FIELD_REQUIREMENTS = {
+        'author': AUTHOR,
+        'author_pk': needs(columns=[]),
+        'isFollow': needs(select=['author'], columns=['author__username']),
+        'isMyself': needs(select=['author'], columns=['author__username']),
+        'userIcon': needs(select=['author'], columns=['author__icon']),
+        'userIcon_variants': needs(select=['author'], columns=['author__icon', 'author__icon_variant_names']),
+        'image_variants': needs(columns=['images', 'images_variant_names']),
+        'isSendFollowRequest': needs(select=['author'], columns=[]),
+        'isBlocked': needs(select=['author__msetting'], columns=[]),
+        'hashTag': needs(prefetch=['hashTag'], columns=[]),
+        'liked': needs(prefetch=['liked'], columns=[]),
+        'isLiked': needs(columns=[]),
+        'isRetweeted': needs(columns=[]),
+        'retweet': needs(columns=[]),
+        'retweet_user': needs(columns=[]),
+        'retweet_users': needs(columns=[]),
+        'followees_in_retweet_users': needs(columns=[]),
+        'followees_in_liked': needs(columns=[]),
+        'reply': needs(columns=['isReply']),
+        'created_at': needs(columns=['created_at']),
+        'created_time': needs(columns=['created_at']),
+        'updated_at': needs(columns=['updated_at']),
+        'liked_count': needs(counts={'liked_count': CountOf(LikedRelationShip, 'liked_tweet')}, columns=[]),
+        'retweet_count': needs(counts={'retweet_count': CountOf(RetweetRelationShip, 'target_tweet')}, columns=[]),
+        'reply_count': needs(
+            counts={'reply_count': CountOf(ReplyRelationShip, 'reply_target_base')},
+            columns=['isReply'],
+        ),
+    }
+
     author = serializers.ReadOnlyField(source='author.username')
     author_pk = serializers.CharField(required=False)
     hashTag = serializers.SerializerMethodField()
@@ -323,6 +515,8 @@ class TweetSerializer(DynamicFieldsModelSerializer):
     followees_in_liked = serializers.SerializerMethodField()
     created_time = serializers.SerializerMethodField()
     userIcon = serializers.SerializerMethodField()
+    userIcon_variants = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
     isBlocked = serializers.SerializerMethodField(read_only=True)
     isSendFollowRequest = serializers.SerializerMethodField(read_only=True)
     created_at = serializers.SerializerMethodField()
@@ -352,6 +546,7 @@ class TweetSerializer(DynamicFieldsModelSerializer):
             'isMyself',
             'hashTag',
             'images',
+            'image_variants',
             'created_at',
             'updated_at',
             'reply',
@@ -364,12 +559,67 @@ class TweetSerializer(DynamicFieldsModelSerializer):
             'retweet_users',
             'retweet_count',
             'userIcon',
+            'userIcon_variants',
             'followees_in_retweet_users',
             'followees_in_liked',
             'created_time',
             'isBlocked',
             'isSendFollowRequest',
         ]
+        list_serializer_class = TweetListSerializer
+
+    def to_representation(self, instance):
+        fragments = self.get_shared_fragments([instance])
+        return self.merge_viewer_fields(instance, fragments[instance.pk])
+
+    def represent_fields(self, instance, fields):
+        """
+        指定したフィールドだけを変換する。(Serializer.to_representationと同じ処理)
+        """
+
+        ret = OrderedDict()
+        for field in fields:
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            if check_for_none is None:
+                ret[field.field_name] = None
+            else:
+                ret[field.field_name] = field.to_representation(attribute)
+
+        return ret
+
+    def get_shared_fragments(self, tweets):
+        """
+        閲覧者に依存しない部分をキャッシュから取得する。(無ければ作ってキャッシュ)
+        """
+
+        uncached = self.VIEWER_FIELDS + self.RELATED_USER_FIELDS
+        fields = [field for field in self._readable_fields if field.field_name not in uncached]
+        signature = field_signature([field.field_name for field in fields])
+        return get_fragments(tweets, signature, lambda tweet: self.represent_fields(tweet, fields))
+
+    def merge_viewer_fields(self, instance, shared):
+        """
+        共通部分に閲覧者毎のフィールドを重ねる。
+        """
+
+        fields = list(self._readable_fields)
+        viewer = self.represent_fields(
+            instance,
+            [field for field in fields if field.field_name not in shared]
+        )
+
+        ret = OrderedDict()
+        for field in fields:
+            if field.field_name in shared:
+                ret[field.field_name] = shared[field.field_name]
+            elif field.field_name in viewer:
+                ret[field.field_name] = viewer[field.field_name]
+        return ret
 
     def get_created_at(self, obj):
         return obj.created_at.strftime('%Y年%m月%d日')
@@ -381,7 +631,7 @@ class TweetSerializer(DynamicFieldsModelSerializer):
 
     def get_hashTag(self, obj):
 
-        return HashTagSerializer(obj.hashTag.all(), many=True).data
+        return HashTagSubSerializer(obj.hashTag.all(), many=True).data
 
 
     def get_liked(self, obj):
@@ -392,7 +642,8 @@ class TweetSerializer(DynamicFieldsModelSerializer):
     def get_liked_count(self, obj):
 
         if obj.isRetweet == False:
-            return obj.liked.count()
+            count = planned_count(obj, 'liked_count')
+            return count if count is not None else obj.liked.count()
 
         try:
             return RetweetRelationShip.objects.get(retweet=obj).target_tweet.liked.all().count()
@@ -489,6 +740,10 @@ class TweetSerializer(DynamicFieldsModelSerializer):
 
     def get_reply_count(self, obj):
 
+        count = planned_count(obj, 'reply_count')
+        if count is not None and is_base_tweet(obj):
+            return count
+
         target_tweet = obj
 
         if obj.isRetweet == True:
@@ -511,6 +766,9 @@ class TweetSerializer(DynamicFieldsModelSerializer):
     def get_retweet_count(self, obj):
 
         if obj.isRetweet == False:
+            count = planned_count(obj, 'retweet_count')
+            if count is not None:
+                return count
             return RetweetRelationShip.objects.filter(target_tweet=obj).count()
         return search_retweet_target(obj).retweets.all().count()
 
@@ -616,6 +874,12 @@ class TweetSerializer(DynamicFieldsModelSerializer):
     def get_userIcon(self, obj):
         return '/media/' + str(obj.author.icon)
 
+    def get_userIcon_variants(self, obj):
+        return variant_urls(obj.author, 'icon')
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj, 'images')
+
     def get_isBlocked(self, obj):
 
         if self.login_user == None:
@@ -668,7 +932,12 @@ class SelectSerializer(serializers.Field):
         return value
 
 
-class EntrySerializer(serializers.ModelSerializer):
+class EntrySerializer(DynamicFieldsModelSerializer):
+
+    FIELD_REQUIREMENTS = {
+        'author': needs(select=['author']),
+        'age_disp': needs(prefetch=['age']),
+    }
 
     author = serializers.ReadOnlyField(source='author.username')
     author_pk = serializers.CharField(required=False)
@@ -716,6 +985,7 @@ class EntrySerializer(serializers.ModelSerializer):
             'age_disp',
             'is_read',
         ]
+        list_serializer_class = PlannedListSerializer
 
     def get_type_disp(self, obj):
         return obj.get_type_display()
@@ -769,7 +1039,12 @@ class EntrySerializer(serializers.ModelSerializer):
         return entry
 
 
-class RoomSerializer(serializers.ModelSerializer):
+class RoomSerializer(DynamicFieldsModelSerializer):
+
+    FIELD_REQUIREMENTS = {
+        'msg_count': needs(prefetch=['room__sender']),
+    }
+
     name = serializers.CharField(required=False)
     room_name = serializers.SerializerMethodField()
     users = serializers.SerializerMethodField()
@@ -789,6 +1064,7 @@ class RoomSerializer(serializers.ModelSerializer):
             'created_at',
             'msg_count',
         ]
+        list_serializer_class = PlannedListSerializer
 
     def get_room_name(self, obj):
         room_name = ''
@@ -817,10 +1093,16 @@ class RoomSerializer(serializers.ModelSerializer):
         room.users.add(mUser.objects.get(username=name))
         return room
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(DynamicFieldsModelSerializer):
+
+    FIELD_REQUIREMENTS = {
+        'sender': needs(select=['sender']),
+        'isMe': needs(select=['sender']),
+    }
 
     sender = serializers.SerializerMethodField()
     isMe = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
 
     def __init__(self, *args, **kwargs):
         self.login_user = kwargs['context']['view'].get_login_user() if 'context' in kwargs else None
@@ -834,11 +1116,13 @@ class MessageSerializer(serializers.ModelSerializer):
             'sender',
             'receiver',
             'image',
+            'image_variants',
             'readed',
             'deleted',
             'isMe',
             'created_at',
         ]
+        list_serializer_class = PlannedListSerializer
 
     def get_sender(self, obj):
         sender_name = obj.sender.username
@@ -848,6 +1132,23 @@ class MessageSerializer(serializers.ModelSerializer):
         isMe = str(obj.sender.username) == str(self.login_user)
         return isMe
 
+    def get_image_variants(self, obj):
+        return variant_urls(obj, 'image')
+
+    def to_representation(self, instance):
+        ret = super().to_representation(instance)
+
+        # 非公開の画像は閲覧者用の署名をURLに付ける(api.media_tokens)
+        if settings.MEDIA_PRIVATE_MESSAGES and self.login_user and instance.image:
+            token = media_token(instance.image.name, self.login_user)
+            if ret.get('image'):
+                ret['image'] = with_media_token(ret['image'], token)
+            if ret.get('image_variants'):
+                ret['image_variants'] = {
+                    variant: with_media_token(url, token) for variant, url in ret['image_variants'].items()
+                }
+        return ret
+
 
 class MessageSubSerializer(serializers.ModelSerializer):
 
@@ -875,14 +1176,90 @@ class MSettingSerializer(serializers.ModelSerializer):
         ]
 
 
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationListSerializer(PlannedListSerializer):
+    """
+    通知一覧のシリアライザー
+        ユーザー, 対象ツイートはjoinで取得し、フォロー申請の状態と対象ツイートは
+        ページ分をまとめて取得, 変換しておく。(ページ毎のクエリ数が件数によらず一定になる)
+    """
+
+    def to_representation(self, data):
+        notifications = self.get_planned_objects(data)
+        fields = self.child.fields
+
+        if 'isAccepted' in fields:
+            self.load_accepted(notifications)
+        if 'target_tweet_info' in fields:
+            self.load_target_tweets(notifications)
+
+        return [self.child.to_representation(notification) for notification in notifications]
+
+    def load_accepted(self, notifications):
+        requests = [notification for notification in notifications if notification.event == 4]
+        if not requests:
+            return
+
+        accepted = {
+            (request_user, response_user): isAccepted
+            for request_user, response_user, isAccepted in FollowRequest.objects.filter(
+                follow_request_user__in={notification.send_user_id for notification in requests},
+                follow_response_user__in={notification.receive_user_id for notification in requests},
+            ).values_list('follow_request_user', 'follow_response_user', 'isAccepted')
+        }
+        for notification in requests:
+            notification.planned_isAccepted = accepted.get(
+                (notification.send_user_id, notification.receive_user_id), False)
+
+    def load_target_tweets(self, notifications):
+        tweets = {
+            notification.target_tweet_info.pk: notification.target_tweet_info
+            for notification in notifications if notification.target_tweet_info is not None
+        }
+        if not tweets:
+            return
+
+        data = TweetSerializer(
+            list(tweets.values()),
+            many=True,
+            fields=self.child.TARGET_TWEET_FIELDS,
+        ).data
+        rendered = {tweet.pk: item for tweet, item in zip(tweets.values(), data)}
+        for notification in notifications:
+            if notification.target_tweet_info is not None:
+                notification.planned_target_tweet_info = rendered[notification.target_tweet_info.pk]
+
+
+class NotificationSerializer(DynamicFieldsModelSerializer):
     """
     通知のシリアライザー
         isAccepted : 申請が許可された。
         isRejected : 申請が拒否された。
     """
 
+    # 通知に表示する対象ツイートのフィールド
+    TARGET_TWEET_FIELDS = [
+        'pk',
+        'author',
+        'author_pk',
+        'content',
+        'reply_count',
+        'liked_count',
+        'retweet_count',
+        'created_at',
+        'created_time',
+        'isLiked',
+        'isRetweeted'
+    ]
+
+    FIELD_REQUIREMENTS = {
+        'receive_user': needs(select=['receive_user']),
+        'send_user': needs(select=['send_user']),
+        'target_tweet_info': needs(select=['target_tweet_info__author']),
+        'readed': needs(select=['receive_user__msetting']),
+    }
+
     event = serializers.SerializerMethodField()
+    readed = serializers.SerializerMethodField()
     created_time = serializers.SerializerMethodField()
     receive_user = serializers.SerializerMethodField()
     send_user = serializers.SerializerMethodField()
@@ -905,12 +1282,18 @@ class NotificationSerializer(serializers.ModelSerializer):
             'isAccepted',
             'isRejected',
         ]
+        list_serializer_class = NotificationListSerializer
 
 
     def get_event(self, obj):
         return obj.get_event_display()
 
 
+    def get_readed(self, obj):
+        # 既読日時より前の通知は既読
+        return is_read(obj, get_watermark(obj.receive_user))
+
+
     def get_receive_user(self, obj):
         return ProfileSubSerializer(obj.receive_user).data
 
@@ -920,23 +1303,13 @@ class NotificationSerializer(serializers.ModelSerializer):
 
 
     def get_target_tweet_info(self, obj):
+        if hasattr(obj, 'planned_target_tweet_info'):
+            return obj.planned_target_tweet_info
+
         if obj.target_tweet_info == None:
             return None
 
-        fields = [
-            'pk',
-            'author',
-            'author_pk',
-            'content',
-            'reply_count',
-            'liked_count',
-            'retweet_count',
-            'created_at',
-            'created_time',
-            'isLiked',
-            'isRetweeted'
-        ]
-        return TweetSerializer(obj.target_tweet_info, fields=fields).data
+        return TweetSerializer(obj.target_tweet_info, fields=self.TARGET_TWEET_FIELDS).data
 
 
     def get_created_time(self, obj):
@@ -965,6 +1338,9 @@ class NotificationSerializer(serializers.ModelSerializer):
         if obj.event != 4:
             return False
 
+        if hasattr(obj, 'planned_isAccepted'):
+            return obj.planned_isAccepted
+
         try:
             return FollowRequest.objects.get(
                 follow_request_user=obj.send_user,
@@ -1006,10 +1382,7 @@ class NotificationCountSerializer(serializers.ModelSerializer):
             return 0
         try:
             login_user = mUser.objects.get(username=self.login_user)
-            return Notification.objects.filter(
-                event__in=event_list,
-                receive_user=login_user,
-                readed=False).count()
+            return unread_notifications(login_user).filter(event__in=event_list).count()
         except mUser.DoesNotExist:
             logger.error('mUserが存在しません')
             return 0
@@ -1060,10 +1433,18 @@ class MessageNotificationSerializer(serializers.ModelSerializer):
 
 
     def get_room(self, obj):
-        return RoomSerializer(obj.room).data
+        try:
+            return RoomSerializer(obj.room).data
+        except ObjectDoesNotExist:
+            # アーカイブした通知のルームが削除されている
+            return None
 
     def get_message(self, obj):
-        return MessageSerializer(obj.message).data
+        try:
+            return MessageSerializer(obj.message).data
+        except ObjectDoesNotExist:
+            # アーカイブした通知のメッセージが削除, アーカイブされている
+            return None
 
 
     def get_created_time(self, obj):
@@ -18,6 +18,8 @@ from .models import (
     MessageNotification,
     ReplyRelationShip,
     FollowRequest,
+    ArchiveBucket,
+    HashTagIndex,
 )
 
 from api.serializers import (
@@ -37,6 +39,49 @@ from .utils import (
     analyzeMethod,
 )
 
+from .fragments import (
+    invalidate_tweet_fragments,
+)
+
+from .caches import (
+    invalidate_tags,
+    user_tag,
+    entry_read_tag,
+    USER,
+    TWEET,
+    ENTRY,
+    SETTING,
+)
+
+from .media import (
+    schedule_for_instance,
+)
+
+from .storage import (
+    BLOB_FIELDS,
+    retain_blobs,
+    release_blobs,
+)
+
+from .hashtags import (
+    index_tweet,
+)
+
+from .inbox import (
+    get_watermark,
+    unread_q,
+)
+
+from .conditional import (
+    invalidate_validators,
+    invalidate_feeds,
+    invalidate_tweet_validators,
+    FEED,
+    PROFILE,
+    VIEWER,
+    INFO,
+)
+
 from django.db.models.signals import (
     pre_save,
     post_save,
@@ -51,13 +96,21 @@ from django.core.signals import (
 )
 
 from django.dispatch import receiver
+from django.db import transaction
+from django.db.models import F
 
 logger = logging.getLogger(__name__)
 
 
 from ws.consumers import MessageConsumer, NotificationConsumer
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from ws.publisher import publish
+
+from .timeline import (
+    push_tweet,
+    TWEET,
+    REPLY as TIMELINE_REPLY,
+    RETWEET as TIMELINE_RETWEET,
+)
 
 
 FOLLOW = 0
@@ -82,6 +135,292 @@ TWEET_EVENT = [
 
 
 
+@receiver([post_save, post_delete], sender=mUser)
+def user_cache_receiver(sender, instance, **kwargs):
+    """
+    ユーザーが更新されたらユーザー関連のレスポンスキャッシュを無効化する。
+    """
+
+    invalidate_tags(USER, user_tag(instance.username))
+    invalidate_tweet_fragments(author_pks=[instance.pk])
+    invalidate_validators(PROFILE, instance.username)
+    invalidate_feeds(instance.username)
+
+    # いいね, リツイートしたツイートの一覧にもプロフィールが載る(liked, retweet_users)
+    if kwargs.get('signal') is not post_delete:
+        tweet_pks = list(Tweet.objects.filter(liked=instance).values_list('pk', flat=True))
+        tweet_pks += list(instance.retweet_user.values_list('target_tweet', flat=True))
+        invalidate_tweet_validators(tweet_pks)
+
+
+@receiver([post_save, post_delete], sender=Tweet)
+def tweet_cache_receiver(sender, instance, **kwargs):
+    """
+    ツイートが更新されたらツイート一覧と作成者のプロフィールのキャッシュを無効化する。
+        リツイートはリツイートしたユーザーのプロフィールにも載る。
+    """
+
+    tags = [TWEET, user_tag(instance.author.username)]
+    if instance.retweet_username:
+        tags.append(user_tag(instance.retweet_username))
+    invalidate_tags(*tags)
+
+    usernames = [instance.author.username, instance.retweet_username]
+    invalidate_validators(PROFILE, *usernames)
+    invalidate_feeds(*usernames)
+
+
+@receiver([post_save, post_delete], sender=RetweetRelationShip)
+@receiver([post_save, post_delete], sender=ReplyRelationShip)
+def tweet_relation_cache_receiver(sender, instance, **kwargs):
+    """
+    リツイート, リプライの関連が更新されたら件数が変わるため無効化する。
+    """
+
+    if sender is RetweetRelationShip:
+        invalidate_tweet_fragments(tweet_pks=[instance.target_tweet_id, instance.retweet_id])
+        usernames = invalidate_tweet_validators([instance.target_tweet_id])
+        invalidate_validators(VIEWER, instance.retweet_user.username)
+    else:
+        invalidate_tweet_fragments(tweet_pks=[instance.reply_target_tweet_id, instance.reply_target_base_id])
+        usernames = invalidate_tweet_validators([instance.reply_target_tweet_id, instance.reply_target_base_id])
+    # ツイートが載るユーザーのプロフィール詳細(件数)も変わる
+    invalidate_tags(TWEET, *[user_tag(username) for username in usernames])
+
+
+@receiver(m2m_changed, sender=Tweet.liked.through)
+@receiver(m2m_changed, sender=Tweet.hashTag.through)
+def tweet_m2m_cache_receiver(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    いいね, ハッシュタグが変わったらツイート関連のキャッシュを無効化する。
+    """
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    tags = [TWEET]
+    if not reverse:
+        tags.append(user_tag(instance.author.username))
+        invalidate_tweet_fragments(tweet_pks=[instance.pk])
+    else:
+        invalidate_tweet_fragments(tweet_pks=pk_set or [])
+
+    if sender is Tweet.liked.through:
+        # いいねした側はいいね一覧(プロフィール)とisLikedが変わる
+        if not reverse:
+            tweet_usernames = invalidate_tweet_validators([instance.pk])
+            usernames = list(mUser.objects.filter(pk__in=pk_set or []).values_list('username', flat=True))
+        else:
+            tweet_usernames = invalidate_tweet_validators(pk_set or [])
+            usernames = [instance.username]
+        tags += [user_tag(username) for username in tweet_usernames]
+        invalidate_validators(PROFILE, *usernames)
+        invalidate_validators(VIEWER, *usernames)
+    invalidate_tags(*tags)
+
+
+@receiver([post_save, post_delete], sender=Entry)
+def entry_cache_receiver(sender, instance, **kwargs):
+    """
+    記事が更新されたら記事一覧と作成者のプロフィールのキャッシュを無効化する。
+    """
+
+    invalidate_tags(ENTRY, user_tag(instance.author.username))
+    invalidate_validators(PROFILE, instance.author.username)
+
+
+@receiver([post_save, post_delete], sender=ReadManagement)
+def entry_read_cache_receiver(sender, instance, **kwargs):
+    """
+    記事を既読にしたら、そのユーザーの記事一覧(is_read)のキャッシュを無効化する。
+    """
+
+    invalidate_tags(entry_read_tag(instance.target.username))
+
+
+@receiver(post_save, sender=mSetting)
+def setting_cache_receiver(sender, instance, **kwargs):
+    """
+    設定(非公開など)が更新されたらキャッシュを無効化する。
+    """
+
+    invalidate_tags(SETTING, user_tag(instance.target.username))
+    invalidate_validators(PROFILE, instance.target.username)
+
+
+@receiver(m2m_changed, sender=mSetting.block_list.through)
+@receiver(m2m_changed, sender=mSetting.mute_list.through)
+def setting_m2m_cache_receiver(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    ミュート, ブロックが変わったら関係するユーザーのキャッシュを無効化する。
+        ホーム画面が変わるのは設定した側だけ。
+    """
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        owners = [instance.target.username]
+        targets = list(mUser.objects.filter(pk__in=pk_set or []).values_list('username', flat=True))
+    else:
+        owners = list(mUser.objects.filter(msetting__in=pk_set or []).values_list('username', flat=True))
+        targets = [instance.username]
+
+    # プロフィール詳細(isMute, isBlockなど)はユーザー個別のタグでキャッシュしている
+    invalidate_tags(SETTING, USER, *[user_tag(username) for username in owners + targets])
+    invalidate_validators(FEED, *owners)
+    invalidate_validators(PROFILE, *owners, *targets)
+    invalidate_validators(VIEWER, *owners, *targets)
+
+
+@receiver(m2m_changed, sender=mUser.followees.through)
+def follow_cache_receiver(sender, instance, action, pk_set, **kwargs):
+    """
+    フォローが変わったらフォローした側, された側のキャッシュを無効化する。
+    """
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    usernames = [instance.username]
+    if pk_set:
+        usernames += list(mUser.objects.filter(pk__in=pk_set).values_list('username', flat=True))
+    invalidate_tags(USER, *[user_tag(username) for username in usernames])
+    invalidate_validators(FEED, *usernames)
+    invalidate_validators(PROFILE, *usernames)
+    invalidate_validators(VIEWER, *usernames)
+
+
+@receiver([post_save, post_delete], sender=FollowRequest)
+def follow_request_cache_receiver(sender, instance, **kwargs):
+    """
+    フォロー申請の状態が変わったらキャッシュを無効化する。
+    """
+
+    invalidate_tags(
+        USER,
+        TWEET,
+        user_tag(instance.follow_request_user.username),
+        user_tag(instance.follow_response_user.username),
+    )
+
+    usernames = [instance.follow_request_user.username, instance.follow_response_user.username]
+    invalidate_validators(PROFILE, *usernames)
+    invalidate_validators(VIEWER, *usernames)
+    invalidate_validators(INFO, *usernames)
+
+
+@receiver([post_save, post_delete], sender=Notification)
+def notification_cache_receiver(sender, instance, **kwargs):
+    """
+    通知が追加, 削除されたら通知一覧のバリデーターを無効化する。
+    """
+
+    invalidate_validators(INFO, instance.receive_user.username)
+
+
+@receiver(post_save, sender=mUser)
+@receiver(post_save, sender=Tweet)
+@receiver(post_save, sender=Message)
+def media_variants_receiver(sender, instance, raw=False, **kwargs):
+    """
+    画像が保存されたらサイズ違いの画像を作る。
+        生成後はURLが変わるため、保存時と同じキャッシュの無効化を行う。
+    """
+
+    if raw:
+        return
+
+    callback = None
+    if sender is mUser:
+        callback = lambda: user_cache_receiver(sender, instance)
+    elif sender is Tweet:
+        def callback():
+            tweet_cache_receiver(sender, instance)
+            invalidate_tweet_fragments(tweet_pks=[instance.pk])
+
+    transaction.on_commit(lambda: schedule_for_instance(instance, callback))
+
+
+def get_blob_names(instance, field_names=None):
+    names = []
+    for field_name in field_names or BLOB_FIELDS[type(instance)]:
+        value = instance.__dict__.get(field_name)
+        name = getattr(value, 'name', value)
+        if name:
+            names.append(name)
+    return names
+
+
+def _blob_fields_to_save(sender, update_fields):
+    field_names = BLOB_FIELDS[sender]
+    if update_fields is None:
+        return field_names
+    return [field_name for field_name in field_names if field_name in update_fields]
+
+
+@receiver(pre_save, sender=mUser)
+@receiver(pre_save, sender=Tweet)
+@receiver(pre_save, sender=Message)
+@receiver(pre_save, sender=hTweetUpd)
+def blob_pre_save_receiver(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    保存前の画像の名前をDBから読んでおく。
+        読み込みの度(post_init)ではなく、画像フィールドを保存する時だけ読む。
+    """
+
+    field_names = _blob_fields_to_save(sender, update_fields)
+    old = None
+    if field_names and not instance._state.adding and instance.pk is not None:
+        old = sender.objects.filter(pk=instance.pk).values_list(*field_names).first()
+    instance._blob_names = [name for name in old or () if name]
+
+
+@receiver(post_save, sender=mUser)
+@receiver(post_save, sender=Tweet)
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=hTweetUpd)
+def blob_save_receiver(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    画像が変わったら参照数を更新する。(参照されなくなったファイルはapi.storage.purge_blobsが消す)
+    """
+
+    field_names = _blob_fields_to_save(sender, update_fields)
+    if not field_names:
+        return
+
+    old = getattr(instance, '_blob_names', [])
+    new = get_blob_names(instance, field_names)
+    if old == new:
+        return
+
+    added = [name for name in new if name not in old]
+    removed = [name for name in old if name not in new]
+    retain_blobs(added)
+    release_blobs(removed)
+
+
+@receiver(post_delete, sender=mUser)
+@receiver(post_delete, sender=Tweet)
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=hTweetUpd)
+def blob_delete_receiver(sender, instance, **kwargs):
+    """
+    削除されたら参照数を減らす。
+    """
+
+    release_blobs(get_blob_names(instance))
+
+
+@receiver(post_delete, sender=ArchiveBucket)
+def archive_delete_receiver(sender, instance, **kwargs):
+    """
+    アーカイブを削除したら、アーカイブした行が参照していた画像の参照数を減らす。
+    """
+
+    release_blobs(json.loads(instance.blobs) if instance.blobs else [])
+
+
 @receiver(m2m_changed, sender=mUser.followees.through)
 def follow_receiver(sender, instance, action, pk_set, **kwargs):
     """
@@ -132,6 +471,50 @@ def retweet_receiver(sender, instance, created, **kwargs):
             logger.error('mUserが存在しません。')
 
 
+@receiver(post_save, sender=Tweet)
+def timeline_tweet_receiver(sender, instance, created, raw=False, **kwargs):
+    """
+    ツイートが作成されたらフォロワーのタイムラインに新着を送る。
+    リツイートはRetweetRelationShipの作成時に送る。
+    """
+
+    if created and not raw and not instance.isRetweet:
+        push_tweet(instance, TIMELINE_REPLY if instance.isReply else TWEET, instance.author)
+
+
+@receiver(post_save, sender=RetweetRelationShip)
+def timeline_retweet_receiver(sender, instance, created, raw=False, **kwargs):
+    """
+    リツイートしたユーザーのフォロワーのタイムラインに新着を送る。
+    リプライのリツイートはホームに出さないため送らない。
+    """
+
+    if created and not raw and not instance.retweet.isReply:
+        push_tweet(instance.retweet, TIMELINE_RETWEET, instance.retweet_user)
+
+
+@receiver(post_save, sender=Tweet)
+def hashtag_receiver(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """
+    本文のハッシュタグ, メンションをインデックスに反映する。
+    """
+
+    if raw:
+        return
+    if update_fields is not None and not {'content', 'deleted'} & set(update_fields):
+        return
+    index_tweet(instance, created=created)
+
+
+@receiver(post_delete, sender=HashTagIndex)
+def hashtag_index_delete_receiver(sender, instance, **kwargs):
+    """
+    インデックスから外れたらタグのツイート件数を減らす。(ツイートの削除によるカスケードも含む)
+    """
+
+    HashTag.objects.filter(pk=instance.tag_id, tweet_count__gt=0).update(tweet_count=F('tweet_count') - 1)
+
+
 @receiver(post_save, sender=ReplyRelationShip)
 def reply_receiver(sender, instance, created, **kwargs):
     """
@@ -232,13 +615,14 @@ def check_exists(event, receive_user, send_user, *args):
         True: 存在する。
         False: 存在しない。
     """
+    unread = unread_q(get_watermark(receive_user))
     if event in TWEET_EVENT:
         return Notification.objects.filter(
+            unread,
             event=event,
             receive_user=receive_user,
             send_user=send_user,
             target_tweet_info=args[0],
-            readed=False,
         ).exists()
     else:
         # フォローは過去にフォローして事あったら通知送らない
@@ -250,10 +634,10 @@ def check_exists(event, receive_user, send_user, *args):
             ).exists()
         else:
             return Notification.objects.filter(
+                unread,
                 event=event,
                 receive_user=receive_user,
                 send_user=send_user,
-                readed=False,
             ).exists()
 
 
@@ -295,8 +679,7 @@ def send_response(event, receive_user, send_user, *args):
             infomation=send_user.username + NOTIFICATION_WORD[event]
         )
 
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
+    publish(
         receive_user.username,
         {'type': 'notification',  'content': NotificationSerializer(res).data}
     )
@@ -307,10 +690,10 @@ def send_read_message(sender, **kwargs):
     対象ルームに対して、既読通知を送るメソッド
     """
 
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        str(kwargs['queryset'][0].room.id),
-        {'type': 'read_message',  'data': MessageSubSerializer(kwargs['queryset'], many=True).data}
+    group = str(kwargs['queryset'][0].room.id)
+    publish(
+        group,
+        {'type': 'read_message', 'group': group, 'data': MessageSubSerializer(kwargs['queryset'], many=True).data}
     )
 
 
@@ -318,6 +701,10 @@ def send_read_message(sender, **kwargs):
 def recevie_message(sender, instance, created, raw, using, update_fields, **kwargs):
     logger.info('メッセージが来た')
 
+    # アップロードした画像を後からセットした時は通知しない
+    if update_fields is not None and set(update_fields) == {'image'}:
+        return
+
     try:
         target_room = instance.room
         sender = instance.sender
@@ -340,8 +727,7 @@ def send_message_notice(receiver, sender, room, message):
         room=room,
         message=message,
     )
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
+    publish(
         receiver.username,
         {'type': 'message_notification',  'content': MessageNotificationSerializer(res).data}
     )
@@ -0,0 +1,156 @@
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+遅いSQLの記録
+
+    SLOW_QUERY_CAPTUREが有効な時だけSlowQueryMiddlewareが記録する。
+    SLOW_QUERY_THRESHOLD_MSより遅いSQLを、発生元のView, actionと一緒に
+    SLOW_QUERY_LOGへNDJSONで追記する。
+    パラメーターも記録するため、本番で使う時は記録先の扱いに注意する。
+"""
+
+SLOW_QUERY_CAPTURE = getattr(settings, 'SLOW_QUERY_CAPTURE', False)
+SLOW_QUERY_THRESHOLD_MS = getattr(settings, 'SLOW_QUERY_THRESHOLD_MS', 100)
+SLOW_QUERY_LOG = getattr(settings, 'SLOW_QUERY_LOG', 'slow_queries.ndjson')
+
+_write_lock = threading.Lock()
+
+
+def record_slow_query(entry, path=SLOW_QUERY_LOG):
+    line = json.dumps(entry, ensure_ascii=False, default=str)
+    with _write_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    logger.warning('遅いSQL %.1fms %s %s', entry['duration_ms'], entry['view'], entry['sql'][:200])
+
+
+def read_slow_queries(path=SLOW_QUERY_LOG):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class SlowQueryRecorder:
+    """
+    connection.execute_wrapperに渡すラッパー
+        viewはprocess_viewでセットされる。
+    """
+
+    def __init__(self, request, alias, threshold_ms=SLOW_QUERY_THRESHOLD_MS):
+        self.request = request
+        self.alias = alias
+        self.threshold_ms = threshold_ms
+        self.view = None
+        self.action = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration_ms = (time.monotonic() - start) * 1000
+            if duration_ms >= self.threshold_ms:
+                record_slow_query({
+                    'time': datetime.now(timezone.utc).isoformat(),
+                    'duration_ms': round(duration_ms, 3),
+                    'alias': self.alias,
+                    'sql': sql,
+                    'params': None if many else params,
+                    'method': self.request.method,
+                    'path': self.request.path,
+                    'view': self.view,
+                    'action': self.action,
+                })
+
+
+"""
+インデックスの提案
+"""
+
+# 全件走査を示すEXPLAINの出力(SQLite, PostgreSQL)
+FULL_SCAN_PATTERNS = [
+    re.compile(r'\bSCAN (?:TABLE )?"?(\w+)"?(?! USING (?:COVERING )?INDEX)'),
+    re.compile(r'Seq Scan on "?(\w+)"?'),
+]
+
+# WHERE, JOIN, ORDER BYに出てくる "table"."column"
+COLUMN_PATTERN = re.compile(r'"(\w+)"\."(\w+)"\s*(?:=|IN\b|<|>|IS\b|LIKE\b)')
+ORDER_PATTERN = re.compile(r'ORDER BY\s+"(\w+)"\."(\w+)"')
+
+
+def explain(sql, params, alias='default'):
+    """
+    EXPLAINの結果を行のリストで返す。
+    """
+
+    connection = connections[alias]
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params or ())
+        return [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+
+
+def full_scan_tables(plan):
+    tables = []
+    for line in plan:
+        for pattern in FULL_SCAN_PATTERNS:
+            for table in pattern.findall(line):
+                if table not in tables:
+                    tables.append(table)
+    return tables
+
+
+def _model_fields(table):
+    for model in apps.get_models():
+        if model._meta.db_table == table:
+            return model, {field.column: field.name for field in model._meta.concrete_fields}
+    return None, {}
+
+
+def _has_index(model, fields):
+    """
+    fieldsを先頭に持つインデックス(FK, 単一カラムのdb_indexを含む)があるか
+    """
+
+    indexed = [list(index.fields) for index in model._meta.indexes]
+    indexed += [[field.name] for field in model._meta.concrete_fields if field.db_index or field.unique]
+    return any(index[:len(fields)] == fields for index in indexed)
+
+
+def suggest_indexes(sql, plan):
+    """
+    全件走査になっているテーブルについて、絞り込み・並び替えに使っているカラムから
+    models.Indexの候補を返す。
+        [(モデル名, [フィールド名, ...]), ...]
+    """
+
+    suggestions = []
+    for table in full_scan_tables(plan):
+        model, columns = _model_fields(table)
+        if model is None:
+            continue
+
+        fields = []
+        for pattern in (COLUMN_PATTERN, ORDER_PATTERN):
+            for found_table, column in pattern.findall(sql):
+                name = columns.get(column)
+                if found_table == table and name and name not in fields:
+                    fields.append(name)
+
+        if fields and not _has_index(model, fields):
+            suggestions.append((model.__name__, fields))
+    return suggestions
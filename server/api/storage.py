@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import (
+    mUser,
+    ArchiveBucket,
+    MediaBlob,
+    Message,
+    Tweet,
+    UploadSession,
+    hTweetUpd,
+)
+
+try:
+    import cloudinary.uploader
+    from cloudinary_storage.storage import MediaCloudinaryStorage
+except ImportError:
+    MediaCloudinaryStorage = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+コンテンツアドレスのストレージ
+
+    アップロードされたファイルを内容のハッシュで cas/ab/cd/<sha256><拡張子> に保存する。
+    同じ内容のファイルは1つだけ保存され、名前が変わらないため永続的にキャッシュできる。
+    cas/ 以下の名前で保存しようとした場合(サイズ違いの画像など)はその名前のまま保存する。
+
+    複数のレコードから参照されるため、削除はMediaBlobの参照数で管理する。
+        - 保存(または保存済みのファイルの再利用)の前にreserve_blobで参照数0の行を作り、released_atを更新する。
+          バリアントは元画像の行で管理する。
+        - レコードの保存, 削除(signals)でretain_blobs, release_blobsが参照数を増減する。
+        - purge_blobs(python manage.py purge_blobs)が、参照数0のままBLOB_PURGE_GRACE秒経った
+          ファイルを行をロックしたまま削除する。モデルの保存に失敗して参照されなかったファイルもここで消える。
+        - 行の無いファイル(この仕組みより前のファイル)はsweep_orphan_filesが参照数を数えて行を作る。
+"""
+
+CAS_PREFIX = 'cas'
+
+BLOB_PURGE_GRACE = getattr(settings, 'BLOB_PURGE_GRACE', 60 * 60)
+
+# 参照数を管理する画像フィールド
+BLOB_FIELDS = {
+    mUser: ('icon', 'header'),
+    Tweet: ('images',),
+    Message: ('image',),
+    hTweetUpd: ('images',),
+}
+
+
+def is_content_addressed(name):
+    return bool(name) and '/{0}/'.format(CAS_PREFIX) in '/' + name
+
+
+def content_name(digest, ext):
+    return '{0}/{1}/{2}/{3}{4}'.format(CAS_PREFIX, digest[:2], digest[2:4], digest, ext.lower())
+
+
+def hash_content(content):
+    sha = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        sha.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return sha.hexdigest()
+
+
+class ContentAddressedMixin:
+    """
+    Storageに混ぜて使うMixin
+    """
+
+    def save(self, name, content, max_length=None):
+        from .media import source_name
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        if not is_content_addressed(name):
+            name = content_name(hash_content(content), os.path.splitext(name)[1])
+
+        # 確認してから参照されるまでの間にpurge_blobsで消されないよう、先に予約する
+        #   バリアントは元画像と一緒に削除されるため、元画像の行を予約する(バリアントの行は作らない)
+        reserve_blob(self.stored_name(source_name(name)))
+        if self.exists(name):
+            return self.stored_name(name)
+        return super().save(name, content, max_length=max_length)
+
+    def stored_name(self, name):
+        """
+        保存済みのファイルの名前(_saveが返す名前と同じ形式)
+        """
+        return name
+
+
+class CASFileSystemStorage(ContentAddressedMixin, FileSystemStorage):
+    pass
+
+
+if MediaCloudinaryStorage is not None:
+
+    class CASCloudinaryStorage(ContentAddressedMixin, MediaCloudinaryStorage):
+        """
+        Cloudinary版
+            Cloudinaryはファイル名にランダムな文字列を付けるため、public_idを指定して上書きしない。
+        """
+
+        def _upload(self, name, content):
+            folder, filename = os.path.split(name)
+            options = {
+                'public_id': os.path.splitext(filename)[0],
+                'unique_filename': False,
+                'overwrite': False,
+                'resource_type': self._get_resource_type(name),
+                'tags': self.TAG,
+            }
+            if folder:
+                options['folder'] = folder
+            return cloudinary.uploader.upload(content, **options)
+
+        def stored_name(self, name):
+            return self._prepend_prefix(os.path.splitext(name)[0])
+
+
+def reserve_blob(name):
+    """
+    保存するファイルの行を参照数0で作る(既にあればreleased_atを更新する)。
+        purge_blobsが同じ行をロックしている間はここで待ち、削除が終わった後に作り直す。
+    """
+
+    now = timezone.now()
+    if MediaBlob.objects.filter(name=name).update(released_at=now):
+        return
+    try:
+        with transaction.atomic():
+            MediaBlob.objects.create(name=name, refcount=0, released_at=now)
+    except IntegrityError:
+        MediaBlob.objects.filter(name=name).update(released_at=now)
+
+
+def retain_blobs(names):
+    """
+    ファイルの参照数を増やす。
+    """
+
+    for name in names:
+        if not is_content_addressed(name):
+            continue
+        updated = MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    MediaBlob.objects.create(name=name, refcount=1)
+            except IntegrityError:
+                # 同時に作られた
+                MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+
+
+def release_blobs(names):
+    """
+    ファイルの参照数を減らす。
+        参照されなくなったファイルはすぐには消さず、purge_blobsに任せる。
+    """
+
+    counts = Counter(name for name in names if is_content_addressed(name))
+    for name, count in counts.items():
+        MediaBlob.objects.filter(name=name, refcount__gte=count).update(refcount=F('refcount') - count)
+    if counts:
+        MediaBlob.objects.filter(name__in=list(counts), refcount=0).update(released_at=timezone.now())
+
+
+def purge_blobs(grace=BLOB_PURGE_GRACE, batch_size=100):
+    """
+    参照数0のままgrace秒経ったファイル(とそのバリアント)を削除し、件数を返す。
+        1件ずつ行をselect_for_updateでロックして条件を確認し直してから削除するため、
+        同時に参照(reserve_blob, retain_blobs)されたファイルは消さない。
+        紐付け前のアップロード(UploadSession)のファイルはセッションが消えるまで残す。
+    """
+
+    from .media import delete_media
+
+    threshold = timezone.now() - timedelta(seconds=grace)
+    candidates = MediaBlob.objects.filter(refcount=0, released_at__lt=threshold) \
+        .exclude(name__in=UploadSession.objects.exclude(stored_name='').values('stored_name'))
+    count = 0
+    last_pk = 0
+    while True:
+        pks = list(candidates.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        for pk in pks:
+            with transaction.atomic():
+                blob = candidates.select_for_update().filter(pk=pk).first()
+                if blob is None:
+                    continue
+                delete_media(blob.name)
+                blob.delete()
+            count += 1
+    return count
+
+
+def count_references(name):
+    """
+    ファイルを参照しているレコード, アーカイブの数
+    """
+
+    count = sum(
+        model.objects.filter(**{field_name: name}).count()
+        for model, field_names in BLOB_FIELDS.items()
+        for field_name in field_names
+    )
+    # アーカイブの参照はJSONの文字列で持っているため、候補を絞ってから数える
+    for blobs in ArchiveBucket.objects.filter(blobs__contains=name).values_list('blobs', flat=True):
+        count += json.loads(blobs).count(name)
+    return count
+
+
+def _walk(storage, path):
+    dirs, files = storage.listdir(path)
+    for filename in files:
+        yield '{0}/{1}'.format(path, filename)
+    for dirname in dirs:
+        yield from _walk(storage, '{0}/{1}'.format(path, dirname))
+
+
+def sweep_orphan_files(storage=default_storage):
+    """
+    MediaBlobの行が無いコンテンツアドレスのファイルについて、参照数を数えて行を作る。
+        参照されていなければ参照数0の行になり、purge_blobsで削除される。
+        作った行の数を返す。(listdirに対応していないストレージでは何もしない)
+    """
+
+    from .media import source_name
+
+    try:
+        names = {source_name(name) for name in _walk(storage, CAS_PREFIX)}
+    except (NotImplementedError, FileNotFoundError):
+        logger.warning('ストレージのファイルを一覧できないため、孤立したファイルを確認できません。')
+        return 0
+
+    names = [storage.stored_name(name) if hasattr(storage, 'stored_name') else name for name in names]
+    known = set()
+    for i in range(0, len(names), 500):
+        known.update(MediaBlob.objects.filter(name__in=names[i:i + 500]).values_list('name', flat=True))
+
+    created = 0
+    now = timezone.now()
+    for name in names:
+        if name in known:
+            continue
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(name=name, refcount=count_references(name), released_at=now)
+            created += 1
+        except IntegrityError:
+            # 同時に保存(reserve_blob)された
+            pass
+    return created
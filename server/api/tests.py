@@ -1,3 +1,1572 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import logging
+import logging.config
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import post_init
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings as jwt_settings
+
+from .access_logs import (
+    AccessLogBuffer,
+    buffer as access_log_buffer,
+    parse_language,
+    parse_user_agent,
+)
+from .archive import (
+    decode_rows,
+    fetch_archived_page,
+    run_retention,
+)
+from .db_routers import (
+    ReplicaRouter,
+    clear_state,
+    has_written,
+    set_read_replica,
+    use_primary,
+)
+from .hashtags import (
+    TAG_MAX_LENGTH,
+    extract_hashtags,
+)
+from .exports import (
+    gzip_stream,
+    iter_user_export,
+)
+from .media import (
+    generate_variants,
+    save_variant_names,
+    schedule_for_instance,
+    variant_urls,
+)
+from .middleware import (
+    REPLICA_PIN_COOKIE,
+    VISITOR_COOKIE,
+    ReplicaRoutingMiddleware,
+)
+from .inbox import (
+    get_watermark,
+    mark_all_read,
+    unread_notifications,
+)
+from .logs import (
+    AsyncQueueHandler,
+    lazy_qs,
+)
+from .models import (
+    mUser,
+    mSetting,
+    mAccessLog,
+    ArchiveBucket,
+    Entry,
+    FollowRequest,
+    HashTag,
+    HashTagIndex,
+    MediaBlob,
+    Message,
+    MessageNotification,
+    Notification,
+    ReadManagement,
+    ReplyRelationShip,
+    RetweetRelationShip,
+    Room,
+    RollupState,
+    TrafficRollup,
+    Tweet,
+    UploadSession,
+)
+from .storage import (
+    purge_blobs,
+    sweep_orphan_files,
+)
+from .uploads import (
+    UploadError,
+    attach_upload,
+    store_upload,
+)
+from .media_tokens import (
+    check_media_token,
+    media_token,
+)
+from .pool import (
+    ConnectionPool,
+    PoolTimeout,
+)
+from .planner import (
+    plan_queryset,
+    requirements,
+)
+from .renderers import (
+    FastJSONRenderer,
+    stream_json_list,
+)
+from .serializers import (
+    MessageSerializer,
+    NotificationSerializer,
+    TweetSerializer,
+)
+from .slow_queries import (
+    SlowQueryRecorder,
+    explain,
+    read_slow_queries,
+    suggest_indexes,
+)
+from .timeline import (
+    REPLY,
+    RETWEET,
+    fanout,
+    recipients,
+)
+from .traffic import (
+    TRAFFIC_ROLLUP_LAG,
+    rollup_batch,
+)
+from .utils import (
+    chunked,
+)
+
+
+def make_user(username):
+    return mUser.objects.create_user(username, username + '@example.com', 'password')
+
+
+class AsyncQueueHandlerTests(SimpleTestCase):
+    """
+    api.logs (user-026)
+    """
+
+    def configure(self, stream, handler_name='a_queue'):
+        # dictConfigは既存のハンドラーを閉じるため、終わったら設定し直す
+        self.addCleanup(logging.config.dictConfig, settings.LOGGING)
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {'json': {'()': 'api.logs.JsonFormatter'}},
+            'handlers': {
+                # 名前順では書き出し先より前になる
+                handler_name: {'()': 'api.logs.AsyncQueueHandler', 'handlers': ['cfg://handlers.z_out']},
+                'z_out': {'class': 'logging.StreamHandler', 'stream': stream, 'formatter': 'json'},
+            },
+            'loggers': {'tests.logs': {'level': 'INFO', 'handlers': [handler_name], 'propagate': False}},
+        })
+        handler = logging.getLogger('tests.logs').handlers[0]
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_resolves_targets_regardless_of_name_order(self):
+        stream = io.StringIO()
+        handler = self.configure(stream)
+        logging.getLogger('tests.logs').info('hello %s', 'world')
+        handler.close()
+
+        self.assertEqual(json.loads(stream.getvalue())['message'], 'hello world')
+
+    def test_traceback_is_kept_out_of_message(self):
+        stream = io.StringIO()
+        handler = self.configure(stream)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logging.getLogger('tests.logs').exception('failed')
+        handler.close()
+
+        payload = json.loads(stream.getvalue())
+        self.assertEqual(payload['message'], 'failed')
+        self.assertIn('ZeroDivisionError', payload['exc_info'])
+
+    def test_drops_when_queue_is_full(self):
+        handler = AsyncQueueHandler(maxsize=1)
+        record = logging.LogRecord('x', logging.INFO, __file__, 1, 'message', None, None)
+        handler.enqueue(record)
+        handler.enqueue(record)
+
+        self.assertEqual(handler.dropped, 1)
+
+    def test_unresolved_target_is_rejected(self):
+        handler = AsyncQueueHandler(handlers=['console'])
+        with self.assertRaises(ValueError):
+            handler._start_listener()
+
+
+class LazyQuerySetTests(TestCase):
+
+    def test_does_not_evaluate_queryset(self):
+        queryset = mUser.objects.all()
+        with self.assertNumQueries(0):
+            text = str(lazy_qs(queryset))
+
+        self.assertIn('mUser', text)
+        self.assertIsNone(queryset._result_cache)
+
+
+class ChunkedTests(TestCase):
+    """
+    api.utils.chunked, api.exports (user-027)
+    """
+
+    def setUp(self):
+        self.user = make_user('alice')
+        for i in range(5):
+            Tweet.objects.create(author=self.user, content='tweet %d' % i)
+
+    def test_iterates_every_row_in_key_order(self):
+        with self.assertNumQueries(3):
+            pks = [tweet.pk for tweet in chunked(Tweet.objects.all(), chunk_size=2)]
+
+        self.assertEqual(pks, sorted(Tweet.objects.values_list('pk', flat=True)))
+
+    def test_values_queryset(self):
+        rows = list(chunked(Tweet.objects.values('pk', 'content'), chunk_size=3))
+        self.assertEqual(len(rows), 5)
+
+    def test_rejects_other_ordering(self):
+        with self.assertRaises(ValueError):
+            list(chunked(Tweet.objects.order_by('-created_at')))
+
+    def test_export_lines(self):
+        lines = [json.loads(line) for line in iter_user_export(self.user, sections=['tweet'], chunk_size=2)]
+
+        self.assertEqual([line['type'] for line in lines], ['tweet'] * 5)
+        self.assertEqual(lines[0]['data']['content'], 'tweet 0')
+
+    def test_export_includes_archived_rows(self):
+        sender = make_user('bob')
+        Notification.objects.create(event=0, receive_user=self.user, send_user=sender, infomation='old')
+        Notification.objects.create(event=0, receive_user=self.user, send_user=sender, infomation='new')
+        Notification.objects.filter(infomation='old').update(created_at=timezone.now() - timedelta(days=400))
+        run_retention(names=['notification'])
+
+        lines = [json.loads(line) for line in iter_user_export(self.user, sections=['notification'])]
+
+        self.assertEqual([(line['data']['infomation'], line.get('archived', False)) for line in lines],
+                         [('old', True), ('new', False)])
+        self.assertEqual(lines[0]['data']['send_user__username'], 'bob')
+
+    def test_gzip_stream(self):
+        chunks = [b'a' * 100, b'b' * 100]
+        self.assertEqual(gzip.decompress(b''.join(gzip_stream(iter(chunks), flush_size=10))), b''.join(chunks))
+
+
+class CacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client = APIClient()
+
+    def get(self, url, **params):
+        response = self.client.get(url, params, HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+
+class ResponseCacheTests(CacheTestCase):
+    """
+    api.caches, signalsの無効化 (user-028)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+
+    def test_profile_reflects_mute_and_block(self):
+        url = '/api/profile/bob/'
+        self.assertFalse(self.get(url, loginUser='alice').data['isMute'])
+
+        self.alice.msetting.mute_list.add(self.bob)
+        self.assertTrue(self.get(url, loginUser='alice').data['isMute'])
+
+        self.alice.msetting.block_list.add(self.bob)
+        self.assertTrue(self.get(url, loginUser='alice').data['isBlock'])
+        # ブロックされた側から見たプロフィール
+        self.assertTrue(self.get('/api/profile/alice/', loginUser='bob').data['isBlocked'])
+
+    def test_profile_counts_reflect_replies_and_retweets(self):
+        tweet = Tweet.objects.create(author=self.alice, content='hello')
+
+        def counts():
+            data = self.get('/api/profile/alice/', loginUser='bob').data
+            row = next(row for row in data['tweet'] if row['pk'] == tweet.pk)
+            return row['reply_count'], row['retweet_count']
+
+        self.assertEqual(counts(), (0, 0))
+
+        reply = Tweet.objects.create(author=self.bob, content='reply', isReply=True)
+        ReplyRelationShip.objects.create(reply_target_tweet=tweet, reply=reply, reply_target_base=tweet)
+        self.assertEqual(counts(), (1, 0))
+
+        retweet = Tweet.objects.create(author=self.alice, content='hello', isRetweet=True, retweet_username='bob')
+        RetweetRelationShip.objects.create(target_tweet=tweet, retweet=retweet, retweet_user=self.bob)
+        self.assertEqual(counts(), (1, 1))
+
+    def test_entry_list_reflects_reads(self):
+        entry = Entry.objects.create(title='title', content='content', author=self.alice, type='0')
+        params = {'entryListFlg': 1, 'loginUser': 'bob'}
+        self.assertFalse(self.get('/api/entry/', **params).data['results'][0]['is_read'])
+
+        ReadManagement.objects.create(target=self.bob, entry=entry)
+        self.assertTrue(self.get('/api/entry/', **params).data['results'][0]['is_read'])
+
+    def test_tweet_list_is_kept_across_unrelated_writes(self):
+        Tweet.objects.create(author=self.alice, content='first')
+        params = {'tweetListFlg': 0, 'targetUser': 'alice', 'loginUser': 'bob'}
+        self.get('/api/tweet/', **params)
+
+        # 関係の無いユーザーのツイートでは無効にならない
+        Tweet.objects.create(author=make_user('carol'), content='other')
+        with self.assertNumQueries(0):
+            self.get('/api/tweet/', **params)
+
+        Tweet.objects.create(author=self.alice, content='second')
+        contents = [tweet['content'] for tweet in self.get('/api/tweet/', **params).data['results']]
+        self.assertEqual(contents, ['second', 'first'])
+
+
+class TweetFragmentTests(CacheTestCase):
+    """
+    api.fragments, TweetSerializerの共通部分 (user-029)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.tweet = Tweet.objects.create(author=self.alice, content='hello')
+
+    def test_shared_part_is_cached(self):
+        fields = ['pk', 'content', 'author']
+        TweetSerializer(self.tweet, fields=fields).data
+        tweet = Tweet.objects.get(pk=self.tweet.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(TweetSerializer(tweet, fields=fields).data['author'], 'alice')
+
+    def test_author_change_invalidates_fragment(self):
+        fields = ['pk', 'author']
+        TweetSerializer(self.tweet, fields=fields).data
+        mUser.objects.filter(pk=self.alice.pk).update(username='alice2')
+        self.alice.refresh_from_db()
+        self.alice.save()
+        tweet = Tweet.objects.get(pk=self.tweet.pk)
+        self.assertEqual(TweetSerializer(tweet, fields=fields).data['author'], 'alice2')
+
+    def test_likers_profile_is_not_cached(self):
+        self.tweet.liked.add(self.bob)
+        self.assertEqual(TweetSerializer(self.tweet).data['liked'][0]['introduction'], None)
+
+        self.bob.introduction = 'updated'
+        self.bob.save()
+        data = TweetSerializer(Tweet.objects.get(pk=self.tweet.pk)).data
+        self.assertEqual(data['liked'][0]['introduction'], 'updated')
+
+    def test_like_changes_count(self):
+        self.assertEqual(TweetSerializer(self.tweet).data['liked_count'], 0)
+        self.tweet.liked.add(self.bob)
+        self.assertEqual(TweetSerializer(Tweet.objects.get(pk=self.tweet.pk)).data['liked_count'], 1)
+
+    def test_liker_update_invalidates_author_lists(self):
+        self.tweet.liked.add(self.bob)
+        params = {'tweetListFlg': 0, 'targetUser': 'alice'}
+        self.get('/api/tweet/', **params)
+
+        self.bob.introduction = 'updated'
+        self.bob.save()
+        data = self.get('/api/tweet/', **params).data['results']
+        self.assertEqual(data[0]['liked'][0]['introduction'], 'updated')
+
+
+class FastJSONRendererTests(SimpleTestCase):
+    """
+    api.renderers (user-030)
+    """
+
+    data = {
+        'content': 'line\u2028separator\u2029end',
+        'message': gettext_lazy('Not found.'),
+        'created_at': timezone.now(),
+        'nested': [{'pk': 1, 'value': None, 'flag': True, 'ratio': 0.5}],
+        'text': '日本語 "quoted" \\ </script>',
+    }
+
+    def test_matches_json_renderer(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_escapes_line_separators(self):
+        content = FastJSONRenderer().render({'content': '\u2028\u2029'})
+        self.assertEqual(content, b'{"content":"\\u2028\\u2029"}')
+        self.assertEqual(json.loads(content)['content'], '\u2028\u2029')
+
+    def test_stream_json_list(self):
+        rows = [{'pk': i, 'content': 'a\u2028b'} for i in range(5)]
+        content = b''.join(stream_json_list(rows, lambda objs: objs, chunk_size=2))
+        self.assertEqual(content, JSONRenderer().render(rows))
+        self.assertEqual(b''.join(stream_json_list([], lambda objs: objs)), b'[]')
+
+
+class ConditionalGetTests(CacheTestCase):
+    """
+    api.conditional (user-031)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+
+    def revalidate(self, url, etag, **params):
+        return self.client.get(url, params, HTTP_HOST='localhost', HTTP_IF_NONE_MATCH=etag)
+
+    def test_profile_not_modified(self):
+        url = '/api/profile/bob/'
+        etag = self.get(url, loginUser='alice')['ETag']
+
+        response = self.revalidate(url, etag, loginUser='alice')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('private', response['Cache-Control'])
+
+        # 閲覧者が変わればETagも変わる
+        self.assertEqual(self.revalidate(url, etag, loginUser='carol').status_code, 200)
+
+        self.bob.introduction = 'updated'
+        self.bob.save()
+        response = self.revalidate(url, etag, loginUser='alice')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_likes_tab_changes_with_other_likes(self):
+        tweet = Tweet.objects.create(author=self.alice, content='hello')
+        tweet.liked.add(self.bob)
+        params = {'tweetListFlg': 3, 'targetUser': 'bob'}
+        response = self.get('/api/tweet/', **params)
+        self.assertEqual(response.data['results'][0]['liked_count'], 1)
+        self.assertEqual(self.revalidate('/api/tweet/', response['ETag'], **params).status_code, 304)
+
+        # 他のユーザーのいいねでも件数が変わる
+        tweet.liked.add(make_user('carol'))
+        response = self.revalidate('/api/tweet/', response['ETag'], **params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['liked_count'], 2)
+
+    def test_feed_changes_with_followee_tweet(self):
+        self.alice.followees.add(self.bob)
+        params = {'tweetListFlg': 4, 'targetUser': 'alice'}
+        etag = self.get('/api/tweet/', **params)['ETag']
+        self.assertEqual(self.revalidate('/api/tweet/', etag, **params).status_code, 304)
+
+        Tweet.objects.create(author=self.bob, content='hello')
+        self.assertEqual(self.revalidate('/api/tweet/', etag, **params).status_code, 200)
+
+    def test_search_is_not_conditional(self):
+        response = self.get('/api/tweet/', tweetListFlg=0, targetUser='alice', searchText='x')
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_notification_list(self):
+        etag = self.get('/api/info/', loginUser='alice')['ETag']
+        self.assertEqual(self.revalidate('/api/info/', etag, loginUser='alice').status_code, 304)
+
+        Notification.objects.create(event=0, receive_user=self.alice, send_user=self.bob, infomation='hello')
+        self.assertEqual(self.revalidate('/api/info/', etag, loginUser='alice').status_code, 200)
+
+
+@mock.patch('api.db_routers.REPLICA_DATABASES', ['replica1'])
+class ReplicaRouterTests(SimpleTestCase):
+    """
+    api.db_routers (user-032)
+    """
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        set_read_replica(True)
+        self.addCleanup(clear_state)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.router.db_for_read(Tweet), 'replica1')
+        self.assertEqual(self.router.db_for_write(Tweet), 'default')
+
+    def test_write_pins_following_reads(self):
+        self.router.db_for_write(Tweet)
+        self.assertTrue(has_written())
+        self.assertEqual(self.router.db_for_read(Tweet), 'default')
+
+    def test_incidental_writes_do_not_pin(self):
+        for model in (Session, mAccessLog):
+            self.assertEqual(self.router.db_for_write(model), 'default')
+        self.assertFalse(has_written())
+        self.assertEqual(self.router.db_for_read(Tweet), 'replica1')
+
+    def test_use_primary(self):
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(Tweet), 'default')
+        self.assertEqual(self.router.db_for_read(Tweet), 'replica1')
+
+
+@mock.patch('api.middleware.REPLICA_DATABASES', ['replica1'])
+class ReplicaRoutingMiddlewareTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.factory = RequestFactory()
+
+    def handle(self, request, model=None):
+        routed = []
+
+        def get_response(request):
+            routed.append(ReplicaRouter().db_for_read(Tweet))
+            if model is not None:
+                ReplicaRouter().db_for_write(model)
+            return HttpResponse()
+
+        with mock.patch('api.db_routers.REPLICA_DATABASES', ['replica1']):
+            response = ReplicaRoutingMiddleware(get_response)(request)
+        return routed[0], response
+
+    def test_write_sets_pin_cookie(self):
+        db, response = self.handle(self.factory.get('/api/tweet/'), model=Tweet)
+        self.assertEqual(db, 'replica1')
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+
+        request = self.factory.get('/api/tweet/')
+        request.COOKIES[REPLICA_PIN_COOKIE] = '1'
+        self.assertEqual(self.handle(request)[0], 'default')
+
+    def test_incidental_write_does_not_pin(self):
+        db, response = self.handle(self.factory.get('/api/tweet/'), model=mAccessLog)
+        self.assertNotIn(REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_unsafe_method_reads_primary(self):
+        self.assertEqual(self.handle(self.factory.post('/api/tweet/'))[0], 'default')
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """
+    api.pool (user-033)
+    """
+
+    def make_pool(self, **kwargs):
+        kwargs.setdefault('timeout', 0.01)
+        return ConnectionPool(FakeConnection, **kwargs)
+
+    def test_reuses_released_connection(self):
+        pool = self.make_pool(maxsize=1)
+        conn = pool.acquire()
+        pool.release(conn)
+
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_times_out_at_maxsize(self):
+        pool = self.make_pool(maxsize=1)
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_unhealthy_connection_keeps_size(self):
+        pool = self.make_pool(maxsize=1, check=lambda conn: False, check_interval=0)
+        conn = pool.acquire()
+        pool.release(conn)
+
+        replaced = pool.acquire()
+        self.assertIsNot(replaced, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['size'], 1)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+
+    def test_discard_frees_slot(self):
+        pool = self.make_pool(maxsize=1)
+        conn = pool.acquire()
+        pool.release(conn, discard=True)
+
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_factory_error_frees_slot(self):
+        calls = []
+
+        def factory():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError
+            return FakeConnection()
+
+        pool = ConnectionPool(factory, maxsize=1, timeout=0.01)
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+        self.assertIsInstance(pool.acquire(), FakeConnection)
+
+
+class DatabaseStatsViewTests(CacheTestCase):
+
+    def test_admin_only(self):
+        response = self.client.get('/api/db-stats/', HTTP_HOST='localhost')
+        self.assertIn(response.status_code, (401, 403))
+
+        admin = make_user('admin')
+        admin.is_staff = True
+        admin.save()
+        self.client.force_authenticate(admin)
+        self.assertEqual(self.get('/api/db-stats/').data, {})
+
+
+class SlowQueryTests(TestCase):
+    """
+    api.slow_queries, advise_indexesコマンド (user-034)
+    """
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def capture(self, queryset):
+        request = RequestFactory().get('/api/tweet/')
+        recorder = SlowQueryRecorder(request, 'default', threshold_ms=0)
+        recorder.view = 'TweetViewSet'
+        # 記録先(record_slow_queryのpathの既定値)を一時ファイルにする
+        with mock.patch('api.slow_queries.record_slow_query.__defaults__', (self.path,)), \
+                connection.execute_wrapper(recorder):
+            list(queryset)
+
+    def test_records_queries_over_threshold(self):
+        self.capture(Tweet.objects.filter(content='x'))
+        entries = list(read_slow_queries(self.path))
+
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['view'], 'TweetViewSet')
+        self.assertEqual(entries[0]['params'], ['x'])
+
+    def test_suggests_index_for_full_scan(self):
+        sql, params = Tweet.objects.filter(content='x').query.sql_with_params()
+        self.assertEqual(suggest_indexes(sql, explain(sql, params)), [('Tweet', ['content'])])
+
+    def test_indexed_lookup_has_no_suggestion(self):
+        sql, params = Tweet.objects.filter(author_id=1).query.sql_with_params()
+        self.assertEqual(suggest_indexes(sql, explain(sql, params)), [])
+
+    def test_command(self):
+        self.capture(Tweet.objects.filter(content='x'))
+        out = io.StringIO()
+        call_command('advise_indexes', file=self.path, stdout=out)
+        self.assertIn("Tweet: models.Index(fields=['content'])", out.getvalue())
+
+
+def make_image(size=(400, 300), format='PNG'):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(output, format)
+    return output.getvalue()
+
+
+class MediaTestCase(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class MediaVariantTests(MediaTestCase):
+    """
+    api.media (user-035)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.name = default_storage.save('content/a.png', ContentFile(make_image()))
+        self.tweet = Tweet.objects.create(author=make_user('alice'), content='image', images=self.name)
+
+    def generate(self):
+        # ワーカープロセスを使わずにこのプロセスで変換する
+        with mock.patch('api.media._get_executors', return_value=(None, None)):
+            return generate_variants(self.name, 'content')
+
+    def test_original_url_before_generation(self):
+        with self.assertNumQueries(0):
+            urls = variant_urls(self.tweet, 'images')
+        self.assertEqual(set(urls.values()), {self.tweet.images.url})
+
+    def test_generated_names_are_stored_on_rows(self):
+        other = Tweet.objects.create(author=self.tweet.author, content='same image', images=self.name)
+        names = self.generate()
+        self.assertTrue(all(default_storage.exists(name) for name in names.values()))
+        self.assertEqual(save_variant_names(Tweet, 'images', self.name, names), 2)
+
+        for tweet in Tweet.objects.filter(pk__in=[self.tweet.pk, other.pk]):
+            with self.assertNumQueries(0):
+                urls = variant_urls(tweet, 'images')
+            self.assertEqual(urls['thumb'], default_storage.url(names['thumb']))
+            self.assertTrue(urls['thumb'].endswith('.thumb.webp'))
+
+    def test_replaced_image_ignores_old_state(self):
+        save_variant_names(Tweet, 'images', self.name, self.generate())
+        self.tweet.refresh_from_db()
+        self.tweet.images = default_storage.save('content/b.png', ContentFile(make_image((50, 50))))
+
+        urls = variant_urls(self.tweet, 'images')
+        self.assertEqual(set(urls.values()), {self.tweet.images.url})
+
+    def test_schedules_only_missing_variants(self):
+        with mock.patch('api.media.schedule_variants') as schedule:
+            schedule_for_instance(self.tweet)
+        schedule.assert_called_once_with(Tweet, 'images', self.name, 'content', None)
+
+        save_variant_names(Tweet, 'images', self.name, self.generate())
+        self.tweet.refresh_from_db()
+        with mock.patch('api.media.schedule_variants') as schedule:
+            schedule_for_instance(self.tweet)
+        schedule.assert_not_called()
+
+    def test_serializer_does_not_touch_storage(self):
+        with mock.patch.object(type(default_storage._wrapped), 'exists') as exists, \
+                mock.patch('api.media.schedule_variants') as schedule:
+            TweetSerializer(self.tweet).data
+        exists.assert_not_called()
+        schedule.assert_not_called()
+
+
+class BlobStorageTests(MediaTestCase):
+    """
+    api.storage (user-036)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice')
+
+    def save_image(self, size=(40, 30)):
+        return default_storage.save('content/a.png', ContentFile(make_image(size)))
+
+    def refcount(self, name):
+        return MediaBlob.objects.get(name=name).refcount
+
+    def test_same_content_is_stored_once(self):
+        name = self.save_image()
+        first = Tweet.objects.create(author=self.user, content='1', images=name)
+        second = Tweet.objects.create(author=self.user, content='2', images=self.save_image())
+
+        self.assertEqual(second.images.name, name)
+        self.assertEqual(self.refcount(name), 2)
+
+        first.delete()
+        self.assertEqual(self.refcount(name), 1)
+        self.assertEqual(purge_blobs(grace=0), 0)
+        self.assertTrue(default_storage.exists(name))
+
+        second.delete()
+        self.assertEqual(self.refcount(name), 0)
+        self.assertEqual(purge_blobs(grace=0), 1)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+
+    def test_replacing_image_releases_old_file(self):
+        old = self.save_image()
+        tweet = Tweet.objects.create(author=self.user, content='1', images=old)
+        tweet = Tweet.objects.get(pk=tweet.pk)
+        tweet.images = self.save_image((10, 10))
+        tweet.save()
+
+        self.assertEqual(self.refcount(old), 0)
+        self.assertEqual(self.refcount(tweet.images.name), 1)
+
+        # 画像以外の保存では参照数を変えない
+        tweet.content = 'updated'
+        tweet.save(update_fields=['content'])
+        self.assertEqual(self.refcount(tweet.images.name), 1)
+
+    def test_unreferenced_file_is_purged_after_grace(self):
+        # モデルの保存に失敗した場合と同じく、保存しただけで参照されないファイル
+        name = self.save_image()
+        self.assertEqual(self.refcount(name), 0)
+
+        self.assertEqual(purge_blobs(), 0)
+        self.assertEqual(purge_blobs(grace=0), 1)
+        self.assertFalse(default_storage.exists(name))
+
+    def test_reused_file_is_not_purged(self):
+        name = self.save_image()
+        MediaBlob.objects.filter(name=name).update(released_at=timezone.now() - timedelta(days=1))
+
+        # 保存済みのファイルを再利用したら、猶予期間が延びる
+        self.assertEqual(self.save_image(), name)
+        self.assertEqual(purge_blobs(grace=60), 0)
+        self.assertTrue(default_storage.exists(name))
+
+    def test_sweep_counts_references(self):
+        referenced = self.save_image()
+        Tweet.objects.create(author=self.user, content='1', images=referenced)
+        orphan = self.save_image((10, 10))
+        MediaBlob.objects.all().delete()
+
+        self.assertEqual(sweep_orphan_files(), 2)
+        self.assertEqual(self.refcount(referenced), 1)
+        self.assertEqual(self.refcount(orphan), 0)
+
+        self.assertEqual(purge_blobs(grace=0), 1)
+        self.assertTrue(default_storage.exists(referenced))
+        self.assertFalse(default_storage.exists(orphan))
+
+    def test_variants_are_kept_with_referenced_source(self):
+        name = self.save_image()
+        Tweet.objects.create(author=self.user, content='1', images=name)
+        with mock.patch('api.media._get_executors', return_value=(None, None)):
+            variants = generate_variants(name, 'content')
+
+        self.assertEqual(list(MediaBlob.objects.values_list('name', flat=True)), [name])
+        self.assertEqual(purge_blobs(grace=0), 0)
+        self.assertTrue(all(default_storage.exists(variant) for variant in variants.values()))
+
+    def test_loading_rows_has_no_blob_receiver(self):
+        for model in (mUser, Tweet):
+            modules = {receiver.__module__ for receiver in post_init._live_receivers(model)}
+            self.assertNotIn('api.signals', modules)
+
+
+class UploadTests(MediaTestCase):
+    """
+    api.uploads, UploadView, UploadDetailView (user-037)
+    """
+
+    def setUp(self):
+        super().setUp()
+        staging_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, staging_dir, ignore_errors=True)
+        patcher = mock.patch('api.uploads.UPLOAD_STAGING_DIR', staging_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # スロットリングの記録を消す
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.user = make_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def start(self, data):
+        response = self.client.post('/api/upload/', {'filename': 'a.png', 'size': len(data)},
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 201, response.content)
+        return '/api/upload/{0}/'.format(response.data['token'])
+
+    def put(self, url, data, start, total):
+        return self.client.put(
+            url, data, content_type='application/octet-stream', HTTP_HOST='localhost',
+            HTTP_CONTENT_RANGE='bytes {0}-{1}/{2}'.format(start, start + len(data) - 1, total),
+        )
+
+    def session(self, url):
+        return UploadSession.objects.get(token=url.rstrip('/').rsplit('/', 1)[1])
+
+    def test_resume_after_interruption(self):
+        data = make_image()
+        url = self.start(data)
+        half = len(data) // 2
+
+        self.assertEqual(self.put(url, data[:half], 0, len(data)).data['offset'], half)
+
+        # 同じチャンクを送り直すと、再開する位置を返す
+        response = self.put(url, data[:half], 0, len(data))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], half)
+        self.assertEqual(self.client.get(url, HTTP_HOST='localhost').data['offset'], half)
+
+        response = self.put(url, data[half:], half, len(data))
+        self.assertEqual(response.data['offset'], len(data))
+        self.assertEqual(response.data['status'], self.session(url).get_status_display())
+
+        session = self.session(url)
+        store_upload(session.pk)
+        session.refresh_from_db()
+        self.assertEqual(session.status, UploadSession.STORED)
+        with default_storage.open(session.stored_name, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_attach_before_and_after_store(self):
+        data = make_image()
+        url = self.start(data)
+        self.put(url, data, 0, len(data))
+        tweet = Tweet.objects.create(author=self.user, content='image')
+
+        # 保存前に紐付けたら、保存後にセットされる
+        attach_upload(self.session(url).token, self.user, tweet, 'images')
+        store_upload(self.session(url).pk)
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.images.name, self.session(url).stored_name)
+        self.assertEqual(MediaBlob.objects.get(name=tweet.images.name).refcount, 1)
+
+        other = Tweet.objects.create(author=self.user, content='other')
+        with self.assertRaises(UploadError):
+            attach_upload(self.session(url).token, make_user('bob'), other, 'images')
+
+    def test_rejects_non_image(self):
+        data = b'not an image'
+        url = self.start(data)
+        self.put(url, data, 0, len(data))
+
+        session = self.session(url)
+        with self.assertRaises(Exception):
+            store_upload(session.pk)
+        session.refresh_from_db()
+        self.assertEqual(session.status, UploadSession.FAILED)
+
+    def test_size_limit(self):
+        response = self.client.post('/api/upload/', {'filename': 'a.png', 'size': 0}, HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 400)
+
+
+class MediaServingTests(MediaTestCase):
+    """
+    api.views.serve_media, api.sendfile, api.media_tokens (user-038)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.data = make_image()
+        self.name = default_storage.save('content/a.png', ContentFile(self.data))
+        self.url = '/media/' + self.name
+
+    def fetch(self, url=None, **headers):
+        response = self.client.get(url or self.url, HTTP_HOST='localhost', **headers)
+        if response.streaming:
+            response.body = b''.join(response.streaming_content)
+        return response
+
+    def test_full_response(self):
+        response = self.fetch()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        response = self.fetch(HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.body, self.data[:10])
+        self.assertEqual(response['Content-Range'], 'bytes 0-9/{0}'.format(len(self.data)))
+
+        response = self.fetch(HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.body, self.data[-5:])
+
+        response = self.fetch(HTTP_RANGE='bytes={0}-'.format(len(self.data)))
+        self.assertEqual(response.status_code, 416)
+
+    def test_if_range_mismatch_returns_full_body(self):
+        response = self.fetch(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, self.data)
+
+    def test_not_modified(self):
+        etag = self.fetch()['ETag']
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH='W/' + etag).status_code, 304)
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_nginx_backend(self):
+        with mock.patch('api.sendfile.MEDIA_SENDFILE_BACKEND', 'nginx'):
+            response = self.fetch()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+        self.assertEqual(response.content, b'')
+
+    def test_rejects_hidden_paths(self):
+        self.assertEqual(self.fetch('/media/../settings.py').status_code, 404)
+        self.assertEqual(self.fetch('/media/.env').status_code, 404)
+
+
+@override_settings(MEDIA_PRIVATE_MESSAGES=True)
+class PrivateMediaTests(MediaServingTests):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        room = Room.objects.create()
+        room.users.add(self.alice, self.bob)
+        self.message = Message.objects.create(room=room, sender=self.alice, receiver=self.bob,
+                                              content='image', image=self.name)
+
+    def fetch(self, url=None, **headers):
+        if url is None:
+            url = self.url + '?t=' + media_token(self.name, 'bob')
+        return super().fetch(url, **headers)
+
+    def test_full_response(self):
+        response = self.fetch()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+
+    def test_requires_signed_token(self):
+        self.assertEqual(self.fetch(self.url).status_code, 404)
+        # JWTをURLで渡す方法は使えない
+        jwt = jwt_settings.JWT_ENCODE_HANDLER(jwt_settings.JWT_PAYLOAD_HANDLER(self.bob))
+        self.assertEqual(self.fetch(self.url + '?token=' + jwt).status_code, 404)
+        self.assertEqual(self.fetch(self.url, HTTP_AUTHORIZATION='JWT ' + jwt).status_code, 200)
+
+    def test_token_is_scoped(self):
+        other = default_storage.save('content/b.png', ContentFile(make_image((10, 10))))
+        token = media_token(other, 'bob')
+        self.assertEqual(self.fetch(self.url + '?t=' + token).status_code, 404)
+
+        make_user('carol')
+        self.assertEqual(self.fetch(self.url + '?t=' + media_token(self.name, 'carol')).status_code, 404)
+
+    def test_token_expires(self):
+        token = media_token(self.name, 'bob')
+        self.assertEqual(check_media_token(token, self.name), 'bob')
+        self.assertIsNone(check_media_token(token, self.name, max_age=-1))
+        self.assertIsNone(check_media_token(token + 'x', self.name))
+
+    def test_serializer_signs_urls_for_viewer(self):
+        view = mock.Mock()
+        view.get_login_user.return_value = 'bob'
+        data = MessageSerializer(self.message, context={'view': view}).data
+
+        token = parse_qs(urlparse(data['image']).query)['t'][0]
+        self.assertEqual(check_media_token(token, self.name), 'bob')
+        self.assertTrue(all('?t=' in url for url in data['image_variants'].values()))
+
+        # URLのまま使える
+        self.assertEqual(self.fetch(urlparse(data['image']).path + '?' + urlparse(data['image']).query).status_code, 200)
+
+
+class PlannerColumnTests(CacheTestCase):
+    """
+    api.planner の列の絞り込み (user-039)
+    """
+
+    FIELDS = ['pk', 'author', 'content', 'userIcon', 'liked_count', 'reply_count', 'created_time']
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        for i in range(3):
+            Tweet.objects.create(author=self.alice, content='tweet{0}'.format(i))
+
+    def test_requested_fields_map_to_columns(self):
+        columns = requirements(TweetSerializer, self.FIELDS).columns
+        for column in ('content', 'author__username', 'author__icon', 'created_at', 'isRetweet', 'updated_at'):
+            self.assertIn(column, columns)
+        self.assertNotIn('images', columns)
+
+    def test_unknown_columns_are_not_narrowed(self):
+        self.assertIsNone(requirements(TweetSerializer).columns)
+        self.assertIsNone(requirements(MessageSerializer, ['pk', 'isMe']).columns)
+
+    def test_queryset_is_narrowed(self):
+        tweet = plan_queryset(Tweet.objects.all(), TweetSerializer, self.FIELDS)[0]
+        self.assertIn('images', tweet.get_deferred_fields())
+        self.assertNotIn('content', tweet.get_deferred_fields())
+        self.assertIn('email', tweet.author.get_deferred_fields())
+
+        tweet = plan_queryset(Tweet.objects.all(), TweetSerializer, self.FIELDS, narrow=False)[0]
+        self.assertEqual(tweet.get_deferred_fields(), set())
+
+    def test_narrowed_list_has_no_deferred_loads(self):
+        queryset = Tweet.objects.order_by('-pk')
+        # 一覧1回(件数はサブクエリ)だけ
+        with self.assertNumQueries(1):
+            data = TweetSerializer(queryset, many=True, fields=self.FIELDS).data
+        self.assertEqual([tweet['content'] for tweet in data], ['tweet2', 'tweet1', 'tweet0'])
+        self.assertEqual(data[0]['userIcon'], '/media/' + str(self.alice.icon))
+        self.assertEqual(data[0]['reply_count'], 0)
+
+    def test_sparse_fields_request_reads_only_those_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get('/api/tweet/', fields='pk,content').data
+        self.assertEqual(set(data['results'][0]), {'pk', 'content'})
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT "api_tweet"."id"')]
+        self.assertTrue(selects)
+        self.assertNotIn('"api_tweet"."images"', selects[0])
+
+
+class NotificationListTests(CacheTestCase):
+    """
+    NotificationListSerializer のまとめた取得 (user-040)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.tweet = Tweet.objects.create(author=self.alice, content='hello')
+
+    def notify(self, count):
+        for i in range(count):
+            sender = make_user('sender{0}'.format(mUser.objects.count()))
+            Notification.objects.create(
+                event=2, receive_user=self.alice, send_user=sender, target_tweet_info=self.tweet)
+            # フォロー申請の通知はsignalsが作る
+            FollowRequest.objects.create(follow_request_user=sender, follow_response_user=self.alice)
+
+    def count_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.get('/api/info/', loginUser='alice')
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_page(self):
+        self.notify(2)
+        small = self.count_queries()
+        self.notify(5)
+        self.assertEqual(self.count_queries(), small)
+
+    def test_follow_request_acceptance_is_batched(self):
+        self.notify(2)
+        accepted = FollowRequest.objects.get(follow_request_user__username='sender1')
+        accepted.isAccepted = True
+        accepted.save()
+
+        results = self.get('/api/info/', loginUser='alice').data['results']
+        requests = {item['send_user']['username']: item['isAccepted'] for item in results if item['event'] == 'Follow Request'}
+        self.assertEqual(requests, {'sender1': True, 'sender2': False})
+
+    def test_batched_target_tweet_matches_single_render(self):
+        self.notify(1)
+        self.tweet.liked.add(Notification.objects.get(event=2).send_user)
+
+        results = self.get('/api/info/', loginUser='alice').data['results']
+        listed = [item['target_tweet_info'] for item in results if item['event'] == 'Liked'][0]
+        single = NotificationSerializer(Notification.objects.get(event=2)).data['target_tweet_info']
+        self.assertEqual(listed['liked_count'], 1)
+        self.assertEqual(listed, single)
+
+
+class InboxTests(CacheTestCase):
+    """
+    api.inbox の既読日時 (user-041)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+
+    def notify(self, information):
+        return Notification.objects.create(event=0, receive_user=self.alice, send_user=self.bob, infomation=information)
+
+    def unread_count(self):
+        return self.get('/api/info/getInfoCnt/', loginUser='alice').data['info_count']
+
+    def test_unread_count_follows_watermark(self):
+        self.notify('first')
+        self.notify('second')
+        self.assertEqual(self.unread_count(), 2)
+
+        with self.assertNumQueries(2):
+            # ユーザーの取得と既読日時の更新だけ
+            self.get('/api/info/readInfo/', loginUser='alice')
+        self.assertEqual(self.unread_count(), 0)
+
+        self.notify('third')
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_readed_is_derived_from_watermark(self):
+        self.notify('old')
+        mark_all_read(self.alice)
+        self.notify('new')
+
+        results = self.get('/api/info/', loginUser='alice').data['results']
+        self.assertEqual({item['infomation']: item['readed'] for item in results}, {'old': True, 'new': False})
+
+    def test_watermark_does_not_move_back(self):
+        now = timezone.now()
+        mark_all_read(self.alice, at=now)
+        mark_all_read(self.alice, at=now - timedelta(hours=1))
+        self.assertEqual(get_watermark(mUser.objects.get(pk=self.alice.pk)), now)
+
+    def test_missing_setting_is_created(self):
+        mSetting.objects.filter(target=self.alice).delete()
+        alice = mUser.objects.get(pk=self.alice.pk)
+        self.notify('before')
+
+        at = mark_all_read(alice)
+        self.assertEqual(get_watermark(alice), at)
+        self.assertEqual(mSetting.objects.get(target=self.alice).last_read_at, at)
+        self.assertEqual(unread_notifications(alice).count(), 0)
+
+
+class ArchivePageTests(CacheTestCase):
+    """
+    api.archive のページ単位の読み出し (user-042)
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = Room.objects.create()
+        self.room.users.add(self.alice, self.bob)
+
+    def message(self, content, days):
+        return Message.objects.create(
+            room=self.room, sender=self.alice, receiver=self.bob, content=content,
+            created_at=timezone.now() - timedelta(days=days),
+        )
+
+    def notify(self, information, days):
+        notification = Notification.objects.create(
+            event=0, receive_user=self.alice, send_user=self.bob, infomation=information)
+        Notification.objects.filter(pk=notification.pk).update(created_at=timezone.now() - timedelta(days=days))
+
+    def test_message_round_trip(self):
+        old = self.message('old', 400)
+        self.message('new', 1)
+        run_retention(names=['message'])
+        self.assertFalse(Message.objects.filter(pk=old.pk).exists())
+
+        url = '/api/message/get_room_msg/'
+        live = self.get(url, id=self.room.id, loginUser='alice').data
+        self.assertEqual([message['content'] for message in live], ['new'])
+
+        data = self.get(url, id=self.room.id, loginUser='alice', before=timezone.now().isoformat()).data
+        self.assertEqual(len(data['results']), 1)
+        restored = data['results'][0]
+        self.assertEqual((restored['id'], restored['content']), (str(old.pk), 'old'))
+        self.assertIsNone(data['next_before'])
+
+    def test_invalid_before(self):
+        response = self.client.get('/api/message/get_room_msg/', {'id': self.room.id, 'loginUser': 'alice', 'before': 'x'}, HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 400)
+
+    def test_page_reads_only_needed_buckets(self):
+        for days in (120, 160, 200, 240):
+            self.notify('{0}'.format(days), days)
+        run_retention(names=['notification'])
+        self.assertEqual(ArchiveBucket.objects.filter(kind='notification').count(), 4)
+
+        with mock.patch('api.archive.decode_rows', side_effect=decode_rows) as decode:
+            objs, before = fetch_archived_page('notification', self.alice.pk, limit=1)
+        self.assertEqual([obj.infomation for obj in objs], ['120'])
+        self.assertEqual(decode.call_count, 1)
+
+        objs, before = fetch_archived_page('notification', self.alice.pk, before=before, limit=2)
+        # created_at順
+        self.assertEqual([obj.infomation for obj in objs], ['200', '160'])
+        objs, before = fetch_archived_page('notification', self.alice.pk, before=before, limit=2)
+        self.assertEqual([obj.infomation for obj in objs], ['240'])
+        self.assertIsNone(before)
+
+    def test_archived_notifications_are_paged_by_cursor(self):
+        for days in (120, 160, 200):
+            self.notify('{0}'.format(days), days)
+        run_retention(names=['notification'])
+
+        self.client.force_authenticate(self.alice)
+        data = self.get('/api/info/archived/', loginUser='alice', page_size=2).data
+        self.assertEqual([item['infomation'] for item in data['results']], ['120', '160'])
+        data = self.get('/api/info/archived/', loginUser='alice', page_size=2, before=data['next_before']).data
+        self.assertEqual([item['infomation'] for item in data['results']], ['200'])
+        self.assertIsNone(data['next_before'])
+
+    def test_archived_message_notifications(self):
+        message = self.message('hello', 1)
+        notice = MessageNotification.objects.create(receiver=self.bob, sender=self.alice, room=self.room, message=message)
+        MessageNotification.objects.filter(pk=notice.pk).update(created_at=timezone.now() - timedelta(days=120))
+        run_retention(names=['message_notification'])
+        self.assertFalse(MessageNotification.objects.filter(pk=notice.pk).exists())
+
+        self.client.force_authenticate(self.bob)
+        data = self.get('/api/message/archived_notice/', loginUser='bob').data
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['message']['content'], 'hello')
+        self.assertEqual(data['results'][0]['sender']['username'], 'alice')
+
+    def test_archived_requires_the_owner(self):
+        self.notify('old', 120)
+        run_retention(names=['notification'])
+
+        for url in ('/api/info/archived/', '/api/message/archived_notice/'):
+            response = self.client.get(url, {'loginUser': 'alice'}, HTTP_HOST='localhost')
+            self.assertIn(response.status_code, (401, 403))
+
+        # loginUserで他のユーザーを指定しても、認証したユーザーの分だけ返す
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.get('/api/info/archived/', loginUser='alice').data['results'], [])
+        self.assertEqual(self.get('/api/info/archived/').data['results'], [])
+
+
+class AccessLogTests(TestCase):
+    """
+    api.access_logs のバッファ, AccessLogMiddleware (user-043)
+    """
+
+    def make_buffer(self, **kwargs):
+        log_buffer = AccessLogBuffer(**kwargs)
+        # 書き込み用のスレッドは起動せず、テストからflushする
+        patcher = mock.patch.object(log_buffer, '_start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return log_buffer
+
+    def test_parse_user_agent(self):
+        self.assertEqual(
+            parse_user_agent('Mozilla/5.0 (Linux; Android 10; Pixel) AppleWebKit/537.36 Chrome/90.0 Mobile Safari/537.36'),
+            ('Mobile', 'Chrome'))
+        self.assertEqual(
+            parse_user_agent('Mozilla/5.0 (iPad; CPU OS 14_0) AppleWebKit/605.1.15 Version/14.0 Safari/604.1'),
+            ('Tablet', 'Safari'))
+        self.assertEqual(parse_user_agent('Googlebot/2.1'), ('Bot', 'Bot'))
+        self.assertEqual(parse_user_agent(''), ('Unknown', 'Unknown'))
+
+    def test_parse_language(self):
+        self.assertEqual(parse_language('fr;q=0.5, ja, en;q=0.8'), 'ja')
+        self.assertEqual(parse_language('*'), '')
+
+    def test_flush_writes_in_batches_and_drops_overflow(self):
+        log_buffer = self.make_buffer(batch_size=2, max_buffer=3)
+        results = [log_buffer.add(mAccessLog(page='/{0}'.format(i), device='PC', browser='Chrome')) for i in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+        self.assertEqual(mAccessLog.objects.count(), 0)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(log_buffer.flush(), 3)
+        self.assertEqual(sorted(mAccessLog.objects.values_list('page', flat=True)), ['/0', '/1', '/2'])
+        self.assertEqual((log_buffer.records, log_buffer.dropped, log_buffer.written), ([], 0, 3))
+
+    def test_middleware_buffers_without_writing(self):
+        log_buffer = self.make_buffer()
+        cache.clear()
+        with mock.patch('api.middleware.access_log_buffer', log_buffer):
+            response = self.client.get('/api/tweet/', HTTP_HOST='localhost', HTTP_ACCEPT_LANGUAGE='ja')
+            visitor = response.cookies[VISITOR_COOKIE].value
+            self.client.get('/api/tweet/', HTTP_HOST='localhost')
+            self.client.get('/static/app.js', HTTP_HOST='localhost')
+
+        self.assertEqual(mAccessLog.objects.count(), 0)
+        self.assertEqual([str(record.uuid) for record in log_buffer.records], [visitor, visitor])
+        self.assertEqual(log_buffer.records[0].language, 'ja')
+        self.assertEqual(log_buffer.records[0].page, '/api/tweet/')
+
+
+class TrafficRollupTests(CacheTestCase):
+    """
+    api.traffic の集計位置, TrafficView (user-044)
+    """
+
+    def setUp(self):
+        super().setUp()
+        # 他のテストのリクエストのログがフラッシュ用のスレッドから書き込まれないようにする
+        patcher = mock.patch.object(access_log_buffer, 'flush', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        access_log_buffer.records.clear()
+
+    def log(self, page, logged_at=None, time=None):
+        now = timezone.now()
+        return mAccessLog.objects.create(
+            page=page, device='PC', browser='Chrome', language='ja',
+            time=time or now, logged_at=logged_at or now,
+        )
+
+    def views(self, granularity=TrafficRollup.HOUR):
+        return dict(TrafficRollup.objects.filter(granularity=granularity).values_list('page', 'views'))
+
+    def test_rollup_advances_high_water_mark(self):
+        old = timezone.now() - timedelta(minutes=10)
+        self.log('/a?loginUser=alice', logged_at=old)
+        last = self.log('/a', logged_at=old)
+
+        self.assertEqual(rollup_batch(), 2)
+        self.assertEqual(RollupState.objects.get(name='traffic').last_id, last.id)
+        self.assertEqual(self.views(), {'/a': 2})
+        self.assertEqual(self.views(TrafficRollup.DAY), {'/a': 2})
+
+        # 集計済みの行は数えない
+        self.assertEqual(rollup_batch(), 0)
+        self.log('/a', logged_at=old)
+        self.assertEqual(rollup_batch(), 1)
+        self.assertEqual(self.views(), {'/a': 3})
+
+    def test_recently_inserted_rows_wait_even_with_old_access_time(self):
+        old = timezone.now() - timedelta(minutes=10)
+        self.log('/done', logged_at=old, time=old)
+        # バッファに溜まっていた行はtimeが古くてもlogged_atは新しい
+        self.log('/late', time=old)
+        self.log('/after', logged_at=old, time=old)
+
+        self.assertEqual(rollup_batch(), 1)
+        self.assertEqual(self.views(), {'/done': 1})
+
+        later = timezone.now() + timedelta(seconds=TRAFFIC_ROLLUP_LAG + 1)
+        self.assertEqual(rollup_batch(now=later), 2)
+        self.assertEqual(self.views(), {'/done': 1, '/late': 1, '/after': 1})
+
+    def test_buffer_stamps_insert_time(self):
+        log_buffer = AccessLogBuffer()
+        log_buffer.records.append(mAccessLog(page='/', device='PC', browser='Chrome', time=timezone.now() - timedelta(hours=1)))
+        before = timezone.now()
+        log_buffer.flush()
+        self.assertGreaterEqual(mAccessLog.objects.get().logged_at, before)
+
+    def test_view_defaults_to_recent_period(self):
+        admin = make_user('admin')
+        admin.is_staff = True
+        admin.save()
+        self.client.force_authenticate(admin)
+
+        now = timezone.now()
+        for page, hours in (('/recent', 1), ('/old', 48)):
+            TrafficRollup.objects.create(
+                granularity=TrafficRollup.HOUR, bucket=now - timedelta(hours=hours),
+                page=page, device='PC', browser='Chrome', language='ja', views=1,
+            )
+
+        rows = self.get('/api/traffic/', group_by='page').data
+        self.assertEqual([row['page'] for row in rows], ['/recent'])
+
+        since = (now - timedelta(days=3)).isoformat()
+        rows = self.get('/api/traffic/', group_by='page', since=since).data
+        self.assertEqual([row['page'] for row in rows], ['/old', '/recent'])
+
+
+class TimelineFanoutTests(TestCase):
+    """
+    api.timeline の送り先 (user-049)
+    """
+
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+
+    def follow(self, author, *usernames):
+        users = [make_user(username) for username in usernames]
+        for user in users:
+            user.followees.add(author)
+        return users
+
+    def test_muted_and_blocked_followers_are_skipped(self):
+        carol, dave, erin = self.follow(self.alice, 'carol', 'dave', 'erin')
+        self.bob.followees.add(self.alice)
+        carol.msetting.mute_list.add(self.alice)
+        dave.msetting.block_list.add(self.alice)
+        self.alice.msetting.block_list.add(erin)
+
+        self.assertEqual(set(recipients(self.alice, self.alice)), {'alice', 'bob'})
+
+    def test_retweet_skips_users_muting_the_original_author(self):
+        frank, gina = self.follow(self.bob, 'frank', 'gina')
+        gina.msetting.mute_list.add(self.alice)
+
+        self.assertEqual(set(recipients(self.bob, self.alice)), {'bob', 'frank'})
+
+    def test_fanout_publishes_in_batches(self):
+        self.follow(self.alice, 'carol', 'dave')
+        tweet = Tweet.objects.create(author=self.alice, content='hello')
+
+        with mock.patch('api.timeline.publisher') as publisher, \
+                mock.patch('api.timeline.TIMELINE_FANOUT_BATCH', 2):
+            publisher.publish_many.side_effect = lambda batch, timeout: len(batch)
+            self.assertEqual(fanout(tweet.pk, RETWEET, self.bob.pk), 1)
+            self.assertEqual(fanout(tweet.pk, 'tweet', self.alice.pk), 3)
+
+        batches = [call[0][0] for call in publisher.publish_many.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [1, 2, 1])
+        event = batches[0][0][1]
+        self.assertEqual((event['id'], event['author'], event['retweeted_by']), (tweet.pk, 'alice', 'bob'))
+
+    def test_deleted_tweet_is_not_pushed(self):
+        tweet = Tweet.objects.create(author=self.alice, content='hello', deleted=True)
+        with mock.patch('api.timeline.publisher') as publisher:
+            self.assertEqual(fanout(tweet.pk, 'tweet', self.alice.pk), 0)
+        self.assertFalse(publisher.publish_many.called)
+
+    def test_retweet_of_reply_is_not_pushed(self):
+        with mock.patch('api.signals.push_tweet') as push_tweet:
+            reply = Tweet.objects.create(author=self.alice, content='reply', isReply=True)
+            retweet = Tweet.objects.create(author=self.alice, content='reply', isReply=True, isRetweet=True)
+            RetweetRelationShip.objects.create(target_tweet=reply, retweet=retweet, retweet_user=self.bob)
+
+        push_tweet.assert_called_once_with(reply, REPLY, self.alice)
+
+
+class HashTagTests(TestCase):
+    """
+    api.hashtags の抽出, インデックスの差分, 件数 (user-050)
+    """
+
+    def setUp(self):
+        self.alice = make_user('alice')
+
+    def counts(self):
+        return dict(HashTag.objects.values_list('slug', 'tweet_count'))
+
+    def tags(self, tweet):
+        indexed = set(HashTagIndex.objects.filter(tweet=tweet).values_list('tag__slug', flat=True))
+        self.assertEqual(set(tweet.hashTag.values_list('slug', flat=True)), indexed)
+        return indexed
+
+    def test_extract_normalizes(self):
+        self.assertEqual(
+            extract_hashtags('#Django #django ＃ＤＪＡＮＧＯ #123 a#b &#123; #py_3'),
+            {'django': 'Django', 'py_3': 'py_3'},
+        )
+
+    def test_extract_skips_tags_too_long_after_normalizing(self):
+        self.assertEqual(extract_hashtags('#' + 'a' * TAG_MAX_LENGTH), {'a' * TAG_MAX_LENGTH: 'a' * TAG_MAX_LENGTH})
+        self.assertEqual(extract_hashtags('#' + 'a' * (TAG_MAX_LENGTH + 1)), {})
+        # ㍻ は NFKC で 平成 の2文字になる
+        self.assertEqual(extract_hashtags('#' + '㍻' * (TAG_MAX_LENGTH // 2 + 1)), {})
+
+    def test_update_applies_diff(self):
+        tweet = Tweet.objects.create(author=self.alice, content='#a #b')
+        other = Tweet.objects.create(author=self.alice, content='#b')
+        self.assertEqual(self.tags(tweet), {'a', 'b'})
+        self.assertEqual(self.counts(), {'a': 1, 'b': 2})
+
+        tweet.content = '#B #c'
+        tweet.save()
+        self.assertEqual(self.tags(tweet), {'b', 'c'})
+        self.assertEqual(self.counts(), {'a': 0, 'b': 2, 'c': 1})
+
+        tweet.deleted = True
+        tweet.save()
+        self.assertEqual(self.tags(tweet), set())
+        self.assertEqual(self.counts(), {'a': 0, 'b': 1, 'c': 0})
+
+        other.delete()
+        self.assertEqual(self.counts(), {'a': 0, 'b': 0, 'c': 0})
+
+    def test_retweet_is_not_indexed(self):
+        Tweet.objects.create(author=self.alice, content='#a', isRetweet=True)
+        self.assertFalse(HashTagIndex.objects.exists())
+
+    def test_tweet_embeds_tags_without_count(self):
+        tweet = Tweet.objects.create(author=self.alice, content='#Django')
+        tag = TweetSerializer(Tweet.objects.get(pk=tweet.pk)).data['hashTag'][0]
+        self.assertEqual((tag['title'], tag['slug']), ('Django', 'django'))
+        self.assertNotIn('tweet_count', tag)
@@ -0,0 +1,130 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import (
+    mUser,
+    mSetting,
+    Tweet,
+)
+from ws.publisher import publisher
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TIMELINE_PUSH = getattr(settings, 'TIMELINE_PUSH', True)
+TIMELINE_PREVIEW_LENGTH = getattr(settings, 'TIMELINE_PREVIEW_LENGTH', 80)
+TIMELINE_FANOUT_BATCH = getattr(settings, 'TIMELINE_FANOUT_BATCH', 500)
+TIMELINE_FANOUT_WORKERS = getattr(settings, 'TIMELINE_FANOUT_WORKERS', 1)
+TIMELINE_FANOUT_TIMEOUT = getattr(settings, 'TIMELINE_FANOUT_TIMEOUT', 10)
+
+
+"""
+ホームのタイムラインへの新着のプッシュ
+
+    ツイート, リツイートが作成されたら、フォロワーの通知のグループ(ユーザー名)に
+    idと短いプレビューだけの timeline イベントを送る。
+    クライアントはスクロールして表示する時に、ツイートをAPIで取得する。
+
+    送らない相手
+        - 作成者(リツイートなら元ツイートの作成者も)をミュートしているユーザー
+        - どちらかがブロックしているユーザー
+        - リプライのリツイート(ホームに出さないため)
+
+    送り先の取得と送信はワーカースレッドで行い、フォロワーが多いユーザーは
+    TIMELINE_FANOUT_BATCH件ずつ、パブリッシャーのキューの空きを待ちながら送る。
+"""
+
+TWEET = 'tweet'
+REPLY = 'reply'
+RETWEET = 'retweet'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=TIMELINE_FANOUT_WORKERS, thread_name_prefix='timeline')
+        return _executor
+
+
+def timeline_event(tweet, kind, actor):
+    """
+    クライアントに送る新着の内容
+    """
+
+    return {
+        'type': 'timeline',
+        'kind': kind,
+        'id': tweet.pk,
+        'author': tweet.author.username,
+        'retweeted_by': actor.username if kind == RETWEET else None,
+        'preview': tweet.content[:TIMELINE_PREVIEW_LENGTH],
+        'has_image': bool(tweet.images),
+        'created_at': tweet.created_at.isoformat(),
+    }
+
+
+def recipients(actor, author):
+    """
+    新着を送るユーザー名(フォロワーと本人)
+    """
+
+    users = {actor.pk, author.pk}
+    # ブロックしたユーザー
+    blocked = mSetting.block_list.through.objects.filter(msetting__target__in=users).values('muser')
+
+    followers = mUser.objects.filter(followees=actor) \
+        .exclude(msetting__mute_list__in=users) \
+        .exclude(msetting__block_list__in=users) \
+        .exclude(pk__in=blocked)
+    return mUser.objects.filter(pk=actor.pk).union(followers).values_list('username', flat=True)
+
+
+def fanout(tweet_pk, kind, actor_pk):
+    """
+    新着をフォロワーに送り、送った件数を返す。
+    """
+
+    try:
+        tweet = Tweet.objects.select_related('author').get(pk=tweet_pk, deleted=False)
+        actor = mUser.objects.get(pk=actor_pk)
+    except (Tweet.DoesNotExist, mUser.DoesNotExist):
+        return 0
+
+    event = timeline_event(tweet, kind, actor)
+    sent = 0
+    batch = []
+    for username in recipients(actor, tweet.author).iterator():
+        batch.append((username, event))
+        if len(batch) >= TIMELINE_FANOUT_BATCH:
+            sent += publisher.publish_many(batch, timeout=TIMELINE_FANOUT_TIMEOUT)
+            batch = []
+    if batch:
+        sent += publisher.publish_many(batch, timeout=TIMELINE_FANOUT_TIMEOUT)
+    return sent
+
+
+def _run_fanout(*args):
+    try:
+        fanout(*args)
+    except Exception:
+        logger.exception('タイムラインの新着を送れませんでした: %s', args)
+    finally:
+        close_old_connections()
+
+
+def push_tweet(tweet, kind, actor):
+    """
+    コミット後にワーカーで新着を送る。
+    """
+
+    if not TIMELINE_PUSH:
+        return
+    transaction.on_commit(lambda: _get_executor().submit(_run_fanout, tweet.pk, kind, actor.pk))
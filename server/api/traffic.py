@@ -0,0 +1,171 @@
+from collections import defaultdict
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .models import (
+    mAccessLog,
+    RollupState,
+    TrafficRollup,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TRAFFIC_ROLLUP_BATCH_SIZE = getattr(settings, 'TRAFFIC_ROLLUP_BATCH_SIZE', 50000)
+TRAFFIC_ROLLUP_LAG = getattr(settings, 'TRAFFIC_ROLLUP_LAG', 60)
+TRAFFIC_DEFAULT_SPANS = {
+    TrafficRollup.HOUR: timedelta(hours=24),
+    TrafficRollup.DAY: timedelta(days=30),
+}
+
+
+"""
+アクセスログの集計
+
+    mAccessLogの新しい行だけを、1時間毎と1日毎にページ, デバイス, ブラウザ, 言語別の
+    件数としてTrafficRollupに足し込む。
+    どこまで集計したかはRollupStateのlast_idに記録する。
+
+    アクセスログはまとめて書き込まれるため、書き込んだ時刻(logged_at)がTRAFFIC_ROLLUP_LAG秒より
+    新しい行から後ろは(idの小さい行がまだ書き込まれていない事があるので)次の実行に回す。
+    アクセスした時刻(time)はバッファに溜まっていた分だけ古いため、この判定には使わない。
+
+    ダッシュボードは traffic_summary で集計済みの行だけを読む。
+    期間を指定しない時は TRAFFIC_DEFAULT_SPANS の分だけ読む。
+"""
+
+STATE_NAME = 'traffic'
+DIMENSIONS = ('page', 'device', 'browser', 'language')
+TRUNCS = (
+    (TrafficRollup.HOUR, TruncHour),
+    (TrafficRollup.DAY, TruncDay),
+)
+
+
+def page_path(page):
+    """
+    集計に使うパス(クエリ文字列はloginUserなどで種類が増えるため除く)
+    """
+    return urlsplit(page).path or '/'
+
+
+def aggregate(logs, trunc):
+    """
+    {(bucket, page, device, browser, language): 件数}
+    """
+
+    rows = logs.order_by().annotate(
+        bucket=trunc('time', tzinfo=timezone.get_current_timezone()),
+    ).values('bucket', *DIMENSIONS).annotate(views=Count('id'))
+
+    counts = defaultdict(int)
+    for row in rows:
+        key = (row['bucket'], page_path(row['page']), row['device'], row['browser'], row['language'])
+        counts[key] += row['views']
+    return counts
+
+
+def merge(granularity, counts):
+    """
+    件数を既存の集計に足す。無ければ作る。
+    """
+
+    if not counts:
+        return
+    buckets = {key[0] for key in counts}
+    existing = {
+        (rollup.bucket,) + tuple(getattr(rollup, name) for name in DIMENSIONS): rollup
+        for rollup in TrafficRollup.objects.filter(granularity=granularity, bucket__in=buckets)
+    }
+
+    updated, created = [], []
+    for key, views in counts.items():
+        rollup = existing.get(key)
+        if rollup is not None:
+            rollup.views += views
+            updated.append(rollup)
+        else:
+            created.append(TrafficRollup(
+                granularity=granularity,
+                bucket=key[0],
+                views=views,
+                **dict(zip(DIMENSIONS, key[1:]))
+            ))
+    TrafficRollup.objects.bulk_update(updated, ['views'], batch_size=1000)
+    TrafficRollup.objects.bulk_create(created, batch_size=1000)
+
+
+def rollup_batch(batch_size=TRAFFIC_ROLLUP_BATCH_SIZE, now=None):
+    """
+    未集計の行をbatch_size件まで集計し、件数を返す。
+        集計と位置の更新は同じトランザクションで行い、状態の行のロックで同時実行を防ぐ。
+    """
+
+    now = now or timezone.now()
+    with transaction.atomic():
+        RollupState.objects.get_or_create(name=STATE_NAME)
+        state = RollupState.objects.select_for_update().get(name=STATE_NAME)
+
+        pending = mAccessLog.objects.filter(id__gt=state.last_id)
+        # 新しい行より後ろは、間の行がまだ書き込まれていない事があるので次に回す
+        recent = pending.filter(logged_at__gte=now - timedelta(seconds=TRAFFIC_ROLLUP_LAG)) \
+            .order_by('id').values_list('id', flat=True).first()
+        if recent is not None:
+            pending = pending.filter(id__lt=recent)
+
+        ids = list(pending.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return 0
+
+        logs = mAccessLog.objects.filter(id__gt=state.last_id, id__lte=ids[-1])
+        for granularity, trunc in TRUNCS:
+            merge(granularity, aggregate(logs, trunc))
+
+        state.last_id = ids[-1]
+        state.save(update_fields=['last_id', 'updated_at'])
+    return len(ids)
+
+
+def run_rollup(batch_size=TRAFFIC_ROLLUP_BATCH_SIZE, max_batches=None, now=None):
+    """
+    未集計の行が無くなるまで集計し、件数を返す。
+    """
+
+    now = now or timezone.now()
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = rollup_batch(batch_size, now=now)
+        total += count
+        batches += 1
+        if count < batch_size:
+            break
+    logger.info('アクセスログを%d件集計しました', total)
+    return total
+
+
+def traffic_summary(granularity, since=None, until=None, group_by=(), filters=None):
+    """
+    集計済みの件数をbucket毎に返す。
+        since : 無ければuntil(無ければ現在)からTRAFFIC_DEFAULT_SPANSの分だけ前
+        group_by : 分けて返すDIMENSIONS
+        filters : {DIMENSION: 値} で絞り込む
+    """
+
+    if since is None:
+        since = (until or timezone.now()) - TRAFFIC_DEFAULT_SPANS[granularity]
+
+    rollups = TrafficRollup.objects.filter(granularity=granularity, bucket__gte=since)
+    if until is not None:
+        rollups = rollups.filter(bucket__lt=until)
+    if filters:
+        rollups = rollups.filter(**filters)
+
+    return rollups.order_by().values('bucket', *group_by) \
+        .annotate(views=Sum('views')).order_by('bucket', '-views')
@@ -0,0 +1,249 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image
+
+from .models import (
+    UploadSession,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+分割アップロード
+
+    1. start_upload でセッションを作り、トークンを返す。
+    2. write_chunk で受け取ったチャンクをローカルのステージング領域に書き込む。
+       途中で切れても、セッションのreceivedから再開できる。
+    3. 全て受け取ったらワーカースレッドが設定されたストレージへ保存する。
+       リクエストはストレージ(Cloudinaryなど)の速度を待たない。
+    4. ツイートなどの作成時は attach_upload でトークンを紐付ける。
+       保存前なら保存後にワーカーがフィールドにセットする。
+"""
+
+UPLOAD_STAGING_DIR = getattr(settings, 'UPLOAD_STAGING_DIR', os.path.join(settings.BASE_DIR, 'upload_staging'))
+UPLOAD_CHUNK_SIZE = getattr(settings, 'UPLOAD_CHUNK_SIZE', 1024 * 1024)
+UPLOAD_MAX_SIZE = getattr(settings, 'UPLOAD_MAX_SIZE', 20 * 1024 * 1024)
+UPLOAD_WORKERS = getattr(settings, 'UPLOAD_WORKERS', 2)
+UPLOAD_SESSION_TTL = getattr(settings, 'UPLOAD_SESSION_TTL', 60 * 60 * 24)
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """
+    アップロードのエラー
+        offset : 続きを送るべき位置(オフセットが合わない場合)
+    """
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+        return _executor
+
+
+def staging_path(session):
+    return os.path.join(UPLOAD_STAGING_DIR, '{0}.part'.format(session.token))
+
+
+def parse_content_range(value):
+    """
+    Content-Range: bytes 0-1023/4096 の開始位置を返す。
+    """
+
+    match = CONTENT_RANGE.match(value or '')
+    if match is None:
+        raise UploadError('Content-Rangeが不正です。')
+    return int(match.group(1))
+
+
+def start_upload(user, filename, size, content_type=''):
+    if size <= 0:
+        raise UploadError('サイズが不正です。')
+    if size > UPLOAD_MAX_SIZE:
+        raise UploadError('{0}バイトを超えるファイルはアップロードできません。'.format(UPLOAD_MAX_SIZE))
+
+    session = UploadSession.objects.create(
+        owner=user,
+        filename=os.path.basename(filename)[:255],
+        content_type=content_type or '',
+        size=size,
+    )
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    open(staging_path(session), 'wb').close()
+    return session
+
+
+def write_chunk(session, offset, data):
+    """
+    チャンクを書き込み、書き込み後のオフセットを返す。
+        offsetは受信済みのバイト数と一致している必要がある。
+    """
+
+    if session.status != UploadSession.UPLOADING:
+        raise UploadError('アップロードは完了しています。', offset=session.received)
+    if offset != session.received:
+        raise UploadError('オフセットが一致しません。', offset=session.received)
+    if offset + len(data) > session.size:
+        raise UploadError('サイズを超えています。', offset=session.received)
+
+    with open(staging_path(session), 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+    received = offset + len(data)
+    updated = UploadSession.objects.filter(
+        pk=session.pk,
+        status=UploadSession.UPLOADING,
+        received=offset,
+    ).update(received=received)
+    if not updated:
+        # 同じ位置へのチャンクが同時に来た
+        session.refresh_from_db()
+        raise UploadError('オフセットが一致しません。', offset=session.received)
+    session.received = received
+
+    if received == session.size:
+        UploadSession.objects.filter(pk=session.pk).update(status=UploadSession.PENDING)
+        session.status = UploadSession.PENDING
+        transaction.on_commit(lambda: schedule_store(session.pk))
+    return received
+
+
+def schedule_store(session_pk):
+    _get_executor().submit(_run_store, session_pk)
+
+
+def _run_store(session_pk):
+    try:
+        store_upload(session_pk)
+    except Exception:
+        logger.exception('アップロードの保存に失敗しました: %s', session_pk)
+    finally:
+        close_old_connections()
+
+
+def store_upload(session_pk):
+    """
+    ステージングしたファイルをストレージに保存し、紐付け先があればセットする。
+    """
+
+    session = UploadSession.objects.get(pk=session_pk)
+    path = staging_path(session)
+    try:
+        with open(path, 'rb') as f:
+            # 画像フィールドにしか使わないため、画像として読めるか確認する
+            Image.open(f).verify()
+            f.seek(0)
+            name = default_storage.save(
+                'upload/{0}/{1}'.format(session.owner.username, session.filename),
+                File(f, name=session.filename),
+            )
+    except Exception:
+        UploadSession.objects.filter(pk=session.pk).update(status=UploadSession.FAILED)
+        raise
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        session.stored_name = name
+        session.status = UploadSession.STORED
+        session.save(update_fields=['stored_name', 'status', 'updated_at'])
+
+        if session.target_model:
+            model = apps.get_model(session.target_model)
+            try:
+                instance = model.objects.get(pk=session.target_pk)
+            except model.DoesNotExist:
+                return
+            assign(instance, session.target_field, name)
+
+
+def assign(instance, field_name, name):
+    """
+    保存済みのファイル名をフィールドにセットする。(signalsが飛ぶようにsaveする)
+    """
+
+    setattr(instance, field_name, name)
+    instance.save(update_fields=[field_name])
+
+
+def attach_upload(token, user, instance, field_name):
+    """
+    アップロードをインスタンスのフィールドに紐付ける。
+        保存済みならすぐにセットし、保存前なら保存後にセットする。
+    """
+
+    try:
+        session = UploadSession.objects.select_for_update().get(token=token, owner=user)
+    except (UploadSession.DoesNotExist, ValidationError):
+        raise UploadError('アップロードが見つかりません。')
+
+    if session.status == UploadSession.FAILED:
+        raise UploadError('アップロードに失敗したファイルです。')
+    if session.status == UploadSession.UPLOADING:
+        raise UploadError('アップロードが完了していません。', offset=session.received)
+
+    if session.status == UploadSession.STORED:
+        assign(instance, field_name, session.stored_name)
+        return
+
+    if session.target_model:
+        raise UploadError('既に使われているアップロードです。')
+    session.target_model = instance._meta.label
+    session.target_pk = str(instance.pk)
+    session.target_field = field_name
+    session.save(update_fields=['target_model', 'target_pk', 'target_field', 'updated_at'])
+
+
+def attach_uploads(data, user, instance, field_names):
+    """
+    リクエストの <フィールド名>_token をまとめて紐付ける。
+    """
+
+    with transaction.atomic():
+        for field_name in field_names:
+            token = data.get(field_name + '_token')
+            if token:
+                attach_upload(token, user, instance, field_name)
+
+
+def cleanup_uploads(ttl=UPLOAD_SESSION_TTL):
+    """
+    期限切れのセッションを削除する。
+        紐付け先が無いまま保存されたファイルは参照数0のまま残り、api.storage.purge_blobsが消す。
+    """
+
+    expired = UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl))
+    count = 0
+    for session in expired.iterator():
+        path = staging_path(session)
+        if os.path.exists(path):
+            os.remove(path)
+        session.delete()
+        count += 1
+    return count
@@ -20,5 +20,12 @@ urlpatterns = [
     path('search/', views.SearchView.as_view(), name='search'),
     path('setting/<int:pk>/', views.SettingView.as_view(), name='setting'),
     path('news/', views.NewsView.as_view(), name='news'),
+    path('export/', views.ExportView.as_view(), name='export'),
+    path('upload/', views.UploadView.as_view(), name='upload'),
+    path('upload/<uuid:token>/', views.UploadDetailView.as_view(), name='upload-detail'),
+    path('traffic/', views.TrafficView.as_view(), name='traffic'),
+    path('ws-ticket/', views.WebsocketTicketView.as_view(), name='ws-ticket'),
+    path('ws-stats/', views.WebsocketStatsView.as_view(), name='ws-stats'),
+    path('db-stats/', views.DatabaseStatsView.as_view(), name='db-stats'),
     # path('setting/<str:username>/', views.SettingView.as_view(), name='setting'),
 ]
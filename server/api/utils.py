@@ -35,21 +35,36 @@ def analyzeMethod(func):
     return inner
 
 
-def chunked(queryset, chunk_size=1000):
+def chunked(queryset, chunk_size=1000, key='pk'):
     """
     メモリに載りきらないような大量なデータを扱う時に、
     QuerySetを分割して実行するメソッド
+        OFFSETではなくkeyの値で次のチャンクを取得する(キーセットページネーション)ため、
+        後ろのチャンクになっても取得コストが変わらない。
+        values()のQuerySetの場合はkeyをvalues()に含めておく。
+
+        結果は常にkeyの昇順になる。(モデルのMeta.orderingは使わない)
+        別の順番を指定したQuerySetは、順番が変わってしまうためValueErrorにする。
     """
 
-    start = 0
+    if queryset.query.order_by and tuple(queryset.query.order_by) != (key,):
+        raise ValueError('chunked()は%sの順で返すため、order_by(%s)は指定できません。'
+                         % (key, ', '.join(map(str, queryset.query.order_by))))
+
+    last = None
     while True:
-        chunk = queryset[start: start + chunk_size]
-        for obj in chunk:
+        chunk = queryset.order_by(key)
+        if last is not None:
+            chunk = chunk.filter(**{key + '__gt': last})
+
+        count = 0
+        for obj in chunk[:chunk_size].iterator(chunk_size=chunk_size):
+            last = obj[key] if isinstance(obj, dict) else getattr(obj, key)
+            count += 1
             yield obj
-        if len(chunk) < chunk_size:
-            raise StopIteration
-        start += chunk_size
 
+        if count < chunk_size:
+            return
 
 
 def search_retweet_target(tweet):
@@ -6,6 +6,12 @@ from django.template.loader import render_to_string
 from django.conf import settings
 from django.db.models import Q
 from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.http import HttpResponseNotAllowed
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import posixpath
 import logging
 import re
 import requests
@@ -16,6 +22,8 @@ from rest_framework import generics, permissions, authentication
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework_jwt.settings import api_settings
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework import status, viewsets, filters
 from rest_framework.views import APIView
 from rest_framework.parsers import FileUploadParser
@@ -41,6 +49,7 @@ from .models import (
     ReadManagement,
     FollowRelationShip,
     RetweetRelationShip,
+    TrafficRollup,
 )
 from .permissions import (
     IsMyselfOrReadOnly,
@@ -56,6 +65,7 @@ from .filters import (
 )
 from .mixins import (
     GetLoginUserMixin,
+    SparseFieldsMixin,
 )
 
 from .utils import (
@@ -66,6 +76,63 @@ from .paginations import (
     StandardListResultSetPagination
 )
 
+from .caches import (
+    cache_response,
+    user_tag,
+)
+
+from .conditional import (
+    condition,
+    PROFILE,
+    VIEWER,
+)
+
+from .storage import (
+    is_content_addressed,
+)
+
+from .media import (
+    source_name,
+)
+
+from .sendfile import (
+    serve_file,
+)
+
+from .media_tokens import (
+    MEDIA_TOKEN_PARAM,
+    check_media_token,
+)
+
+from .uploads import (
+    UPLOAD_CHUNK_SIZE,
+    UploadError,
+    start_upload,
+    write_chunk,
+    parse_content_range,
+    attach_uploads,
+)
+from .models import UploadSession
+
+from .exports import (
+    SECTION_NAMES,
+    iter_user_export,
+    gzip_stream,
+)
+
+from .traffic import (
+    DIMENSIONS,
+    traffic_summary,
+)
+
+from .pool import (
+    pool_stats,
+)
+
+from ws.publisher import publisher
+from ws.outbox import outbox_stats
+from ws.tickets import WS_TICKET_MAX_AGE, issue_ticket
+
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
 from django.views.decorators.vary import vary_on_cookie
@@ -80,9 +147,10 @@ env.read_env(os.path.join(BASE_DIR, '.env'))
 
 
 
-class BaseListAPIView(generics.ListAPIView, GetLoginUserMixin):
+class BaseListAPIView(SparseFieldsMixin, generics.ListAPIView, GetLoginUserMixin):
     """
     getでリクエストが来たらlogin_userをセットしておく。
+    ?fields= で返すフィールドを選べる。(SparseFieldsMixin)
     """
 
     def get(self, request, *args, **kwargs):
@@ -95,7 +163,79 @@ class IndexView(generic.TemplateView):
     template_name = 'pages/index.html'
 
 
-class ProfileDetailView(generics.RetrieveAPIView, GetLoginUserMixin):
+# 公開ファイルの判定結果(メッセージの画像以外)のキャッシュ
+MEDIA_ACCESS_KEY = 'media_access:{0}'
+MEDIA_ACCESS_TIMEOUT = 60 * 5
+
+
+def _is_public_media(name):
+    """
+    プロフィール, ツイートから参照されているファイルか
+        メッセージの画像だけで使われているファイルは非公開にする。
+    """
+
+    key = MEDIA_ACCESS_KEY.format(name)
+    if cache.get(key):
+        return True
+
+    public = (
+        mUser.objects.filter(Q(icon=name) | Q(header=name)).exists()
+        or Tweet.objects.filter(images=name).exists()
+        or hTweetUpd.objects.filter(images=name).exists()
+        or not Message.objects.filter(image=name).exists()
+    )
+    if public:
+        cache.set(key, True, MEDIA_ACCESS_TIMEOUT)
+    return public
+
+
+def _can_access_media(request, name):
+    """
+    ルームのユーザーか
+        imgタグからは ?t= の署名(api.media_tokens)、fetchなどからはJWTのヘッダーで確認する。
+    """
+
+    token = request.GET.get(MEDIA_TOKEN_PARAM)
+    if token:
+        username = check_media_token(token, name)
+    else:
+        try:
+            auth = JSONWebTokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        username = auth[0].username if auth is not None else None
+    if username is None:
+        return False
+    return Message.objects.filter(image=name, room__users__username=username).exists()
+
+
+def serve_media(request, path):
+    """
+    メディアの配信
+        アクセスを確認して、転送はフロントのサーバーに任せる。(api.sendfile)
+        コンテンツアドレスのファイルは内容が変わらないため永続的にキャッシュさせる。
+    """
+
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+
+    name = posixpath.normpath(path).lstrip('/')
+    if any(part.startswith('.') for part in name.split('/')):
+        raise Http404
+
+    cache_control = 'public, max-age=31536000, immutable' if is_content_addressed(name) else 'public, no-cache'
+    if settings.MEDIA_PRIVATE_MESSAGES:
+        source = source_name(name)
+        if not _is_public_media(source):
+            if not _can_access_media(request, source):
+                # 存在も知らせない
+                raise Http404
+            cache_control = cache_control.replace('public', 'private')
+
+    return serve_file(request, name, settings.MEDIA_ROOT, cache_control)
+
+
+class ProfileDetailView(SparseFieldsMixin, generics.RetrieveAPIView, GetLoginUserMixin):
     """
     ユーザー毎のプロフィールを取得
     """
@@ -107,32 +247,44 @@ class ProfileDetailView(generics.RetrieveAPIView, GetLoginUserMixin):
     serializer_class = ProfileSerializer
     lookup_field = 'username'
 
+    # 返すフィールド
+    detail_fields = [
+        'pk',
+        'username',
+        'created_at',
+        'header',
+        'header_variants',
+        'introduction',
+        'icon',
+        'icon_variants',
+        'followees',
+        'followers',
+        'followees_count',
+        'followers_count',
+        'tweet',
+        'entry',
+        'setting',
+        'tweet_limit_level',
+        'isBlocked',
+        'isPrivate',
+        'isMute',
+        'isBlock',
+        'isFollow',
+        'isSendFollowRequest',
+    ]
+
+    def get_queryset(self):
+        return self.plan_queryset(super().get_queryset(), self.detail_fields)
+
+    @condition(lambda view, request, kwargs: [
+        (PROFILE, kwargs['username']),
+        (VIEWER, request.query_params.get('loginUser') or 'anon'),
+    ])
+    @cache_response(lambda view, request, kwargs: user_tag(kwargs['username']))
     def retrieve(self, request, *args, **kwargs):
         self.set_login_user(request)
         instance = self.get_object()
-        fields = [
-            'pk',
-            'username',
-            'created_at',
-            'header',
-            'introduction',
-            'icon',
-            'followees',
-            'followers',
-            'followees_count',
-            'followers_count',
-            'tweet',
-            'entry',
-            'setting',
-            'tweet_limit_level',
-            'isBlocked',
-            'isPrivate',
-            'isMute',
-            'isBlock',
-            'isFollow',
-            'isSendFollowRequest',
-        ]
-        serializer = self.get_serializer(instance, fields=fields)
+        serializer = self.get_serializer(instance, fields=self.detail_fields)
         return Response(serializer.data)
 
 
@@ -153,7 +305,12 @@ class ProfileUpdateView(generics.RetrieveUpdateDestroyAPIView):
         logger.info(serializer.is_valid())
         logger.info(serializer.errors)
         if serializer.is_valid():
-            self.perform_update(serializer)
+            try:
+                with transaction.atomic():
+                    self.perform_update(serializer)
+                    attach_uploads(request.data, request.user, serializer.instance, ['icon', 'header'])
+            except UploadError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -249,7 +406,6 @@ class SearchView(BaseListAPIView):
         queryset = self.filter_queryset(self.get_queryset())
 
         if searchFlg != self.USER:
-            page = self.paginate_queryset(queryset)
             fields = [
                 'pk',
                 'author',
@@ -266,9 +422,12 @@ class SearchView(BaseListAPIView):
                 'isRetweeted',
                 'retweet_count',
                 'userIcon',
+                'userIcon_variants',
             ]
             if searchFlg == self.MEDIA:
                 fields.append('images')
+                fields.append('image_variants')
+            page = self.paginate_queryset(self.plan_queryset(queryset, fields))
             if page is not None:
                 serializer = self.get_serializer(
                     page,
@@ -283,18 +442,20 @@ class SearchView(BaseListAPIView):
             )
             return Response(serializer.data)
         else:
-            page = self.paginate_queryset(queryset)
             fields = [
                 'pk',
                 'username',
                 'header',
+                'header_variants',
                 'introduction',
                 'icon',
+                'icon_variants',
                 'isBlocked',
                 'isPrivate',
                 'isFollow',
                 'isSendFollowRequest',
             ]
+            page = self.paginate_queryset(self.plan_queryset(queryset, fields))
             if page is not None:
                 serializer = self.get_serializer(
                     page,
@@ -328,6 +489,202 @@ class SettingView(generics.RetrieveUpdateAPIView, GetLoginUserMixin):
     # lookup_field = 'target__username'
 
 
+class ExportView(APIView):
+    """
+    ログインユーザーのデータをNDJSONでストリーミングダウンロードするView
+
+        Parameters
+        --------------------------------
+        compress : gzipを指定するとgzip圧縮して返す
+        sections : 出力する種類をカンマ区切りで指定(tweet,like,message,entry,notification)
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        sections = None
+        if 'sections' in request.query_params:
+            sections = [i.strip() for i in request.query_params['sections'].split(',') if i.strip()]
+            if any(i not in SECTION_NAMES for i in sections):
+                return Response({'sections': SECTION_NAMES}, status=status.HTTP_400_BAD_REQUEST)
+
+        stream = iter_user_export(request.user, sections=sections)
+        filename = request.user.username + '.ndjson'
+        content_type = 'application/x-ndjson'
+
+        if request.query_params.get('compress') == 'gzip':
+            stream = gzip_stream(stream)
+            filename += '.gz'
+            content_type = 'application/gzip'
+
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+        return response
+
+
+class UploadView(APIView):
+    """
+    分割アップロードを開始するView
+
+        Parameters
+        --------------------------------
+        filename : ファイル名
+        size : ファイル全体のバイト数
+        content_type : MIMEタイプ
+
+        トークンと1回に送るチャンクのサイズを返す。
+        チャンクは PUT upload/<token>/ で Content-Range を付けて送る。
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            session = start_upload(
+                request.user,
+                request.data.get('filename', ''),
+                int(request.data.get('size', 0)),
+                request.data.get('content_type', ''),
+            )
+        except (UploadError, ValueError) as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'token': session.token,
+            'offset': 0,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+        }, status=status.HTTP_201_CREATED)
+
+
+class UploadDetailView(APIView):
+    """
+    分割アップロードのチャンクを受け取るView
+
+        GET : 受信済みのバイト数(再開する位置)と状態を返す
+        PUT : チャンクを書き込む。本文はファイルのバイト列そのもの。
+            開始位置は Content-Range (bytes 0-1023/4096) か ?offset= で指定する。
+            位置が合わない場合は409と再開する位置を返す。
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_session(self, request, token):
+        try:
+            return UploadSession.objects.get(token=token, owner=request.user)
+        except UploadSession.DoesNotExist:
+            raise Http404
+
+    def get(self, request, token, *args, **kwargs):
+        session = self.get_session(request, token)
+        return Response(self.get_state(session))
+
+    def put(self, request, token, *args, **kwargs):
+        session = self.get_session(request, token)
+        try:
+            if 'HTTP_CONTENT_RANGE' in request.META:
+                offset = parse_content_range(request.META['HTTP_CONTENT_RANGE'])
+            else:
+                offset = int(request.query_params.get('offset', session.received))
+            write_chunk(session, offset, request.body)
+        except UploadError as e:
+            if e.offset is not None:
+                return Response(dict(self.get_state(session), detail=str(e)), status=status.HTTP_409_CONFLICT)
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(self.get_state(session))
+
+    def get_state(self, session):
+        return {
+            'token': session.token,
+            'offset': session.received,
+            'size': session.size,
+            'status': session.get_status_display(),
+        }
+
+
+class TrafficView(APIView):
+    """
+    集計済みのアクセス数を返す管理者用のView(ダッシュボード用)
+
+        Parameters
+        --------------------------------
+        granularity : hour / day
+        since, until : 期間(ISO 8601)。sinceが無ければ直近の24時間(hour), 30日(day)
+        group_by : 分けて返す項目をカンマ区切りで指定(page,device,browser,language)
+        page, device, browser, language : 絞り込み
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        granularity = params.get('granularity', TrafficRollup.HOUR)
+        if granularity not in (TrafficRollup.HOUR, TrafficRollup.DAY):
+            return Response({'granularity': [TrafficRollup.HOUR, TrafficRollup.DAY]}, status=status.HTTP_400_BAD_REQUEST)
+
+        group_by = [i.strip() for i in params.get('group_by', '').split(',') if i.strip()]
+        if any(i not in DIMENSIONS for i in group_by):
+            return Response({'group_by': DIMENSIONS}, status=status.HTTP_400_BAD_REQUEST)
+
+        period = {}
+        for name in ('since', 'until'):
+            if name in params:
+                period[name] = parse_datetime(params[name])
+                if period[name] is None:
+                    return Response({name: 'ISO 8601の日時を指定してください。'}, status=status.HTTP_400_BAD_REQUEST)
+                if timezone.is_naive(period[name]):
+                    period[name] = timezone.make_aware(period[name])
+
+        filters = {name: params[name] for name in DIMENSIONS if name in params}
+        rows = traffic_summary(granularity, group_by=group_by, filters=filters, **period)
+        return Response(list(rows))
+
+
+class WebsocketTicketView(APIView):
+    """
+    websocket(ws/?ticket=)に接続するためのチケットを返すView(ws.tickets)
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        return Response({
+            'ticket': issue_ticket(request.user),
+            'expires_in': WS_TICKET_MAX_AGE,
+        })
+
+
+class WebsocketStatsView(APIView):
+    """
+    このプロセスのwebsocketの送信状況を返す管理者用のView
+
+        publisher : 同期のコードから送るキュー(ws.publisher)
+        outbox : 接続毎の送信キュー(ws.outbox)
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'publisher': publisher.stats(),
+            'outbox': outbox_stats(),
+        })
+
+
+class DatabaseStatsView(APIView):
+    """
+    このプロセスのコネクションプール(api.pool)のメトリクスを返す管理者用のView
+        プールを使っていない(DB_POOL_SIZE=0, PostgreSQL以外)場合は空。
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(pool_stats())
+
+
 class NewsView(generics.ListAPIView):
     permission_classes = (permissions.AllowAny,)
 
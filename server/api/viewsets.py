@@ -1,27 +1,33 @@
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.views import generic
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.db.models import Q
 from django.contrib import messages
 from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import logging
 import re
 from rest_framework import generics, permissions, authentication
 from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 from rest_framework_jwt.settings import api_settings
 from rest_framework import status, viewsets, filters
 from rest_framework.views import APIView
 from rest_framework.parsers import FileUploadParser
 from .serializers import (
+    DynamicFieldsModelSerializer,
     ProfileSerializer,
     TweetSerializer,
     EntrySerializer,
     RoomSerializer,
     MessageSerializer,
     NotificationSerializer,
-    NotificationCountSerializer
+    NotificationCountSerializer,
+    MessageNotificationSerializer,
+    HashTagSerializer,
 )
 from .models import (
     mUser,
@@ -58,6 +64,7 @@ from .filters import (
 
 from .mixins import (
     GetLoginUserMixin,
+    SparseFieldsMixin,
 )
 
 from .utils import (
@@ -70,16 +77,107 @@ from .utils import (
     is_base_tweet,
 )
 
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
-from django.views.decorators.vary import vary_on_cookie
+from .renderers import (
+    STREAM_CHUNK_SIZE,
+    stream_json_list,
+)
+
+from .caches import (
+    cache_response,
+    entry_read_tag,
+    USER,
+    TWEET,
+    ENTRY,
+    SETTING,
+)
+
+from .uploads import (
+    UploadError,
+    attach_uploads,
+)
+
+from .inbox import (
+    mark_all_read,
+)
+
+from .archive import (
+    ARCHIVE_PAGE_SIZE,
+    fetch_archived_page,
+)
+
+from .hashtags import (
+    normalize_tag,
+    tagged_tweets,
+    mentioned_tweets,
+    popular_tags,
+)
+
+from .conditional import (
+    condition,
+    invalidate_validators,
+    validator_tag,
+    FEED,
+    PROFILE,
+    VIEWER,
+    INFO,
+)
 
 
-class BaseModelViewSet(viewsets.ModelViewSet, GetLoginUserMixin):
+def tweet_list_validators(view, request, kwargs):
+    """
+    ツイート一覧のバリデーター
+        ホーム画面(tweetListFlg=4)とプロフィール画面の一覧だけが対象。
+        検索結果は対象外。
+    """
+
+    params = request.query_params
+    target_user = params.get('targetUser')
+    if not target_user or 'searchText' in params:
+        return None
+
+    scope = FEED if params.get('tweetListFlg') == '4' else PROFILE
+    validators = [(scope, target_user)]
+    if params.get('loginUser'):
+        validators.append((VIEWER, params['loginUser']))
+    return validators
+
+
+def tweet_list_tags(view, request, kwargs):
+    """
+    ツイート一覧のレスポンスキャッシュのタグ
+        ホーム画面, プロフィール画面の一覧はバリデーターと同じユーザー毎のタグにする。
+        (そのユーザー, フォローしているユーザー, 閲覧者の変更でだけ無効になる)
+        検索結果など対象のユーザーが決まらない一覧は全体のタグにする。
+    """
+
+    validators = tweet_list_validators(view, request, kwargs)
+    if validators is None:
+        return [TWEET, USER, SETTING]
+    return [validator_tag(scope, ident) for scope, ident in validators]
+
+
+def entry_list_tags(view, request, kwargs):
+    """
+    記事一覧のレスポンスキャッシュのタグ(is_readは閲覧者の既読で変わる)
+    """
+    return [ENTRY, entry_read_tag(request.query_params.get('loginUser') or 'anon')]
+
+
+def info_list_validators(view, request, kwargs):
+    """
+    通知一覧のバリデーター
+    """
+
+    login_user = request.query_params.get('loginUser')
+    return [(INFO, login_user)] if login_user else None
+
+
+class BaseModelViewSet(SparseFieldsMixin, viewsets.ModelViewSet, GetLoginUserMixin):
     """
     ModelViewSetのBaseクラス
         ModelViewSetでloginUserを取得する事が多いので
         GetLoginUserMixinを継承し、このクラスの継承先で使用
+        ?fields= で返すフィールドを選べる。(SparseFieldsMixin)
     """
 
     def list(self, request, *args, **kwargs):
@@ -87,6 +185,7 @@ class BaseModelViewSet(viewsets.ModelViewSet, GetLoginUserMixin):
         getでリクエストが来たらlogin_userをセット
         response=Trueだったらレスポンスも返す
         paginate=Trueだったらページネーションありのレスポンスを返す
+        stream=Trueだったらページネーションなしの一覧を少しずつ返す
         """
         self.set_login_user(request)
 
@@ -94,7 +193,7 @@ class BaseModelViewSet(viewsets.ModelViewSet, GetLoginUserMixin):
             return self.send_response_(**kwargs)
 
     def send_response_(self, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+        queryset = self.plan_queryset(self.filter_queryset(self.get_queryset()))
 
         """
         paginate=Trueだったらページネーションありのレスポンスを返す
@@ -105,9 +204,69 @@ class BaseModelViewSet(viewsets.ModelViewSet, GetLoginUserMixin):
                 serializer = self.get_serializer(page, many=True)
                 return self.get_paginated_response(serializer.data)
 
+        if 'stream' in kwargs and kwargs['stream'] == True:
+            return self.get_streaming_response(queryset)
+
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    def get_before(self):
+        """
+        ?before= の日時(続きを読む時)。無ければNone
+        """
+
+        value = self.request.query_params.get('before')
+        if not value:
+            return None
+
+        before = parse_datetime(value)
+        if before is None:
+            raise ParseError('before is invalid')
+        if timezone.is_naive(before):
+            before = timezone.make_aware(before)
+        return before
+
+    def get_archived_response(self, name, key, before=None, serializer_class=None, newest_first=False):
+        """
+        アーカイブした行をbeforeより前から1ページ分返す。(api.archive)
+            読むバケットはページの分だけなので、アーカイブの量によらない。
+            next_before : 続きを読む時の ?before= (無ければNone)
+        """
+
+        limit = self.paginator.get_page_size(self.request) or ARCHIVE_PAGE_SIZE
+        objs, next_before = fetch_archived_page(name, key, before=before, limit=limit)
+        if newest_first:
+            objs.reverse()
+
+        if serializer_class is None:
+            serializer = self.get_serializer(objs, many=True)
+        else:
+            serializer = serializer_class(objs, many=True, context=self.get_serializer_context())
+        return Response({
+            'results': serializer.data,
+            'next_before': next_before.isoformat() if next_before else None,
+        }, status=status.HTTP_200_OK)
+
+    def get_streaming_response(self, queryset, serializer_class=None, context=None, **kwargs):
+        """
+        一覧をJSONの配列でストリーミングして返す。
+            QuerySetはiteratorでSTREAM_CHUNK_SIZE件ずつ取得し、
+            取得した分だけシリアライズしてエンコードする。
+        """
+
+        serializer_class = serializer_class or self.get_serializer_class()
+        context = self.get_serializer_context() if context is None else context
+        if issubclass(serializer_class, DynamicFieldsModelSerializer):
+            kwargs['fields'] = self.get_requested_fields(kwargs.get('fields'))
+
+        def serialize(objs):
+            return serializer_class(objs, many=True, context=context, **kwargs).data
+
+        return StreamingHttpResponse(
+            stream_json_list(queryset.iterator(chunk_size=STREAM_CHUNK_SIZE), serialize),
+            content_type='application/json',
+        )
+
     def return_tweet_list(self, login_user):
         """
         home画面で表示するツイート一覧を返す
@@ -124,12 +283,13 @@ class BaseModelViewSet(viewsets.ModelViewSet, GetLoginUserMixin):
                 retweet_user__in=login_user.followees.all())).exclude(isReply=True)
         res = my_tweets.union(followees_tweets).union(followees_retweets).order_by('-created_at')
 
+        fields = self.get_requested_fields()
         page = self.paginate_queryset(res)
         if page is not None:
-            serializer = TweetSerializer(page, many=True)
+            serializer = TweetSerializer(page, many=True, fields=fields)
             return self.get_paginated_response(serializer.data)
 
-        return Response(TweetSerializer(res, many=True).data)
+        return Response(TweetSerializer(res, many=True, fields=fields).data)
 
 
 class TweetViewSet(BaseModelViewSet):
@@ -157,6 +317,8 @@ class TweetViewSet(BaseModelViewSet):
     filter_class = TweetFilter
     parser_class = (FileUploadParser)
 
+    @condition(tweet_list_validators)
+    @cache_response(tweet_list_tags)
     def list(self, request, *args, **kwargs):
         return super().list(request, paginate=True,
                             response=True, *args, **kwargs)
@@ -172,7 +334,12 @@ class TweetViewSet(BaseModelViewSet):
         serializer = self.get_serializer(data=request.data)
 
         if serializer.is_valid():
-            self.perform_create(serializer)
+            try:
+                with transaction.atomic():
+                    self.perform_create(serializer)
+                    attach_uploads(request.data, request.user, serializer.instance, ['images'])
+            except UploadError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
             headers = self.get_success_headers(serializer.data)
             return Response(self.get_serializer(serializer.instance).data, status=status.HTTP_201_CREATED, headers=headers)
 
@@ -390,17 +557,85 @@ class TweetViewSet(BaseModelViewSet):
             'isRetweet',
             'reply',
             'userIcon',
+            'userIcon_variants',
             'isBlocked',
         ]
 
         context = {
             'view': self
         }
-        serializer = TweetSerializer(tweet, fields=fields, context=context)
+        serializer = TweetSerializer(tweet, fields=self.get_requested_fields(fields), context=context)
 
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+    @action(methods=['get'], detail=False)
+    def hashtag(self, request):
+        """
+        ハッシュタグが付いたツイートを新しい順に返すアクション
+            ?tag= : タグ(#は無くてもいい)
+            ?before= : この日時より前のツイート(続きを読む時)
+        """
+
+        self.set_login_user(request)
+
+        tag = request.query_params.get('tag', '').strip().lstrip('#＃')
+        if not tag:
+            return Response({'detail': 'tag is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        tweets = self.exclude_hidden(tagged_tweets(normalize_tag(tag), before=self.get_before()))
+        return self.tweet_page_response(tweets)
+
+
+    @action(methods=['get'], detail=False)
+    def mentions(self, request):
+        """
+        ログインユーザーがメンションされたツイートを新しい順に返すアクション
+        """
+
+        self.set_login_user(request)
+
+        if not request.user.is_authenticated:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        tweets = self.exclude_hidden(mentioned_tweets(request.user))
+        return self.tweet_page_response(tweets)
+
+
+    @action(methods=['get'], detail=False)
+    def popularTags(self, request):
+        """
+        ツイートの件数が多いハッシュタグを返すアクション
+        """
+
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 50)
+        except ValueError:
+            return Response({'detail': 'limit is invalid'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(HashTagSerializer(popular_tags(limit), many=True).data, status=status.HTTP_200_OK)
+
+
+    def exclude_hidden(self, tweets):
+        """
+        ログインユーザーをブロックしているユーザー, 非公開のユーザーのツイートを省く。
+        """
+
+        hidden = Q(author__msetting__isPrivate=True)
+        if self.get_login_user() is not None:
+            hidden |= Q(author__msetting__block_list__username=self.get_login_user())
+        return tweets.exclude(hidden)
+
+
+    def tweet_page_response(self, tweets):
+        fields = self.get_requested_fields()
+        page = self.paginate_queryset(self.plan_queryset(tweets))
+        if page is not None:
+            serializer = TweetSerializer(page, many=True, fields=fields, context={'view': self})
+            return self.get_paginated_response(serializer.data)
+
+        return Response(TweetSerializer(tweets, many=True, fields=fields, context={'view': self}).data)
+
+
 
 class mUserViewSet(BaseModelViewSet):
     """
@@ -420,17 +655,16 @@ class mUserViewSet(BaseModelViewSet):
     serializer_class = ProfileSerializer
 
 
-    @method_decorator(cache_page(60*60*2))
-    @method_decorator(vary_on_cookie)
+    @cache_response(USER)
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
-        page = self.paginate_queryset(queryset)
-        fields = [
+        fields = self.get_requested_fields([
             'pk',
             'username',
             'email',
             'address',
-        ]
+        ])
+        queryset = self.plan_queryset(self.filter_queryset(self.get_queryset()), fields)
+        page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = ProfileSerializer(page, many=True, fields=fields)
             return self.get_paginated_response(serializer.data)
@@ -586,9 +820,11 @@ class mUserViewSet(BaseModelViewSet):
             'address',
             'introduction',
             'header',
+            'header_variants',
             'icon',
+            'icon_variants',
         ]
-        return Response(ProfileSerializer(mute_list, fields=fields, many=True).data)
+        return self.get_streaming_response(mute_list, ProfileSerializer, context={'view': self}, fields=fields)
 
     @action(methods=['post'], detail=False)
     def blockList(self, request):
@@ -605,9 +841,11 @@ class mUserViewSet(BaseModelViewSet):
             'address',
             'introduction',
             'header',
+            'header_variants',
             'icon',
+            'icon_variants',
         ]
-        return Response(ProfileSerializer(mute_list, fields=fields, many=True).data)
+        return self.get_streaming_response(mute_list, ProfileSerializer, context={'view': self}, fields=fields)
 
     @action(methods=['post'], detail=False)
     def followRequest(self, request):
@@ -709,7 +947,7 @@ class RoomViewSet(BaseModelViewSet):
 
     def list(self, request, *args, **kwargs):
 
-        return super().list(request, response=True, *args, **kwargs)
+        return super().list(request, response=True, stream=True, *args, **kwargs)
 
     def create(self, request, *args, **kwargs):
         self.login_user = request.data['loginUser'] if 'loginUser' in request.data else None
@@ -753,7 +991,7 @@ class MessageViewSet(BaseModelViewSet):
 
     def list(self, request, *args, **kwargs):
         logger.info('メッセージ一覧取得')
-        return super().list(request, response=True, *args, **kwargs)
+        return super().list(request, response=True, stream=True, *args, **kwargs)
         # self.set_login_user(request)
         # queryset = self.filter_queryset(self.get_queryset())
         # serializer = self.get_serializer(queryset, many=True)
@@ -761,14 +999,23 @@ class MessageViewSet(BaseModelViewSet):
 
     @action(methods=['GET'], detail=False)
     def get_room_msg(self, request, pk=None):
+        """
+        ルームのメッセージを返すアクション
+            ?before= : アーカイブした古いメッセージをこの日時より前から1ページ分返す。
+                       (無ければアーカイブは読まない)
+        """
+
         logger.info('来たー')
         logger.info(request.query_params)
         self.set_login_user(request)
         logger.info(self.login_user)
         login_user = mUser.objects.get(username=self.login_user)
-        queryset = Message.objects.filter(
-            room=Room.objects.get(id=request.query_params['id'])
-        )
+        room = Room.objects.get(id=request.query_params['id'])
+        before = self.get_before()
+        if before is not None:
+            return self.get_archived_response('message', room.id, before)
+
+        queryset = Message.objects.filter(room=room)
         serializer = self.get_serializer(queryset, many=True)
 
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -797,6 +1044,20 @@ class MessageViewSet(BaseModelViewSet):
 
         return Response(status=status.HTTP_200_OK)
 
+    @action(methods=['GET'], detail=False, permission_classes=(permissions.IsAuthenticated,))
+    def archived_notice(self, request):
+        """
+        アーカイブした古いメッセージの通知を新しい順に返すアクション
+            ?before= : この日時より前(続きを読む時)
+            他のユーザーの通知を読めないよう、loginUserではなく認証したユーザーで絞る。
+        """
+
+        self.login_user = request.user.username
+        return self.get_archived_response(
+            'message_notification', request.user.pk, self.get_before(),
+            serializer_class=MessageNotificationSerializer, newest_first=True,
+        )
+
     def remove_msg_notice(self, user, room):
         notifications = MessageNotification.objects.filter(
             receiver=mUser.objects.get(username=user),
@@ -816,6 +1077,7 @@ class EntryViewSet(BaseModelViewSet):
     serializer_class = EntrySerializer
     filter_class = EntryFilter
 
+    @cache_response(entry_list_tags)
     def list(self, request, *args, **kwargs):
         return super().list(request, response=True,
                             paginate=True, *args, **kwargs)
@@ -878,6 +1140,7 @@ class InfoViewSet(BaseModelViewSet):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     queryset = Notification.objects.all().order_by('-created_at')
 
+    @condition(info_list_validators)
     def list(self, request, *args, **kwargs):
         super().list(request, *args, **kwargs)
         self.serializer_class = NotificationSerializer
@@ -887,13 +1150,25 @@ class InfoViewSet(BaseModelViewSet):
             queryset = self.get_queryset().filter(
                 receive_user=mUser.objects.get(username=self.login_user)
             )
-        page = self.paginate_queryset(queryset)
+        page = self.paginate_queryset(self.plan_queryset(queryset))
         if page is not None:
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    @action(methods=['get'], detail=False, permission_classes=(permissions.IsAuthenticated,))
+    def archived(self, request):
+        """
+        アーカイブした古い通知を新しい順に返すアクション
+            ?before= : この日時より前(続きを読む時)
+            他のユーザーの通知を読めないよう、loginUserではなく認証したユーザーで絞る。
+        """
+
+        self.login_user = request.user.username
+        self.serializer_class = NotificationSerializer
+        return self.get_archived_response('notification', request.user.pk, self.get_before(), newest_first=True)
+
     @action(methods=['get'], detail=False)
     def getInfoCnt(self, request):
         self.set_login_user(request)
@@ -904,18 +1179,15 @@ class InfoViewSet(BaseModelViewSet):
 
     @action(methods=['get'], detail=False)
     def readInfo(self, request):
+        """
+        通知を全て既読にするアクション
+            既読日時を更新するだけなので、未読の件数によらず1行の更新で済む。
+        """
+
         self.set_login_user(request)
-        self.serializer_class = NotificationSerializer
 
-        notifications = Notification.objects.filter(
-            receive_user=mUser.objects.get(username=self.login_user),
-            readed=False
-        )
-        infos = []
-        for notification in notifications:
-            notification.readed = True
-            infos.append(notification)
-        Notification.objects.bulk_update(infos, fields=['readed'])
+        read_at = mark_all_read(mUser.objects.get(username=self.login_user))
+        # updateはsignalsが飛ばないためここで無効化する
+        invalidate_validators(INFO, self.login_user)
 
-        serializer = self.get_serializer(notifications, many=True)
-        return Response(serializer.data)
+        return Response({'status': 'success', 'last_read_at': read_at}, status=status.HTTP_200_OK)
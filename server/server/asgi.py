@@ -8,6 +8,13 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
 
 import os
+
+# スレッド数について
+#   asgiref 3.3以降のsync_to_async(thread_sensitive=True)は、同期のView(channelsのAsgiHandler)を
+#   プロセスで1つのスレッドで順に実行するため、executorを差し替えても並列にならない。
+#   同期のViewの並列数はdaphneのプロセス数で増やす。
+#   websocketのDBアクセスはws.consumers.db_executor(ASGI_THREADS)で並列に実行する。
+
 import django
 # from django.core.asgi import get_asgi_application
 from channels.routing import get_default_application
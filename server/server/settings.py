@@ -12,7 +12,6 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import os
 import datetime
-import logging
 import environ
 import dj_database_url
 
@@ -75,6 +74,10 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'api.paginations.StandardResultSetPagination',
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.AnonRateThrottle',
@@ -86,14 +89,27 @@ REST_FRAMEWORK = {
     }
 }
 
-# CACHES = {
-#     'default': {
-#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-#         'LOCATION': '127.0.0.1:11211',
-#         # 'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-#         # 'LOCATION': 'cache',
-#     }
-# }
+# キャッシュ設定
+#   CACHE_LOCATIONが設定されていればmemcached(CACHE_BACKENDで変更可)
+#   設定されていなければローカルメモリ(開発用)
+CACHE_LOCATION = os.environ.get('CACHE_LOCATION')
+if CACHE_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.memcached.MemcachedCache'),
+            'LOCATION': CACHE_LOCATION.split(','),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'bandue',
+        }
+    }
+
+# レスポンスキャッシュの有効期間(秒)。無効化はsignalsで行う。
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get('RESPONSE_CACHE_TIMEOUT', 60 * 10))
 
 
 # JWT認証設定
@@ -115,26 +131,43 @@ JWT_AUTH = {
 #     }
 # }
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('172.17.0.1', 6379)],
+# チャンネルレイヤー(ws.layers)
+#   local : プロセス内(1プロセスで動かす場合, 開発, テスト。Redis不要)
+#   redis : Redis(同じタイミングのgroup_sendはまとめて送る)
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'redis')
+CHANNEL_LAYER_CAPACITY = int(os.environ.get('CHANNEL_LAYER_CAPACITY', 100))
+if CHANNEL_LAYER_BACKEND == 'local':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'ws.layers.LocalChannelLayer',
+            'CONFIG': {
+                'capacity': CHANNEL_LAYER_CAPACITY,
+            },
         },
-        # 'CONFIG': {
-        #     'hosts':[os.environ.get('REDIS_URL', 'redis://localhost:6379')],
-        # },
-    },
-}
-if not DEBUG:
-    CHANNEL_LAYERS['default'].update({
-        'CONFIG': {
-            'hosts':[os.environ.get('REDIS_URL', 'redis://localhost:6379')],
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'ws.layers.BatchedRedisChannelLayer',
+            'CONFIG': {
+                "hosts": [('172.17.0.1', 6379)],
+                'capacity': CHANNEL_LAYER_CAPACITY,
+            },
+            # 'CONFIG': {
+            #     'hosts':[os.environ.get('REDIS_URL', 'redis://localhost:6379')],
+            # },
         },
-    })
+    }
+    if not DEBUG:
+        CHANNEL_LAYERS['default']['CONFIG'].update({
+            'hosts':[os.environ.get('REDIS_URL', 'redis://localhost:6379')],
+        })
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.ReplicaRoutingMiddleware',
+    'api.middleware.SlowQueryMiddleware',
+    'api.middleware.AccessLogMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -166,6 +199,27 @@ TEMPLATES = [
 WSGI_APPLICATION = 'server.wsgi.application'
 ASGI_APPLICATION = 'server.routing.application'
 
+# 1つのwebsocket(ws/)で購読できるストリームの上限
+WS_MAX_SUBSCRIPTIONS = int(os.environ.get('WS_MAX_SUBSCRIPTIONS', 50))
+# ws/?ticket= のチケット(api/ws-ticket/)の有効期間
+WS_TICKET_MAX_AGE = int(os.environ.get('WS_TICKET_MAX_AGE', 30))
+# 同期のコードからwebsocketへ送るキュー(ws.publisher)
+WS_PUBLISH_QUEUE_SIZE = int(os.environ.get('WS_PUBLISH_QUEUE_SIZE', 10000))
+WS_PUBLISH_BATCH_SIZE = int(os.environ.get('WS_PUBLISH_BATCH_SIZE', 100))
+# websocketの接続毎の送信キューの上限(超えたらイベントの種類毎にまとめる, 捨てる, 切断する)
+WS_OUTBOX_SIZE = int(os.environ.get('WS_OUTBOX_SIZE', 100))
+
+# ホームのタイムラインの新着をwebsocketで送る(api.timeline)
+TIMELINE_PUSH = os.environ.get('TIMELINE_PUSH', 'true').lower() in ('1', 'true', 'yes')
+TIMELINE_PREVIEW_LENGTH = int(os.environ.get('TIMELINE_PREVIEW_LENGTH', 80))
+# フォロワーが多いユーザーは何件ずつ送るか
+TIMELINE_FANOUT_BATCH = int(os.environ.get('TIMELINE_FANOUT_BATCH', 500))
+TIMELINE_FANOUT_WORKERS = int(os.environ.get('TIMELINE_FANOUT_WORKERS', 1))
+
+# 1ツイートから取り出すハッシュタグ, メンションの最大数(api.hashtags)
+HASHTAG_MAX_PER_TWEET = int(os.environ.get('HASHTAG_MAX_PER_TWEET', 10))
+MENTION_MAX_PER_TWEET = int(os.environ.get('MENTION_MAX_PER_TWEET', 10))
+
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
@@ -180,6 +234,68 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 db_from_env = dj_database_url.config(default=DATABASE_URL, ssl_require=True)
 DATABASES['default'].update(db_from_env)
 
+# 読み取りレプリカ(カンマ区切りのURL)
+#   ローカルでは sqlite:////path/to/replica.sqlite3 を指定し、
+#   python manage.py copy_to_replicas でプライマリの内容を複製して確認する。
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+]
+for i, url in enumerate(DATABASE_REPLICA_URLS):
+    replica = dj_database_url.parse(url, ssl_require=not url.startswith('sqlite'))
+    replica['TEST'] = {'MIRROR': 'default'}
+    DATABASES['replica{0}'.format(i + 1)] = replica
+
+DATABASE_ROUTERS = ['api.db_routers.ReplicaRouter']
+
+# 書き込んだユーザーをプライマリに固定する秒数
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+# 書き込んでもプライマリに固定しないモデル(セッション, アクセスログ, 集計など)
+REPLICA_PIN_EXCLUDED_MODELS = [
+    'sessions.session',
+    'api.maccesslog',
+    'api.mediablob',
+    'api.trafficrollup',
+    'api.rollupstate',
+    'api.archivebucket',
+]
+
+# 遅いSQLの記録(python manage.py advise_indexes で確認する)
+SLOW_QUERY_CAPTURE = os.environ.get('SLOW_QUERY_CAPTURE', 'false').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 100))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', os.path.join(BASE_DIR, 'slow_queries.ndjson'))
+
+# アクセスログ(mAccessLog)をまとめて書き込む(api.access_logs)
+ACCESS_LOG_ENABLED = os.environ.get('ACCESS_LOG_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# 記録する割合(0.1なら10%)
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', 1.0))
+ACCESS_LOG_BATCH_SIZE = int(os.environ.get('ACCESS_LOG_BATCH_SIZE', 200))
+ACCESS_LOG_FLUSH_SECONDS = float(os.environ.get('ACCESS_LOG_FLUSH_SECONDS', 5))
+# 書き込みが追い付かずにこれ以上溜まったら捨てる
+ACCESS_LOG_MAX_BUFFER = int(os.environ.get('ACCESS_LOG_MAX_BUFFER', 5000))
+# ロードバランサーの後ろではX-Forwarded-ForのIPを使う
+ACCESS_LOG_TRUST_FORWARDED = os.environ.get('ACCESS_LOG_TRUST_FORWARDED', 'false').lower() in ('1', 'true', 'yes')
+# アクセスログの集計(python manage.py rollup_traffic)
+TRAFFIC_ROLLUP_BATCH_SIZE = int(os.environ.get('TRAFFIC_ROLLUP_BATCH_SIZE', 50000))
+# 書き込んだ時刻(mAccessLog.logged_at)がこの秒数より新しい行から後ろは集計しない(書き込み中の行を飛ばさないため)
+TRAFFIC_ROLLUP_LAG = int(os.environ.get('TRAFFIC_ROLLUP_LAG', 60))
+
+# websocketのconsumerがDBにアクセスするスレッド数(ws.consumers.db_executor)
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 8))
+
+# コネクションプール(PostgreSQLのみ, 0で無効)
+#   ASGI_THREADS + 1(同期のViewのスレッド)以上にしておく。
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+if DB_POOL_SIZE:
+    for database in DATABASES.values():
+        if database['ENGINE'] in ('django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2'):
+            database['ENGINE'] = 'api.db_backends.postgresql_pool'
+            database['CONN_MAX_AGE'] = 0
+            database['POOL'] = {
+                'SIZE': DB_POOL_SIZE,
+                'TIMEOUT': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+                'CHECK_INTERVAL': int(os.environ.get('DB_POOL_CHECK_INTERVAL', 30)),
+            }
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -225,6 +341,43 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# 分割アップロード(api.uploads)
+UPLOAD_STAGING_DIR = os.environ.get('UPLOAD_STAGING_DIR', os.path.join(BASE_DIR, 'upload_staging'))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))  # DATA_UPLOAD_MAX_MEMORY_SIZE以下にする
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 20 * 1024 * 1024))
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 2))
+
+# アップロードを内容のハッシュで保存して重複を排除する(api.storage)
+MEDIA_CONTENT_ADDRESSED = os.environ.get('MEDIA_CONTENT_ADDRESSED', 'true').lower() in ('1', 'true', 'yes')
+if MEDIA_CONTENT_ADDRESSED:
+    DEFAULT_FILE_STORAGE = 'api.storage.CASFileSystemStorage'
+# 参照されなくなったファイルを残す秒数(python manage.py purge_blobs)
+BLOB_PURGE_GRACE = int(os.environ.get('BLOB_PURGE_GRACE', 60 * 60))
+
+# アップロード画像のサイズ違いを作るワーカープロセス数(0ならスレッドで変換)
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', 2))
+MEDIA_VARIANT_FORMAT = os.environ.get('MEDIA_VARIANT_FORMAT', 'WEBP')
+MEDIA_VARIANT_QUALITY = int(os.environ.get('MEDIA_VARIANT_QUALITY', 80))
+
+# メディアの転送をフロントのサーバーに任せる(api.sendfile)
+#   '' : Pythonで送る, 'nginx' : X-Accel-Redirect, 'xsendfile' : X-Sendfile
+MEDIA_SENDFILE_BACKEND = os.environ.get('MEDIA_SENDFILE_BACKEND', '')
+# nginxのinternalなlocation (alias にMEDIA_ROOTを指定する)
+MEDIA_SENDFILE_ROOT = os.environ.get('MEDIA_SENDFILE_ROOT', '/protected-media/')
+# メッセージの画像をルームのユーザーにだけ見せる
+MEDIA_PRIVATE_MESSAGES = os.environ.get('MEDIA_PRIVATE_MESSAGES', 'false').lower() in ('1', 'true', 'yes')
+# メッセージの画像のURLに付ける署名(api.media_tokens)の有効期間
+MEDIA_TOKEN_MAX_AGE = int(os.environ.get('MEDIA_TOKEN_MAX_AGE', 60 * 60))
+
+# 古い通知, メッセージのアーカイブ(api.archive, manage.py archive_data)
+ARCHIVE_NOTIFICATION_DAYS = int(os.environ.get('ARCHIVE_NOTIFICATION_DAYS', 90))
+ARCHIVE_MESSAGE_DAYS = int(os.environ.get('ARCHIVE_MESSAGE_DAYS', 365))
+# 削除フラグが立ってから物理削除するまでの日数
+ARCHIVE_PURGE_DELETED_DAYS = int(os.environ.get('ARCHIVE_PURGE_DELETED_DAYS', 30))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+# ?page_size= が無い時にアーカイブから1回で返す件数
+ARCHIVE_PAGE_SIZE = int(os.environ.get('ARCHIVE_PAGE_SIZE', 50))
+
 # LOGIN_URL = 'api:login'
 # LOGIN_REDIRECT_URL 'api:index'
 
@@ -237,11 +390,54 @@ EMAIL_HOST_PASSWORD = os.environ['SENDGRID_API_KEY']
 EMAIL_USE_TLS = True
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# ログ設定
+#   LOG_LEVEL : 環境毎のログレベル(開発はDEBUG, 本番はINFO)
+#   LOG_FORMAT : text / json(ログ収集基盤に取り込む場合)
+#   出力はAsyncQueueHandlerでキューに積み、別スレッドで書き出す。
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG' if DEBUG else 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'text': {
+            'format': '''%(levelname)s %(asctime)s %(pathname)s:%(funcName)s:%(lineno)s
+        %(message)s''',
+        },
+        'json': {
+            '()': 'api.logs.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': LOG_FORMAT,
+        },
+        'queue': {
+            '()': 'api.logs.AsyncQueueHandler',
+            'handlers': ['cfg://handlers.console'],
+            'maxsize': LOG_QUEUE_SIZE,
+        },
+    },
+    'root': {
+        'level': LOG_LEVEL,
+        'handlers': ['queue'],
+    },
+    'loggers': {
+        'django': {
+            'level': os.environ.get('DJANGO_LOG_LEVEL', 'INFO'),
+            'handlers': ['queue'],
+            'propagate': False,
+        },
+        'asyncio': {
+            'level': 'WARNING',
+        },
+    },
+}
+
 if DEBUG:
-    logging.basicConfig(
-        level = logging.DEBUG,
-        format = '''%(levelname)s %(asctime)s %(pathname)s:%(funcName)s:%(lineno)s
-        %(message)s''')
     INSTALLED_APPS += ['corsheaders']
     MIDDLEWARE = ['corsheaders.middleware.CorsMiddleware'] + MIDDLEWARE
     CORS_ORIGIN_WHITELIST = (
@@ -249,18 +445,13 @@ if DEBUG:
     )
 
 else:
-    logging.basicConfig(
-        level = logging.DEBUG,
-        format = '''%(levelname)s %(asctime)s %(pathname)s:%(funcName)s 行数:%(lineno)s:%(lineno)s
-        %(message)s'''
-        # filename = 'logs/debug.log',
-        # filemode = 'a'
-    )
     INSTALLED_APPS += [
         'cloudinary',
         'cloudinary_storage',
     ]
     DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+    if MEDIA_CONTENT_ADDRESSED:
+        DEFAULT_FILE_STORAGE = 'api.storage.CASCloudinaryStorage'
     EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
     CLOUDINARY_STORAGE = {
         'CLOUD_NAME': os.environ['CLOUD_NAME'],
@@ -1,11 +1,14 @@
+import re
+
 from django.contrib import admin
-from django.urls import path, include
-from django.contrib.staticfiles.urls import static, staticfiles_urlpatterns
+from django.urls import path, re_path, include
+from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.views.generic import TemplateView
 
 from rest_framework_jwt.views import obtain_jwt_token
 
 from . import settings
+from api.views import serve_media
 
 urlpatterns = [
     path('api/', include('api.urls')),
@@ -16,5 +19,5 @@ urlpatterns = [
 ]
 
 urlpatterns += staticfiles_urlpatterns()
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+urlpatterns += [re_path(r'^{0}(?P<path>.*)$'.format(re.escape(settings.MEDIA_URL.lstrip('/'))), serve_media)]
 urlpatterns += [path('<path:path>', TemplateView.as_view(template_name='index.html'))]
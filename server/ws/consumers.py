@@ -1,9 +1,10 @@
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer, AsyncJsonWebsocketConsumer
 from channels.generic.http import AsyncHttpConsumer
 from django.db import connection
 from django.db.utils import OperationalError
-from channels.db import database_sync_to_async
+from channels.db import DatabaseSyncToAsync
+from concurrent.futures import ThreadPoolExecutor
 from django.core import serializers
 from django.utils import timezone
 import json
@@ -12,15 +13,62 @@ from api.models import (
     Room,
     Message,
 )
-from urllib.parse import urlparse
+from api.uploads import (
+    UploadError,
+    attach_uploads,
+)
+from .outbox import Outbox
+from .tickets import WS_TICKET_PARAM, check_ticket
+from urllib.parse import urlparse, parse_qs
+from django.conf import settings
 import datetime
 import time
 import json
 import logging
 logger = logging.getLogger(__name__)
 
+WS_MAX_SUBSCRIPTIONS = getattr(settings, 'WS_MAX_SUBSCRIPTIONS', 50)
+
+# consumerのDBアクセスを実行するスレッド(接続はスレッド毎なのでプールはASGI_THREADS以上にする)
+db_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ASGI_THREADS', 8),
+    thread_name_prefix='ws-db',
+)
+
+
+def database_sync_to_async(func):
+    """
+    channels.db.database_sync_to_asyncをdb_executorで並列に実行する版
+        thread_sensitive=True(既定)だと同期のViewと同じ1つのスレッドで順に実行される。
+        スレッドに依存する状態を持たないORMの処理だけに使う。
+    """
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=db_executor)
+
+
+class OutboxMixin:
+    """
+    チャンネルレイヤーのイベントを接続毎の送信キュー(ws.outbox)経由で送る。
+        遅いクライアントへの送信を待たずに次のイベントを受け取れる。
+    """
+
+    outbox = None
+
+    def open_outbox(self):
+        self.outbox = Outbox(self.send_payload, self.close)
+
+    def close_outbox(self):
+        if self.outbox is not None:
+            self.outbox.stop()
+
+    async def send_payload(self, payload):
+        await self.send(text_data=json.dumps(payload))
+
+    def push(self, payload):
+        if self.outbox is not None:
+            self.outbox.put(payload['type'], payload)
+
 
-class MessageConsumer(AsyncWebsocketConsumer):
+class MessageConsumer(OutboxMixin, AsyncWebsocketConsumer):
     """
     メッセージ関連のコンシューマー
     """
@@ -31,6 +79,7 @@ class MessageConsumer(AsyncWebsocketConsumer):
         logger.info('コネクト')
         try:
             await self.accept()
+            self.open_outbox()
             self.room_group_name = self.scope['url_route']['kwargs']['room_name']
             await self.channel_layer.group_add(
                 self.room_group_name,
@@ -41,6 +90,7 @@ class MessageConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         logger.info('ディスコネクト')
+        self.close_outbox()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -61,6 +111,8 @@ class MessageConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 {
                     'type': 'chat_message',
+                    'group': self.room_group_name,
+                    'id': self.message_id,
                     'roomId': roomId,
                     'content': content,
                     'sender': sender,
@@ -75,24 +127,24 @@ class MessageConsumer(AsyncWebsocketConsumer):
             content = event['content']
             sender = event['sender']
             receiver = event['receiver']
-            await self.send(text_data=json.dumps({
+            self.push({
                 'type': 'chat_message',
                 'content': content,
                 'sender': sender,
                 'receiver': receiver,
-                'id': self.message_id,
+                'id': event.get('id'),
                 'deleted': False,
-            }))
+            })
         except Exception as e:
             raise
 
     async def read_message(self, event):
         try:
             data = event['data']
-            await self.send(text_data=json.dumps({
+            self.push({
                 'type': 'read_message',
                 'data': data,
-            }))
+            })
         except Exception as e:
             raise
 
@@ -100,21 +152,35 @@ class MessageConsumer(AsyncWebsocketConsumer):
     def createMessage(self, event):
         logger.info('作成')
         try:
-            room = Room.objects.get(id=event['roomId'])
-            sender = mUser.objects.get(username=event['sender'])
-            receiver = mUser.objects.get(username=event['receiver'])
-            msg = Message.objects.create(
-                room=room,
-                content=event['content'],
-                sender=sender,
-                receiver=receiver,
+            msg = create_message(
+                Room.objects.get(id=event['roomId']),
+                mUser.objects.get(username=event['sender']),
+                mUser.objects.get(username=event['receiver']),
+                event,
             )
             self.message_id = str(msg.id)
         except Exception as e:
             raise
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+def create_message(room, sender, receiver, event):
+    msg = Message.objects.create(
+        room=room,
+        content=event['content'],
+        sender=sender,
+        receiver=receiver,
+    )
+
+    # 画像はアップロード(api/upload/)のトークンで受け取る
+    if event.get('imageToken'):
+        try:
+            attach_uploads({'image_token': event['imageToken']}, sender, msg, ['image'])
+        except UploadError as e:
+            logger.warning('画像を添付できませんでした: %s', e)
+    return msg
+
+
+class NotificationConsumer(OutboxMixin, AsyncWebsocketConsumer):
     """
     通知関連のコンシューマー
     """
@@ -131,11 +197,13 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
             await self.accept()
+            self.open_outbox()
         except Exception as e:
             raise
 
     async def disconnect(self, close_code):
         logger.debug('【【DISCONNECT】】')
+        self.close_outbox()
         await self.channel_layer.group_discard(
             self.user_group_name,
             self.channel_name
@@ -146,10 +214,10 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         logger.debug('=====NOTIFICATION=====')
         try:
             content = event['content']
-            await self.send(text_data=json.dumps({
+            self.push({
                 'type': 'notification',
                 'content': content,
-            }))
+            })
         except Exception as e:
             raise
 
@@ -157,9 +225,207 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         logger.debug('=====MESSAGE_NOTIFICATION=====')
         try:
             content = event['content']
-            await self.send(text_data=json.dumps({
+            self.push({
                 'type': 'message_notification',
                 'content': content,
-            }))
+            })
         except Exception as e:
             raise
+
+    async def timeline(self, event):
+        self.push(event)
+
+
+class MultiplexConsumer(OutboxMixin, AsyncJsonWebsocketConsumer):
+    """
+    1つの接続で通知と複数のルームを扱うコンシューマー
+
+        接続 : ws/?ticket=<api/ws-ticket/で発行したチケット>
+        ストリーム
+            user : 自分の通知(notification, message_notification), タイムラインの新着(timeline)
+            room:<ルームのid> : ルームのメッセージ(chat_message, read_message)
+
+        クライアント → サーバー
+            {"action": "subscribe", "stream": "room:<id>"}
+            {"action": "unsubscribe", "stream": "room:<id>"}
+            {"action": "send", "stream": "room:<id>", "content": ..., "imageToken": ...}
+                受信者はルームの相手。receiver(ユーザー名)を指定する場合はルームのユーザーに限る。
+            {"action": "ping"}
+
+        サーバー → クライアント
+            {"stream": <ストリーム>, "type": <イベント>, ...}
+            {"type": "subscribed" / "unsubscribed", "stream": <ストリーム>}
+            {"type": "error", "detail": ..., "stream": <ストリーム>}
+            {"type": "resume", "since": <日時>} : 送信が追い付かない時。4008で切断するので、
+                                                 再接続してsince以降をAPIで取り直す。
+
+        グループは従来のコンシューマーと同じ(ユーザー名, ルームのid)なので、送る側はそのまま使える。
+    """
+
+    async def connect(self):
+        self.user = await self.authenticate()
+        if self.user is None:
+            await self.close()
+            return
+
+        # {グループ名: ストリーム}
+        self.subscriptions = {}
+        await self.accept()
+        self.open_outbox()
+
+    async def disconnect(self, close_code):
+        self.close_outbox()
+        for group in list(getattr(self, 'subscriptions', {})):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.subscriptions = {}
+
+    async def receive_json(self, content):
+        action = content.get('action') if isinstance(content, dict) else None
+        stream = content.get('stream', '') if isinstance(content, dict) else ''
+
+        if action == 'ping':
+            await self.send_json({'type': 'pong'})
+        elif action == 'subscribe':
+            await self.subscribe(stream)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(stream)
+        elif action == 'send':
+            await self.send_room_message(stream, content)
+        else:
+            await self.send_error('不明なactionです。', stream)
+
+    async def subscribe(self, stream):
+        group = await self.resolve_group(stream)
+        if group is None:
+            await self.send_error('購読できないストリームです。', stream)
+            return
+        if group not in self.subscriptions:
+            if len(self.subscriptions) >= WS_MAX_SUBSCRIPTIONS:
+                await self.send_error('購読数の上限を超えています。', stream)
+                return
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.subscriptions[group] = stream
+        await self.send_json({'type': 'subscribed', 'stream': stream})
+
+    async def unsubscribe(self, stream):
+        for group, subscribed in list(self.subscriptions.items()):
+            if subscribed == stream:
+                await self.channel_layer.group_discard(group, self.channel_name)
+                del self.subscriptions[group]
+        await self.send_json({'type': 'unsubscribed', 'stream': stream})
+
+    async def send_room_message(self, stream, content):
+        group = self.group_of(stream)
+        if group is None or not stream.startswith('room:'):
+            await self.send_error('購読していないルームです。', stream)
+            return
+        try:
+            message_id, receiver = await self.create_room_message(group, content)
+        except (mUser.DoesNotExist, Room.DoesNotExist, KeyError):
+            await self.send_error('メッセージを作成できませんでした。', stream)
+            return
+
+        await self.channel_layer.group_send(group, {
+            'type': 'chat_message',
+            'group': group,
+            'id': message_id,
+            'roomId': group,
+            'content': content['content'],
+            'sender': self.user.username,
+            'receiver': receiver,
+        })
+
+    def group_of(self, stream):
+        for group, subscribed in self.subscriptions.items():
+            if subscribed == stream:
+                return group
+        return None
+
+    async def send_error(self, detail, stream=''):
+        await self.send_json({'type': 'error', 'detail': detail, 'stream': stream})
+
+    async def forward(self, event, stream=None):
+        """
+        グループのイベントを購読しているストリームとしてクライアントに送る。
+        """
+
+        stream = stream or self.subscriptions.get(event.get('group'))
+        if stream is None:
+            return
+        payload = {key: value for key, value in event.items() if key != 'group'}
+        payload['stream'] = stream
+        self.push(payload)
+
+    async def notification(self, event):
+        await self.forward(event, 'user')
+
+    async def message_notification(self, event):
+        await self.forward(event, 'user')
+
+    async def timeline(self, event):
+        await self.forward(event, 'user')
+
+    async def chat_message(self, event):
+        await self.forward(event)
+
+    async def read_message(self, event):
+        await self.forward(event)
+
+    async def authenticate(self):
+        """
+        クエリ文字列のチケット(ws.tickets)か、セッションのユーザー
+        """
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        ticket = query.get(WS_TICKET_PARAM, [None])[0]
+        if ticket:
+            return await self.get_user_from_ticket(ticket)
+
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            return user
+        return None
+
+    @database_sync_to_async
+    def get_user_from_ticket(self, ticket):
+        pk = check_ticket(ticket)
+        if pk is None:
+            return None
+        return mUser.objects.filter(pk=pk, is_active=True).first()
+
+    @database_sync_to_async
+    def resolve_group(self, stream):
+        """
+        ストリームのグループ名(購読できなければNone)
+        """
+
+        if stream == 'user':
+            return self.user.username
+        if stream.startswith('room:'):
+            try:
+                room = Room.objects.filter(id=stream[len('room:'):], users=self.user).values_list('id', flat=True).first()
+            except Exception:
+                # idの形式が違う
+                return None
+            if room is not None:
+                return str(room)
+        return None
+
+    @database_sync_to_async
+    def create_room_message(self, group, content):
+        """
+        メッセージを作成し、(id, 受信者のユーザー名)を返す。
+            購読した後にルームから外されていれば作らない。
+            受信者はルームの自分以外のユーザーから選ぶ。
+        """
+
+        room = Room.objects.get(id=group, users=self.user)
+        members = room.users.exclude(pk=self.user.pk)
+        if content.get('receiver'):
+            receiver = members.get(username=content['receiver'])
+        else:
+            receiver = members.order_by('pk').first()
+            if receiver is None:
+                raise mUser.DoesNotExist
+        msg = create_message(room, self.user, receiver, content)
+        return str(msg.id), receiver.username
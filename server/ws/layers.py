@@ -0,0 +1,252 @@
+import asyncio
+import collections
+import random
+import string
+import threading
+import time
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from channels_redis.core import RedisChannelLayer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+チャンネルレイヤー
+
+    settings.CHANNEL_LAYER_BACKEND で選ぶ。
+        local : LocalChannelLayer (1プロセスで動かす場合, 開発, テスト, 負荷試験。Redis不要)
+        redis : BatchedRedisChannelLayer (複数プロセス, 複数サーバー)
+
+    どちらも group_send_many([(グループ名, メッセージ), ...]) でまとめて送れる。
+"""
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """
+    プロセス内のチャンネルレイヤー
+
+        channelsのInMemoryChannelLayerと違い、別スレッドのイベントループ
+        (async_to_syncで送るsignalsなど)から送っても受信側のループで起こす。
+        グループに送るメッセージはコピーを1回だけ作り、全ての受信者で共有する。
+        (コンシューマーは受け取ったメッセージを変更しない事)
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        # {チャンネル名: deque((期限, メッセージ))}
+        self.channels = {}
+        # {チャンネル名: [(ループ, Future)]}
+        self.waiters = {}
+        # {グループ名: {チャンネル名: 追加した時刻}}
+        self.groups = {}
+        self._lock = threading.Lock()
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self._push(channel, deepcopy(message), time.time())
+
+    def _push(self, channel, message, now):
+        with self._lock:
+            queue = self.channels.setdefault(channel, collections.deque())
+            if len(queue) >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            queue.append((now + self.expiry, message))
+            waiters = self.waiters.pop(channel, [])
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                queue = self.channels.get(channel)
+                while queue:
+                    expires, message = queue.popleft()
+                    if expires >= time.time():
+                        if not queue:
+                            del self.channels[channel]
+                        return message
+                if queue is not None:
+                    del self.channels[channel]
+                future = loop.create_future()
+                self.waiters.setdefault(channel, []).append((loop, future))
+
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    waiters = self.waiters.get(channel, [])
+                    if (loop, future) in waiters:
+                        waiters.remove((loop, future))
+                raise
+
+    async def new_channel(self, prefix='specific.'):
+        return '{0}.local!{1}'.format(prefix, ''.join(random.choice(string.ascii_letters) for i in range(12)))
+
+    async def flush(self):
+        with self._lock:
+            self.channels = {}
+            self.groups = {}
+
+    async def close(self):
+        pass
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        with self._lock:
+            self.groups.setdefault(group, {})[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Invalid group name'
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        with self._lock:
+            members = self.groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del self.groups[group]
+
+    async def group_send(self, group, message):
+        await self.group_send_many([(group, message)])
+
+    async def group_send_many(self, sends):
+        now = time.time()
+        over_capacity = 0
+        for group, message in sends:
+            assert isinstance(message, dict), 'Message is not a dict'
+            assert self.valid_group_name(group), 'Invalid group name'
+            message = deepcopy(message)
+            for channel in self._group_channels(group, now):
+                try:
+                    self._push(channel, message, now)
+                except ChannelFull:
+                    over_capacity += 1
+        if over_capacity:
+            logger.warning('%d件のメッセージがチャンネルの上限を超えたため送れませんでした', over_capacity)
+
+    def _group_channels(self, group, now):
+        with self._lock:
+            members = self.groups.get(group, {})
+            for channel, joined in list(members.items()):
+                if joined < now - self.group_expiry:
+                    del members[channel]
+            return list(members)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+GROUP_SEND_LUA = """
+local over_capacity = 0
+for i=1,#KEYS do
+    if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS]) then
+        redis.call('LPUSH', KEYS[i], ARGV[i])
+        redis.call('EXPIRE', KEYS[i], %d)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+class BatchedRedisChannelLayer(RedisChannelLayer):
+    """
+    同じループの同じタイミング(次にイベントループに戻るまで)に呼ばれたgroup_sendを
+    まとめて送るRedisのチャンネルレイヤー
+
+        グループのメンバーの取得はRedisのサーバー毎に1回のパイプライン,
+        メッセージの追加もサーバー毎に1回のLuaスクリプトで行う。
+        (channels_redisは1回のgroup_send毎に2往復する)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {ループ: [(グループ名, メッセージ, Future)]}
+        self._pending = {}
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.get(loop)
+        if pending is None:
+            pending = self._pending[loop] = []
+            loop.call_soon(self._start_flush, loop)
+        pending.append((group, message, future))
+        await future
+
+    def _start_flush(self, loop):
+        loop.create_task(self._flush(self._pending.pop(loop, [])))
+
+    async def _flush(self, pending):
+        try:
+            await self.group_send_many([(group, message) for group, message, future in pending])
+        except Exception as e:
+            for group, message, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for group, message, future in pending:
+                if not future.done():
+                    future.set_result(None)
+
+    async def group_send_many(self, sends):
+        if not sends:
+            return
+        members = await self._group_members({group for group, message in sends})
+
+        # {接続の番号: ([キー], [メッセージ], [上限])}
+        batches = collections.defaultdict(lambda: ([], [], []))
+        for group, message in sends:
+            connection_to_keys, key_to_message, key_to_capacity = \
+                self._map_channel_keys_to_connection(members[group], message)
+            for index, keys in connection_to_keys.items():
+                batch = batches[index]
+                for key in keys:
+                    batch[0].append(key)
+                    batch[1].append(key_to_message[key])
+                    batch[2].append(key_to_capacity[key])
+
+        script = GROUP_SEND_LUA % self.expiry
+        for index, (keys, messages, capacities) in batches.items():
+            async with self.connection(index) as connection:
+                over_capacity = await connection.eval(script, keys=keys, args=messages + capacities)
+            if over_capacity:
+                logger.warning('%d件のメッセージがチャンネルの上限を超えたため送れませんでした', over_capacity)
+
+    async def _group_members(self, groups):
+        """
+        {グループ名: [チャンネル名]}
+        """
+
+        by_connection = collections.defaultdict(list)
+        for group in groups:
+            by_connection[self.consistent_hash(group)].append(group)
+
+        members = {}
+        expired = int(time.time()) - self.group_expiry
+        for index, names in by_connection.items():
+            async with self.connection(index) as connection:
+                pipe = connection.pipeline()
+                for group in names:
+                    key = self._group_key(group)
+                    pipe.zremrangebyscore(key, min=0, max=expired)
+                    pipe.zrange(key, 0, -1)
+                results = await pipe.execute()
+            for group, channels in zip(names, results[1::2]):
+                members[group] = [channel.decode('utf8') for channel in channels]
+        return members
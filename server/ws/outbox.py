@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import time
+import weakref
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+WS_OUTBOX_SIZE = getattr(settings, 'WS_OUTBOX_SIZE', 100)
+
+
+"""
+websocketの接続毎の送信キュー
+
+    コンシューマーはチャンネルレイヤーから受け取ったイベントをキューに積むだけで、
+    送信は接続毎のタスクが行う。遅いクライアントがいても他の接続への配信や
+    チャンネルレイヤーからの受信を止めない。
+
+    キューが詰まった時の扱いはイベントの種類毎に決める。
+        COALESCE : 上限に達したら、未送信の同じ種類のイベントを最新の内容にまとめる。(coalescedに件数)
+                   クライアントは件数を見て一覧を取り直す。上限までは1件ずつ送る。
+        DROP_OLDEST : 上限に達したら同じ種類の一番古いものを捨てる。(既読通知)
+        DISCONNECT : 上限に達したら再開の目安(since)を送って切断する。
+                     クライアントは再接続してsince以降をAPIで取り直す。
+"""
+
+COALESCE = 'coalesce'
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+
+POLICIES = {
+    'notification': COALESCE,
+    'message_notification': COALESCE,
+    # まとめた場合はクライアントがホームの先頭を取り直す
+    'timeline': COALESCE,
+    'read_message': DROP_OLDEST,
+    'chat_message': DISCONNECT,
+}
+
+# 上限を超えて切断した時のクローズコード
+CLOSE_SLOW_CONSUMER = 4008
+
+_outboxes = weakref.WeakSet()
+_counters = collections.Counter()
+
+
+class Outbox:
+    """
+    Parameters
+    -------------------------------------------
+    send : 1件を送るコルーチン関数(dictを受け取る)
+    close : 切断するコルーチン関数(クローズコードを受け取る)
+    """
+
+    def __init__(self, send, close, limit=WS_OUTBOX_SIZE):
+        self.send = send
+        self.close_connection = close
+        self.limit = limit
+        # [種類, 内容, 積んだ時刻, まとめた件数]
+        self.queue = collections.deque()
+        self.max_depth = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+        _outboxes.add(self)
+        _counters['connections'] += 1
+
+    def put(self, kind, payload):
+        """
+        イベントを積む。(待たない)
+        """
+
+        if self.closed:
+            return
+        policy = POLICIES.get(kind, DISCONNECT)
+
+        if policy == COALESCE and len(self.queue) >= self.limit:
+            for entry in reversed(self.queue):
+                if entry[0] == kind:
+                    entry[3] += 1
+                    entry[1] = dict(payload, coalesced=entry[3])
+                    _counters['coalesced'] += 1
+                    return
+
+        if len(self.queue) >= self.limit:
+            if policy == DROP_OLDEST and self._drop_oldest(kind):
+                _counters['dropped'] += 1
+            elif policy == DISCONNECT or policy == COALESCE:
+                self._overflow()
+                return
+            else:
+                _counters['dropped'] += 1
+                return
+
+        self.queue.append([kind, payload, time.time(), 1])
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self._wakeup.set()
+
+    def _drop_oldest(self, kind):
+        for entry in self.queue:
+            if entry[0] == kind:
+                self.queue.remove(entry)
+                return True
+        return False
+
+    def _overflow(self):
+        since = self.queue[0][2] if self.queue else time.time()
+        self.queue.clear()
+        self.closed = True
+        _counters['disconnected'] += 1
+        logger.warning('送信が追い付かない接続を切断します(上限%d件)', self.limit)
+        asyncio.ensure_future(self._disconnect(since))
+
+    async def _disconnect(self, since):
+        try:
+            await self.send({
+                'type': 'resume',
+                'since': timezone.localtime(datetime.fromtimestamp(since, tz=timezone.utc)).isoformat(),
+            })
+        finally:
+            await self.close_connection(CLOSE_SLOW_CONSUMER)
+            self.stop()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.queue and not self.closed:
+                kind, payload, queued_at, count = self.queue.popleft()
+                try:
+                    await self.send(payload)
+                except Exception:
+                    # 切断済みなど
+                    logger.debug('送信できませんでした', exc_info=True)
+                    self.stop()
+                    return
+                _counters['sent'] += 1
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        self._task.cancel()
+
+
+def outbox_stats():
+    """
+    このプロセスの送信キューの状態
+    """
+
+    outboxes = list(_outboxes)
+    depths = [len(outbox.queue) for outbox in outboxes]
+    return dict(
+        _counters,
+        open=len(outboxes),
+        queued=sum(depths),
+        max_depth=max(depths, default=0),
+        peak_depth=max((outbox.max_depth for outbox in outboxes), default=0),
+    )
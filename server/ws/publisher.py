@@ -0,0 +1,185 @@
+import asyncio
+import atexit
+import collections
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+WS_PUBLISH_QUEUE_SIZE = getattr(settings, 'WS_PUBLISH_QUEUE_SIZE', 10000)
+WS_PUBLISH_BATCH_SIZE = getattr(settings, 'WS_PUBLISH_BATCH_SIZE', 100)
+WS_PUBLISH_SHUTDOWN_TIMEOUT = getattr(settings, 'WS_PUBLISH_SHUTDOWN_TIMEOUT', 5)
+
+
+"""
+同期のコード(signals, View)からwebsocketへ送るパブリッシャー
+
+    async_to_sync(channel_layer.group_send) は送る度にイベントループを用意し、
+    送り終わるまでリクエストを待たせる。
+    publish はキューに積むだけで戻り、専用スレッドのイベントループが
+    WS_PUBLISH_BATCH_SIZE件ずつ group_send_many でまとめて送る。
+
+    キューがWS_PUBLISH_QUEUE_SIZEを超えたら(レイヤーが遅い時)は捨ててdroppedに数える。
+    トランザクション中に呼ばれた場合はコミットされてから積む。
+"""
+
+
+class Publisher:
+
+    def __init__(self, maxsize=WS_PUBLISH_QUEUE_SIZE, batch_size=WS_PUBLISH_BATCH_SIZE):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.pending = collections.deque()
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_latency = 0.0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._wakeup = None
+        self._task = None
+        self._scheduled = False
+
+    def publish(self, group, message):
+        """
+        送るメッセージをキューに積む。(積めなければFalse)
+        """
+        return self.publish_many([(group, message)]) == 1
+
+    def publish_many(self, sends, timeout=0):
+        """
+        [(グループ名, メッセージ)]をまとめて積み、積めた件数を返す。
+            timeout : 空きが出るまで待つ秒数(大量に送るワーカー用。リクエストからは待たない)
+        """
+
+        if self._loop is None:
+            self._start()
+
+        deadline = time.monotonic() + timeout
+        while timeout and time.monotonic() < deadline:
+            with self._lock:
+                if len(self.pending) + len(sends) <= self.maxsize:
+                    break
+            time.sleep(0.01)
+
+        now = time.monotonic()
+        with self._lock:
+            accepted = max(min(len(sends), self.maxsize - len(self.pending)), 0)
+            self.pending.extend((group, message, now) for group, message in sends[:accepted])
+            self.submitted += accepted
+            if accepted < len(sends):
+                before = self.dropped
+                self.dropped += len(sends) - accepted
+                if before // 1000 != self.dropped // 1000 or before == 0:
+                    logger.warning('websocketへの送信キューが一杯です(%d件破棄)', self.dropped)
+            wake = accepted and not self._scheduled
+            if wake:
+                self._scheduled = True
+        if wake:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return accepted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self.pending),
+                'submitted': self.submitted,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'batches': self.batches,
+                'last_latency_ms': round(self.last_latency * 1000, 3),
+            }
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(loop, ready), name='ws-publisher', daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            atexit.register(self.close)
+
+    def _run(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._drain())
+        ready.set()
+        loop.run_forever()
+        loop.close()
+
+    async def _drain(self):
+        layer = get_channel_layer()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    batch = [self.pending.popleft() for i in range(min(self.batch_size, len(self.pending)))]
+                    if not batch:
+                        self._scheduled = False
+                        break
+                await self._send(layer, batch)
+
+    async def _send(self, layer, batch):
+        sends = [(group, message) for group, message, queued_at in batch]
+        try:
+            if hasattr(layer, 'group_send_many'):
+                await layer.group_send_many(sends)
+            else:
+                await asyncio.gather(*[layer.group_send(group, message) for group, message in sends])
+        except Exception:
+            logger.exception('websocketへの送信に失敗しました(%d件)', len(batch))
+            with self._lock:
+                self.failed += len(batch)
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self.sent += len(batch)
+            self.batches += 1
+            self.last_latency = now - batch[0][2]
+
+    def close(self, timeout=WS_PUBLISH_SHUTDOWN_TIMEOUT):
+        """
+        残っている分を送ってからループを止める。(止めた後は何もしない)
+        """
+
+        if self._loop is None or self._loop.is_closed():
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self.pending and not self._scheduled:
+                    break
+            time.sleep(0.01)
+        self._loop.call_soon_threadsafe(self._stop)
+        self._thread.join(timeout)
+
+    def _stop(self):
+        # 待機中のタスクを残したまま止めると終了時にエラーが出るため、キャンセルしてから止める
+        self._task.cancel()
+        self._task.add_done_callback(lambda task: self._loop.stop())
+
+
+publisher = Publisher()
+
+
+def publish(group, message):
+    """
+    グループにメッセージを送る。(待たない)
+    """
+
+    transaction.on_commit(lambda: publisher.publish(group, message))
@@ -1,3 +1,399 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from api.models import (
+    mUser,
+    Message,
+    Room,
+)
+
+from .consumers import MultiplexConsumer
+from .layers import BatchedRedisChannelLayer, LocalChannelLayer
+from .outbox import CLOSE_SLOW_CONSUMER, Outbox, outbox_stats
+from .publisher import Publisher, publish
+from .tickets import check_ticket, issue_ticket
+
+
+LOCAL_LAYERS = {'default': {'BACKEND': 'ws.layers.LocalChannelLayer'}}
+
+
+def make_user(username):
+    return mUser.objects.create_user(username, username + '@example.com', 'password')
+
+
+@override_settings(CHANNEL_LAYERS=LOCAL_LAYERS)
+class MultiplexConsumerTests(TransactionTestCase):
+    """
+    ws/ の認証, 購読, 送信 (user-045)
+        consumerのDBアクセスは別スレッド(db_executor)で行うため、TransactionTestCaseを使う。
+    """
+
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.mallory = make_user('mallory')
+        self.room = Room.objects.create()
+        self.room.users.add(self.alice, self.bob)
+
+    def connect(self, user=None, ticket=None):
+        ticket = ticket or issue_ticket(user)
+        return WebsocketCommunicator(MultiplexConsumer, '/ws/?ticket=' + ticket)
+
+    def run_session(self, communicator, actions):
+        """
+        接続してactionを順に送り、それぞれの応答を返す。
+        """
+
+        async def session():
+            connected, _ = await communicator.connect()
+            replies = []
+            if connected:
+                for action, expected in actions:
+                    await communicator.send_json_to(action)
+                    replies.append([await communicator.receive_json_from(timeout=5) for _ in range(expected)])
+            await communicator.disconnect()
+            return connected, replies
+
+        return async_to_sync(session)()
+
+    def stream(self, room=None):
+        return 'room:{0}'.format((room or self.room).pk)
+
+    def test_ticket_is_required(self):
+        connected, _ = self.run_session(WebsocketCommunicator(MultiplexConsumer, '/ws/'), [])
+        self.assertFalse(connected)
+
+        ticket = issue_ticket(self.alice)
+        connected, _ = self.run_session(self.connect(ticket=ticket[:-1] + ('a' if ticket[-1] != 'a' else 'b')), [])
+        self.assertFalse(connected)
+
+    def test_ticket_expires(self):
+        ticket = issue_ticket(self.alice)
+        self.assertEqual(check_ticket(ticket), self.alice.pk)
+        self.assertIsNone(check_ticket(ticket, max_age=-1))
+
+    def test_ticket_endpoint_requires_login(self):
+        cache.clear()
+        client = APIClient()
+        self.assertIn(client.post('/api/ws-ticket/', HTTP_HOST='localhost').status_code, (401, 403))
+
+        client.force_authenticate(self.alice)
+        response = client.post('/api/ws-ticket/', HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(check_ticket(response.data['ticket']), self.alice.pk)
+
+    def test_subscribe_only_to_member_rooms(self):
+        other = Room.objects.create()
+        other.users.add(self.bob, self.mallory)
+
+        connected, replies = self.run_session(self.connect(self.alice), [
+            ({'action': 'subscribe', 'stream': self.stream()}, 1),
+            ({'action': 'subscribe', 'stream': self.stream(other)}, 1),
+            ({'action': 'subscribe', 'stream': 'room:not-a-uuid'}, 1),
+            ({'action': 'subscribe', 'stream': 'user'}, 1),
+        ])
+
+        self.assertTrue(connected)
+        self.assertEqual([reply[0]['type'] for reply in replies], ['subscribed', 'error', 'error', 'subscribed'])
+
+    def test_receiver_is_the_other_member(self):
+        connected, replies = self.run_session(self.connect(self.alice), [
+            ({'action': 'subscribe', 'stream': self.stream()}, 1),
+            ({'action': 'send', 'stream': self.stream(), 'content': 'hello'}, 1),
+            ({'action': 'send', 'stream': self.stream(), 'content': 'spoof', 'receiver': 'mallory'}, 1),
+        ])
+
+        message = replies[1][0]
+        self.assertEqual((message['type'], message['receiver'], message['sender']), ('chat_message', 'bob', 'alice'))
+        self.assertEqual(replies[2][0]['type'], 'error')
+        self.assertEqual(
+            list(Message.objects.values_list('content', 'receiver__username')),
+            [('hello', 'bob')],
+        )
+
+    def test_send_after_removed_from_room(self):
+        communicator = self.connect(self.alice)
+
+        async def session():
+            await communicator.connect()
+            await communicator.send_json_to({'action': 'subscribe', 'stream': self.stream()})
+            await communicator.receive_json_from(timeout=5)
+
+            await database_sync_to_async(self.room.users.remove)(self.alice)
+            await communicator.send_json_to({'action': 'send', 'stream': self.stream(), 'content': 'late'})
+            reply = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            return reply
+
+        self.assertEqual(async_to_sync(session)()['type'], 'error')
+        self.assertFalse(Message.objects.exists())
+
+
+class LocalChannelLayerTests(SimpleTestCase):
+    """
+    ws.layers.LocalChannelLayer, BatchedRedisChannelLayerのまとめ送り (user-046)
+    """
+
+    def test_send_and_receive_copy(self):
+        layer = LocalChannelLayer()
+        message = {'type': 'test', 'items': [1]}
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.send(channel, message)
+            message['items'].append(2)
+            return await layer.receive(channel)
+
+        self.assertEqual(async_to_sync(run)(), {'type': 'test', 'items': [1]})
+
+    def test_group_send_many(self):
+        layer = LocalChannelLayer()
+
+        async def run():
+            a, b = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('room1', a)
+            await layer.group_add('room1', b)
+            await layer.group_add('room2', b)
+            await layer.group_discard('room2', a)
+            await layer.group_send_many([('room1', {'type': 'one'}), ('room2', {'type': 'two'})])
+            return [await layer.receive(a)], [await layer.receive(b), await layer.receive(b)]
+
+        received_a, received_b = async_to_sync(run)()
+        self.assertEqual([message['type'] for message in received_a], ['one'])
+        self.assertEqual([message['type'] for message in received_b], ['one', 'two'])
+        # グループの受信者はコピーを共有する
+        self.assertIs(received_a[0], received_b[0])
+
+    def test_capacity(self):
+        layer = LocalChannelLayer(capacity=1)
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            await layer.send(channel, {'type': 'first'})
+            # グループへの送信は上限を超えた分を捨てる
+            await layer.group_send('room', {'type': 'dropped'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'full'})
+            return await layer.receive(channel), layer.channels.get(channel)
+
+        message, rest = async_to_sync(run)()
+        self.assertEqual((message['type'], rest), ('first', None))
+
+    def test_expired_group_members_are_skipped(self):
+        layer = LocalChannelLayer(group_expiry=-1)
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            await layer.group_send('room', {'type': 'late'})
+            return layer.groups['room']
+
+        self.assertEqual(async_to_sync(run)(), {})
+
+    def test_send_from_another_thread_wakes_receiver(self):
+        layer = LocalChannelLayer()
+
+        async def run():
+            channel = await layer.new_channel()
+            waiting = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0)
+            # signalsなど別スレッドのループから送る
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: async_to_sync(layer.send)(channel, {'type': 'wake'}))
+            return await asyncio.wait_for(waiting, timeout=5)
+
+        self.assertEqual(async_to_sync(run)(), {'type': 'wake'})
+
+    def test_redis_group_sends_are_batched_per_tick(self):
+        layer = BatchedRedisChannelLayer(hosts=[('localhost', 6379)])
+        sent = []
+
+        async def group_send_many(sends):
+            sent.append(list(sends))
+
+        async def run():
+            with mock.patch.object(layer, 'group_send_many', group_send_many):
+                await asyncio.gather(
+                    layer.group_send('a', {'type': 'one'}),
+                    layer.group_send('b', {'type': 'two'}),
+                )
+                await layer.group_send('c', {'type': 'three'})
+
+        async_to_sync(run)()
+        self.assertEqual(sent, [
+            [('a', {'type': 'one'}), ('b', {'type': 'two'})],
+            [('c', {'type': 'three'})],
+        ])
+
+
+@override_settings(CHANNEL_LAYERS=LOCAL_LAYERS)
+class PublisherTests(TransactionTestCase):
+    """
+    ws.publisher (user-047)
+    """
+
+    def make_publisher(self, **kwargs):
+        publisher = Publisher(**kwargs)
+        self.addCleanup(publisher.close)
+        return publisher
+
+    def subscribe(self, group):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(group, channel)
+        return layer, channel
+
+    def test_publish_reaches_group(self):
+        layer, channel = self.subscribe('alice')
+        publisher = self.make_publisher()
+        self.assertTrue(publisher.publish('alice', {'type': 'notification', 'content': 'hello'}))
+
+        async def receive():
+            return await asyncio.wait_for(layer.receive(channel), timeout=5)
+
+        self.assertEqual(async_to_sync(receive)()['content'], 'hello')
+        publisher.close()
+        self.assertEqual(publisher.stats()['sent'], 1)
+
+    def test_sends_in_batches(self):
+        self.subscribe('alice')
+        publisher = self.make_publisher(batch_size=2)
+        self.assertEqual(publisher.publish_many([('alice', {'type': 'n', 'i': i}) for i in range(5)]), 5)
+        publisher.close()
+
+        stats = publisher.stats()
+        self.assertEqual((stats['sent'], stats['batches'], stats['queued']), (5, 3, 0))
+
+    def test_overflow_is_dropped(self):
+        publisher = self.make_publisher(maxsize=2)
+        with self.assertLogs('ws.publisher', 'WARNING'):
+            self.assertEqual(publisher.publish_many([('alice', {'type': 'n'})] * 3), 2)
+        self.assertEqual(publisher.stats()['dropped'], 1)
+
+    def test_layer_failure_is_counted(self):
+        class BrokenLayer:
+            async def group_send_many(self, sends):
+                raise ConnectionError('down')
+
+        with mock.patch('ws.publisher.get_channel_layer', return_value=BrokenLayer()), \
+                self.assertLogs('ws.publisher', 'ERROR'):
+            publisher = self.make_publisher()
+            publisher.publish('alice', {'type': 'n'})
+            publisher.close()
+        self.assertEqual((publisher.stats()['failed'], publisher.stats()['sent']), (1, 0))
+
+    def test_publish_waits_for_commit(self):
+        with mock.patch('ws.publisher.publisher') as queued:
+            with transaction.atomic():
+                publish('alice', {'type': 'n'})
+                self.assertFalse(queued.publish.called)
+            queued.publish.assert_called_once_with('alice', {'type': 'n'})
+
+
+class OutboxTests(SimpleTestCase):
+    """
+    ws.outbox の種類毎の溢れ方 (user-048)
+    """
+
+    def run_outbox(self, puts, limit=3, fail=False):
+        """
+        送信を止めたままputsを積み、送信を再開して送られたものと切断コードを返す。
+        """
+
+        sent, closed = [], []
+
+        async def run():
+            release = asyncio.Event()
+
+            async def send(payload):
+                await release.wait()
+                if fail:
+                    raise ConnectionError('closed')
+                sent.append(payload)
+
+            async def close(code):
+                closed.append(code)
+
+            outbox = Outbox(send, close, limit=limit)
+            for kind, payload in puts:
+                outbox.put(kind, dict(payload, type=kind))
+            release.set()
+            for _ in range(10):
+                await asyncio.sleep(0)
+            outbox.stop()
+            return outbox
+
+        outbox = async_to_sync(run)()
+        return outbox, sent, closed
+
+    def test_not_coalesced_under_limit(self):
+        outbox, sent, closed = self.run_outbox([('notification', {'n': n}) for n in range(3)])
+
+        self.assertEqual(sent, [{'type': 'notification', 'n': n} for n in range(3)])
+
+    def test_coalesce_keeps_latest_when_full(self):
+        outbox, sent, closed = self.run_outbox([
+            ('notification', {'n': 1}),
+            ('read_message', {'n': 2}),
+            ('notification', {'n': 3}),
+            ('notification', {'n': 4}),
+            ('notification', {'n': 5}),
+        ])
+
+        self.assertEqual(sent, [
+            {'type': 'notification', 'n': 1},
+            {'type': 'read_message', 'n': 2},
+            {'type': 'notification', 'n': 5, 'coalesced': 3},
+        ])
+        self.assertEqual(closed, [])
+
+    def test_drop_oldest(self):
+        outbox, sent, closed = self.run_outbox([('read_message', {'n': n}) for n in range(5)])
+
+        self.assertEqual([payload['n'] for payload in sent], [2, 3, 4])
+        self.assertEqual(closed, [])
+
+    def test_disconnect_sends_resume(self):
+        before = outbox_stats().get('disconnected', 0)
+        with self.assertLogs('ws.outbox', 'WARNING'):
+            outbox, sent, closed = self.run_outbox([('chat_message', {'n': n}) for n in range(4)])
+
+        self.assertTrue(outbox.closed)
+        self.assertEqual([payload['type'] for payload in sent], ['resume'])
+        self.assertIn('since', sent[0])
+        self.assertEqual(closed, [CLOSE_SLOW_CONSUMER])
+        self.assertEqual(outbox_stats()['disconnected'], before + 1)
+
+    def test_full_queue_disconnects_new_coalesce_kind(self):
+        # まとめる先が無ければ, 溢れた時は切断する
+        with self.assertLogs('ws.outbox', 'WARNING'):
+            outbox, sent, closed = self.run_outbox([
+                ('chat_message', {'n': 1}),
+                ('notification', {'n': 2}),
+            ], limit=1)
+
+        self.assertEqual(closed, [CLOSE_SLOW_CONSUMER])
+
+    def test_unknown_kind_disconnects(self):
+        with self.assertLogs('ws.outbox', 'WARNING'):
+            outbox, sent, closed = self.run_outbox([('unknown', {'n': n}) for n in range(2)], limit=1)
+
+        self.assertEqual(closed, [CLOSE_SLOW_CONSUMER])
+
+    def test_send_failure_stops(self):
+        with self.assertLogs('ws.outbox', 'DEBUG'):
+            outbox, sent, closed = self.run_outbox([('notification', {'n': 1}), ('read_message', {'n': 2})], fail=True)
+
+        self.assertTrue(outbox.closed)
+        self.assertEqual((sent, list(outbox.queue)), ([], []))
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core import signing
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+"""
+websocket(ws/)の接続に使うチケット
+
+    ブラウザのWebSocketはAuthorizationヘッダーを送れないため、URLに ?ticket= を付ける。
+    JWTをURLに載せるとログやリファラーから漏れた時に全てのAPIを使われるため、
+    認証済みのAPI(api/ws-ticket/)で発行した、WS_TICKET_MAX_AGE秒だけ有効な署名を使う。
+"""
+
+WS_TICKET_MAX_AGE = getattr(settings, 'WS_TICKET_MAX_AGE', 30)
+WS_TICKET_PARAM = 'ticket'
+SALT = 'ws.tickets'
+
+
+def issue_ticket(user):
+    """
+    ユーザーのチケット
+    """
+    return signing.dumps(user.pk, salt=SALT)
+
+
+def check_ticket(ticket, max_age=WS_TICKET_MAX_AGE):
+    """
+    チケットのユーザーのpkを返す。(期限切れ, 改ざんはNone)
+    """
+
+    try:
+        return signing.loads(ticket, salt=SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None